@@ -0,0 +1,81 @@
+"""聊天连接注册表压测：整个班级同时连入、断开时每次注册/注销的耗时
+
+每个规模下先依次connect全部连接（每个用户tabs个连接，模拟多个标签页），再全部disconnect，
+输出每次操作的平均耗时。注册表是O(1)的，规模增大时单次耗时应基本不变；
+结束后注册表没有清空，或单次耗时超过--max-op-us时以非0状态退出。
+
+    python chat_churn_bench.py
+    python chat_churn_bench.py --sizes 1000 10000 100000 --tabs 3
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import server
+
+class FakeWebSocket:
+    """只记录收到的帧的WebSocket替身，send_delay模拟慢客户端"""
+    def __init__(self, send_delay: float = 0.0):
+        self.send_delay = send_delay
+        self.frames = []
+        self.closed = None
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, message: str):
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        self.frames.append(message)
+
+    async def send_bytes(self, message: bytes):
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        self.frames.append(message)
+
+    async def close(self, code: int = 1000):
+        self.closed = code
+
+async def churn(size: int, tabs: int) -> dict:
+    manager = server.ConnectionManager()
+    sockets = [FakeWebSocket() for _ in range(size)]
+    users = max(1, size // tabs)
+    began = time.perf_counter()
+    for number, websocket in enumerate(sockets):
+        await manager.connect(websocket, f"student{number % users}@bench.test")
+    connected = time.perf_counter() - began
+    began = time.perf_counter()
+    for websocket in sockets:
+        manager.disconnect(websocket)
+    disconnected = time.perf_counter() - began
+    # 让被取消的写任务结束
+    await asyncio.sleep(0)
+    return {
+        "size": size,
+        "connect_us": connected / size * 1e6,
+        "disconnect_us": disconnected / size * 1e6,
+        "leftover": len(manager.active_connections) + len(manager.user_connections),
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="聊天连接注册/注销压测")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="连接数")
+    parser.add_argument("--tabs", type=int, default=2, help="每个用户的连接数")
+    parser.add_argument("--max-op-us", type=float, default=None, help="单次connect/disconnect耗时上限（微秒），超过时返回1")
+    args = parser.parse_args()
+
+    failures = []
+    for size in args.sizes:
+        result = asyncio.run(churn(size, args.tabs))
+        print(f"连接 {size}：connect {result['connect_us']:.2f}us/次  disconnect {result['disconnect_us']:.2f}us/次")
+        if result["leftover"]:
+            failures.append(f"{size} 个连接全部断开后注册表还剩 {result['leftover']} 项")
+        if args.max_op_us is not None and max(result["connect_us"], result["disconnect_us"]) > args.max_op_us:
+            failures.append(f"{size} 个连接时单次操作超过 {args.max_op_us}us")
+    for failure in failures:
+        print(f"❌ {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
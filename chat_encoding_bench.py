@@ -0,0 +1,75 @@
+"""聊天帧编码压测：每条消息的字节数、编码耗时，以及向混合格式的订阅者发布一条消息的耗时
+
+发布时每种格式只应编码一次，所有接收者共享同一个帧对象；不是这样时以非0状态退出。
+
+    python chat_encoding_bench.py
+    python chat_encoding_bench.py --subscribers 5000 --binary-share 0.5
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import server
+from chat_churn_bench import FakeWebSocket
+
+# 和handle_bus_event发布的消息相同，JSON帧带avatar、isSelf，二进制帧不带
+SAMPLE_MESSAGE = server.chat_payload(1234, "course:高等数学", "张三", "明天的高数作业是第三章习题吗？", "14:30")
+
+def frame_size(frame) -> int:
+    return len(frame) if isinstance(frame, bytes) else len(frame.encode("utf-8"))
+
+def time_encode(payload: dict, encoding: str, repeat: int) -> float:
+    began = time.perf_counter()
+    for _ in range(repeat):
+        server.encode_chat_frame(payload, encoding)
+    return (time.perf_counter() - began) / repeat
+
+async def fanout(subscribers: int, binary_share: float, messages: int) -> dict:
+    manager = server.ConnectionManager(queue_size=messages + 1)
+    sockets = []
+    binary_count = int(subscribers * binary_share)
+    for number in range(subscribers):
+        websocket = FakeWebSocket()
+        await manager.connect(websocket, f"student{number}@bench.test", "binary" if number < binary_count else "json")
+        manager.join(websocket, SAMPLE_MESSAGE["room"])
+        sockets.append(websocket)
+    began = time.perf_counter()
+    for seq in range(messages):
+        manager.publish_chat(SAMPLE_MESSAGE["room"], dict(SAMPLE_MESSAGE, seq=seq))
+    publish = (time.perf_counter() - began) / messages
+    while sum(len(websocket.frames) for websocket in sockets) < subscribers * messages:
+        await asyncio.sleep(0)
+    # 同一条消息同一种格式的接收者应当拿到同一个对象
+    shared = all(
+        len({id(websocket.frames[seq]) for websocket in group}) <= 1
+        for group in (sockets[:binary_count], sockets[binary_count:]) for seq in range(messages)
+    )
+    for websocket in sockets:
+        manager.disconnect(websocket)
+    await asyncio.sleep(0)
+    return {"publish_us": publish * 1e6, "shared": shared}
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="聊天帧编码压测")
+    parser.add_argument("--repeat", type=int, default=200000, help="单独编码的次数")
+    parser.add_argument("--subscribers", type=int, default=2000, help="聊天室订阅者数")
+    parser.add_argument("--binary-share", type=float, default=0.5, help="使用二进制格式的订阅者比例")
+    parser.add_argument("--messages", type=int, default=50, help="发布的消息数")
+    args = parser.parse_args()
+
+    for encoding in server.CHAT_ENCODINGS:
+        frame = server.encode_chat_frame(SAMPLE_MESSAGE, encoding)
+        seconds = time_encode(SAMPLE_MESSAGE, encoding, args.repeat)
+        print(f"{encoding}：{frame_size(frame)} 字节，编码 {seconds * 1e6:.2f}us/次")
+
+    result = asyncio.run(fanout(args.subscribers, args.binary_share, args.messages))
+    print(f"发布到 {args.subscribers} 个订阅者（二进制 {args.binary_share:.0%}）：{result['publish_us']:.0f}us/条，"
+          f"每个接收者 {result['publish_us'] / args.subscribers:.2f}us")
+    if not result["shared"]:
+        print("❌ 同一格式的接收者没有共享同一个帧")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""聊天广播压测：1000和10000个连接时broadcast的耗时和消息送达所有连接的延迟
+
+每个规模（--sizes）下连接对应数量的客户端，其中--slow-share比例的客户端每次发送要等--slow-delay秒（慢客户端），
+另有--broken个客户端发送时直接出错。每隔--interval秒broadcast一条消息，测量broadcast调用本身的耗时
+（只入队，不应随慢客户端变长）和每条消息送达全部正常客户端的延迟。
+正常客户端漏收消息、出错的连接没有被注销，或耗时p99超过上限时以非0状态退出。
+
+    python chat_fanout_bench.py
+    python chat_fanout_bench.py --policy evict --slow-share 0.05
+    python chat_fanout_bench.py --max-publish-p99-us 5000 --max-delivery-p99-ms 100
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import server
+from chat_churn_bench import FakeWebSocket
+from reminder_bench import tick_summary
+
+class TimedWebSocket(FakeWebSocket):
+    """记录每一帧送达的时间"""
+    def __init__(self, send_delay: float = 0.0):
+        super().__init__(send_delay)
+        self.arrivals = []
+
+    async def send_text(self, message: str):
+        await super().send_text(message)
+        self.arrivals.append(time.perf_counter())
+
+class BrokenWebSocket(FakeWebSocket):
+    """发送时出错的客户端"""
+    async def send_text(self, message: str):
+        raise ConnectionResetError("客户端已断开")
+
+async def fanout(size: int, args) -> dict:
+    manager = server.ConnectionManager(queue_size=args.queue_size, policy=args.policy)
+    slow_count = int(size * args.slow_share)
+    fast = [TimedWebSocket() for _ in range(size - slow_count - args.broken)]
+    slow = [TimedWebSocket(args.slow_delay) for _ in range(slow_count)]
+    broken = [BrokenWebSocket() for _ in range(args.broken)]
+    for number, websocket in enumerate(fast + slow + broken):
+        await manager.connect(websocket, f"student{number}@bench.test")
+
+    loop = asyncio.get_running_loop()
+    published = []
+    publish_seconds = []
+    scheduled = loop.time()
+    for seq in range(args.messages):
+        message = json.dumps(server.chat_payload(seq, server.DEFAULT_ROOM, "张三", "明天的高数作业是第三章习题吗？", "14:30"))
+        began = time.perf_counter()
+        manager.broadcast(message)
+        publish_seconds.append(time.perf_counter() - began)
+        published.append(began)
+        scheduled += args.interval
+        await asyncio.sleep(max(0.0, scheduled - loop.time()))
+
+    # 等正常客户端收完，超时视为漏收
+    deadline = loop.time() + args.timeout
+    while any(len(websocket.arrivals) < args.messages for websocket in fast) and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    complete = all(len(websocket.arrivals) == args.messages for websocket in fast)
+    # 每条消息的延迟：从broadcast到最后一个正常客户端收到
+    delivery = [max(websocket.arrivals[seq] for websocket in fast) - published[seq]
+                for seq in range(args.messages)] if complete and fast else []
+    leftover_broken = sum(websocket in manager.active_connections for websocket in broken)
+    stats = dict(manager.stats)
+    for websocket in list(manager.active_connections):
+        manager.disconnect(websocket)
+    await asyncio.sleep(0)
+    return {
+        "publish": tick_summary(publish_seconds),
+        "delivery": tick_summary(delivery),
+        "complete": complete,
+        "slow": slow_count,
+        "slow_received": sum(len(websocket.frames) for websocket in slow),
+        "leftover_broken": leftover_broken,
+        "stats": stats,
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="聊天广播压测（慢客户端和出错客户端隔离）")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="连接数")
+    parser.add_argument("--messages", type=int, default=300, help="每个规模broadcast的消息数（超过发送队列上限时慢客户端才会被丢弃消息或断开）")
+    parser.add_argument("--interval", type=float, default=0.01, help="两次broadcast之间的秒数")
+    parser.add_argument("--slow-share", type=float, default=0.01, help="慢客户端的比例")
+    parser.add_argument("--slow-delay", type=float, default=0.5, help="慢客户端每次发送的秒数")
+    parser.add_argument("--broken", type=int, default=10, help="发送时出错的客户端数")
+    parser.add_argument("--queue-size", type=int, default=server.CHAT_SEND_QUEUE_SIZE, help="每个连接的发送队列上限")
+    parser.add_argument("--policy", choices=["drop", "evict"], default=server.CHAT_SLOW_CONSUMER_POLICY,
+                        help="发送队列已满时的策略")
+    parser.add_argument("--timeout", type=float, default=30, help="等待正常客户端收完消息的秒数")
+    parser.add_argument("--max-publish-p99-us", type=float, default=None, help="broadcast耗时p99的上限（微秒），超过时返回1")
+    parser.add_argument("--max-delivery-p99-ms", type=float, default=None, help="送达延迟p99的上限（毫秒），超过时返回1")
+    args = parser.parse_args()
+
+    failures = []
+    for size in args.sizes:
+        result = asyncio.run(fanout(size, args))
+        publish, delivery, stats = result["publish"], result["delivery"], result["stats"]
+        print(f"连接 {size}（慢客户端 {result['slow']}，出错 {args.broken}，策略 {args.policy}）：")
+        print(f"  broadcast耗时 p50 {publish['p50_ms'] * 1000:.0f}us  p99 {publish['p99_ms'] * 1000:.0f}us  "
+              f"max {publish['max_ms'] * 1000:.0f}us，每个连接 {publish['p50_ms'] * 1000 / size:.2f}us")
+        print(f"  送达全部正常客户端 p50 {delivery['p50_ms']:.2f}ms  p99 {delivery['p99_ms']:.2f}ms  "
+              f"max {delivery['max_ms']:.2f}ms")
+        print(f"  慢客户端收到 {result['slow_received']} 条，丢弃 {stats['dropped']} 条，断开 {stats['evicted']} 个，"
+              f"发送出错 {stats['send_errors']} 个")
+        if not result["complete"]:
+            failures.append(f"{size} 个连接时有正常客户端在 {args.timeout}s 内没有收完消息")
+        if result["leftover_broken"]:
+            failures.append(f"{size} 个连接时 {result['leftover_broken']} 个出错的连接没有注销")
+        if args.max_publish_p99_us is not None and publish["p99_ms"] * 1000 > args.max_publish_p99_us:
+            failures.append(f"{size} 个连接时broadcast耗时p99 {publish['p99_ms'] * 1000:.0f}us 超过上限 {args.max_publish_p99_us}us")
+        if args.max_delivery_p99_ms is not None and delivery["p99_ms"] > args.max_delivery_p99_ms:
+            failures.append(f"{size} 个连接时送达延迟p99 {delivery['p99_ms']:.2f}ms 超过上限 {args.max_delivery_p99_ms}ms")
+    for failure in failures:
+        print(f"❌ {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
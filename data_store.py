@@ -1,73 +1,569 @@
-from typing import Dict, List, Optional
-from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+from datetime import datetime, timedelta
 from dataclasses import dataclass,field
+import bisect
+import contextlib
+import functools
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+
+from pytz import timezone
+
+from passwords import check_password
+
+# 星期的中文写法，课程记录中保存为下标0-6（周一为0，与datetime.weekday()一致）
+WEEKDAY_NAMES = ("周一", "周二", "周三", "周四", "周五", "周六", "周日")
+WEEKDAY_INDEX = {name: index for index, name in enumerate(WEEKDAY_NAMES)}
+
+COURSE_FIELDS = ("course_name", "day_of_week", "start_time", "end_time", "location")
+TASK_FIELDS = ("title", "description", "due_date")
+
+def iso_date(value: str) -> str:
+    """校验YYYY-MM-DD日期并统一为补零的写法（strptime也接受2026-1-5），保证按字符串排序即按日期排序"""
+    return datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+
+def normalize_date(value: str) -> str:
+    """同iso_date，无法识别的写法（旧数据）原样返回"""
+    try:
+        return iso_date(value)
+    except (TypeError, ValueError):
+        return value
+
+class Course:
+    """课表中的一门课程
+
+    使用__slots__避免每条记录一个字典；星期保存为小整数，课程名、时间和地点在很多课程之间
+    重复，保存前做字符串驻留，相同的值只占一份内存。对外仍通过to_dict()输出原来的字典格式。
+    """
+    __slots__ = ("course_name", "day", "start_time", "end_time", "location", "last_reminder")
+
+    def __init__(self, course_name: str, day_of_week: str, start_time: str, end_time: str,
+                 location: str, last_reminder: Optional[str] = None):
+        self.course_name = sys.intern(course_name)
+        self.day_of_week = day_of_week
+        self.start_time = sys.intern(start_time)
+        self.end_time = sys.intern(end_time)
+        self.location = sys.intern(location)
+        self.last_reminder = last_reminder
+
+    @property
+    def day_of_week(self) -> str:
+        return WEEKDAY_NAMES[self.day] if isinstance(self.day, int) else self.day
+
+    @day_of_week.setter
+    def day_of_week(self, value: str):
+        # 无法识别的写法（如CSV中的其他格式）原样保存
+        self.day = WEEKDAY_INDEX.get(value, value)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Course":
+        return cls(*(data[key] for key in COURSE_FIELDS), data.get("last_reminder"))
+
+    def update(self, data: dict):
+        for key in COURSE_FIELDS + ("last_reminder",):
+            if key in data:
+                value = data[key]
+                setattr(self, key, sys.intern(value) if key in ("course_name", "start_time", "end_time", "location") else value)
+
+    def to_dict(self) -> dict:
+        return {
+            "course_name": self.course_name,
+            "day_of_week": self.day_of_week,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "location": self.location,
+            "last_reminder": self.last_reminder,
+        }
+
+class Task:
+    """一条学习任务，截止日期统一为补零的YYYY-MM-DD并做字符串驻留"""
+    __slots__ = TASK_FIELDS
+
+    def __init__(self, title: str, description: str, due_date: str):
+        self.title = title
+        self.description = description
+        self.due_date = sys.intern(normalize_date(due_date))
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Task":
+        return cls(*(data[key] for key in TASK_FIELDS))
+
+    def to_dict(self) -> dict:
+        return {"title": self.title, "description": self.description, "due_date": self.due_date}
 
 @dataclass
 class User:
     email: str
     username: str
     password: str
-    timetable: List[dict] =  field(default_factory=list) 
-    tasks: List[dict] = field(default_factory=list) 
-@dataclass
+    # 课程和任务按ID保存在保持插入顺序的字典中: id -> 记录
+    timetable: Dict[int, Course] = field(default_factory=dict)
+    tasks: Dict[int, Task] = field(default_factory=dict)
+    next_id: int = 1  # 下一个可分配的课程/任务ID
+    # 课表/任务的版本号，每次修改后更新；快照是按当前版本生成的只读结果，修改时作废
+    timetable_version: int = 0
+    tasks_version: int = 0
+    timetable_snapshot: Optional[Tuple[dict, ...]] = field(default=None, repr=False, compare=False)
+    tasks_snapshot: Optional[Tuple[dict, ...]] = field(default=None, repr=False, compare=False)
+    # 按截止日期排序的任务索引: [(due_date, 任务ID)]，日期统一为补零的YYYY-MM-DD（见Task），按字符串排序即按日期排序
+    due_index: List[Tuple[str, int]] = field(default_factory=list, repr=False, compare=False)
+
 class ChatMessage:
-    username: str
-    content: str
-    timestamp: datetime
+    """一条聊天消息；时间保存为时间戳浮点数，读取timestamp时才转换为datetime"""
+    __slots__ = ("username", "content", "created", "seq")
+
+    def __init__(self, username: str, content: str, timestamp: Optional[datetime] = None, seq: int = 0):
+        self.username = sys.intern(username)
+        self.content = content
+        self.created = time.time() if timestamp is None else timestamp.timestamp()
+        self.seq = seq
+
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(self.created)
+
+    def __repr__(self):
+        return f"ChatMessage(username={self.username!r}, content={self.content!r}, timestamp={self.timestamp!r}, seq={self.seq})"
 
 @dataclass
 class VideoUser:
     username: str
     peer_id: str
+    expires_at: float = 0.0  # 租约到期时间（time.monotonic）
+
+# 每个聊天室最多保留的聊天记录条数
+CHAT_HISTORY_CAPACITY = 1000
+DEFAULT_ROOM = "lobby"
+
+class ChatHistory:
+    """定长环形缓冲区保存聊天记录，每条消息带递增序号，超出容量时覆盖最旧的消息"""
+    def __init__(self, capacity: int = CHAT_HISTORY_CAPACITY):
+        if capacity <= 0:
+            raise ValueError("容量必须大于0")
+        self.capacity = capacity
+        self._buffer: List[Optional[ChatMessage]] = [None] * capacity
+        self._next_seq = 1
+
+    @property
+    def first_seq(self) -> int:
+        """仍在缓冲区中的最旧消息序号"""
+        return max(1, self._next_seq - self.capacity)
+
+    @property
+    def last_seq(self) -> int:
+        return self._next_seq - 1
+
+    def __len__(self) -> int:
+        return self._next_seq - self.first_seq
+
+    def append(self, username: str, content: str, timestamp: Optional[datetime] = None) -> ChatMessage:
+        message = ChatMessage(
+            username=username,
+            content=content,
+            timestamp=timestamp,
+            seq=self._next_seq
+        )
+        self._buffer[message.seq % self.capacity] = message
+        self._next_seq += 1
+        return message
+
+    def restore(self, messages: List[ChatMessage], next_seq: int):
+        """从快照恢复缓冲区内容"""
+        self._buffer = [None] * self.capacity
+        for message in messages[-self.capacity:]:
+            self._buffer[message.seq % self.capacity] = message
+        self._next_seq = next_seq
+
+    def page(self, before: Optional[int] = None, limit: int = 50) -> List[ChatMessage]:
+        """返回序号小于before的最近limit条消息（按序号升序），只访问这一页的元素"""
+        end = self._next_seq if before is None else max(self.first_seq, min(before, self._next_seq))
+        start = max(self.first_seq, end - max(limit, 0))
+        return [self._buffer[seq % self.capacity] for seq in range(start, end)]
+
+# 视频用户租约时长（秒），客户端需要在到期前通过心跳续约
+VIDEO_LEASE_TTL = 30
+
+class VideoLeaseRegistry:
+    """视频用户租约表：注册或心跳时续约，到期未续约的用户通过最小堆按到期时间弹出，无需全表扫描"""
+    def __init__(self, ttl: float = VIDEO_LEASE_TTL, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.users: Dict[str, VideoUser] = {}
+        self._heap: List[Tuple[float, str]] = []  # (到期时间, 用户名)，续约后旧条目在弹出时忽略
+
+    def register(self, username: str, peer_id: str) -> bool:
+        """注册或续约，返回在线列表是否发生变化（新用户或peer_id改变）"""
+        expires_at = self.clock() + self.ttl
+        current = self.users.get(username)
+        changed = current is None or current.peer_id != peer_id
+        if changed:
+            self.users[username] = VideoUser(username=username, peer_id=peer_id, expires_at=expires_at)
+        else:
+            current.expires_at = expires_at
+        heapq.heappush(self._heap, (expires_at, username))
+        if len(self._heap) > 4 * len(self.users) + 64:
+            # 频繁续约留下的旧条目过多时重建堆
+            self._heap = [(user.expires_at, name) for name, user in self.users.items()]
+            heapq.heapify(self._heap)
+        return changed
+
+    def remove(self, username: str) -> bool:
+        return self.users.pop(username, None) is not None
+
+    def expire(self, now: Optional[float] = None) -> List[str]:
+        """移除所有已到期的租约，返回被移除的用户名"""
+        now = self.clock() if now is None else now
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, username = heapq.heappop(self._heap)
+            user = self.users.get(username)
+            if user is not None and user.expires_at <= now:
+                del self.users[username]
+                expired.append(username)
+        return expired
+
+    def values(self) -> List[VideoUser]:
+        return list(self.users.values())
+
+# 预置的测试账号 (邮箱, 用户名, 密码)
+TEST_USERS = [
+    ("test1@example.com", "张三", "123456"),
+    ("test2@example.com", "李四", "123456"),
+    ("test3@example.com", "王五", "123456"),
+]
+
+# 用户锁的分段数：按邮箱哈希选择分段，不同用户的操作基本不会互相等待
+LOCK_STRIPES = 64
+
+# 批量任务操作: {"op": "add", "task": {...}} / {"op": "edit", "id": 1, "task": {...}} / {"op": "delete", "id": 1}
+TASK_BATCH_OPS = ("add", "edit", "delete")
+
+def check_task_batch(operations: List[dict], task_ids: Iterable[int]):
+    """按顺序模拟一遍批量操作，有任何一个操作无效就抛出异常（ValueError格式错误 / IndexError任务不存在）"""
+    present = set(task_ids)
+    for number, operation in enumerate(operations, 1):
+        op = operation.get("op")
+        if op not in TASK_BATCH_OPS:
+            raise ValueError(f"第{number}个操作: 未知的操作类型 {op}")
+        if op in ("add", "edit") and any(not str(operation.get("task", {}).get(key) or "").strip() for key in TASK_FIELDS):
+            raise ValueError(f"第{number}个操作: 任务信息不完整")
+        if op in ("edit", "delete"):
+            if operation.get("id") not in present:
+                raise IndexError(f"第{number}个操作: 任务不存在")
+            if op == "delete":
+                present.discard(operation["id"])
+
+# 二级索引中对课程的引用: (邮箱, 课程ID)
+CourseRef = Tuple[str, int]
+
+# 判断两条课程记录是否是同一门课时比较的字段
+COURSE_IDENTITY_FIELDS = ("course_name", "day_of_week", "start_time")
+
+# 课程提醒：上课前多少秒发送，时间按北京时间计算
+REMINDER_LEAD = 600
+REMINDER_TIMEZONE = timezone("Asia/Shanghai")
+
+@functools.lru_cache(maxsize=1024)
+def _parse_start_time(start_time: str) -> Optional[Tuple[int, int]]:
+    try:
+        parsed = datetime.strptime(start_time, "%H:%M")
+    except (TypeError, ValueError):
+        return None
+    return parsed.hour, parsed.minute
+
+@functools.lru_cache(maxsize=4096)
+def _local_timestamp(date, hour: int, minute: int) -> float:
+    # 必须用localize，直接replace(tzinfo=...)会得到pytz的地方平时(+08:06)
+    return REMINDER_TIMEZONE.localize(datetime(date.year, date.month, date.day, hour, minute)).timestamp()
+
+# 最近一次换算的本地日期 (当天0点时间戳, 次日0点时间戳, 日期)，同一天内的时间戳不必再做时区换算
+_local_day = (0.0, 0.0, None)
+
+def _local_date(timestamp: float):
+    global _local_day
+    day_start, day_end, date = _local_day
+    if not day_start <= timestamp < day_end:
+        date = datetime.fromtimestamp(timestamp, REMINDER_TIMEZONE).date()
+        _local_day = (_local_timestamp(date, 0, 0), _local_timestamp(date + timedelta(days=1), 0, 0), date)
+    return date
+
+def next_course_start(day: Union[int, str], start_time: str, after: float) -> Optional[float]:
+    """返回每周day（0为周一）start_time（HH:MM）上课、晚于after的下一次上课时间戳，无法解析时返回None"""
+    parsed = _parse_start_time(start_time) if isinstance(day, int) else None
+    if parsed is None:
+        return None
+    today = _local_date(after)
+    date = today + timedelta(days=(day - today.weekday()) % 7)
+    start = _local_timestamp(date, *parsed)
+    if start <= after:
+        start = _local_timestamp(date + timedelta(days=7), *parsed)
+    return start
+
+class ReminderSchedule:
+    """课程提醒时间表：每门课按下一次提醒时间（上课前lead秒）放入最小堆，每次只弹出已到时间的课程
+
+    课程修改或删除后，堆中的旧条目不立即删除，弹出时与entries对比后忽略。
+    只保存提醒时间，星期和上课时间在安排下一次提醒时通过lookup从课程本身读取。
+    """
+    def __init__(self, lookup: Callable[[CourseRef], Optional[Course]], lead: float = REMINDER_LEAD,
+                 clock: Callable[[], float] = time.time):
+        self.lookup = lookup
+        self.lead = lead
+        self.clock = clock
+        self.entries: Dict[CourseRef, float] = {}  # 课程 -> 提醒时间
+        self._heap: List[Tuple[float, CourseRef]] = []  # (提醒时间, 课程)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def schedule(self, ref: CourseRef, day: Union[int, str], start_time: str, after: Optional[float] = None):
+        """按晚于after（默认当前时间）的下一次上课安排提醒；上课时间无法解析的课程不安排"""
+        after = self.clock() if after is None else after
+        start = next_course_start(day, start_time, after)
+        if start is None:
+            self.entries.pop(ref, None)
+            return
+        fire = start - self.lead
+        self.entries[ref] = fire
+        heapq.heappush(self._heap, (fire, ref))
+        if len(self._heap) > 2 * len(self.entries) + 1024:
+            # 频繁修改留下的旧条目过多时重建堆
+            self._heap = [(fire, ref) for ref, fire in self.entries.items()]
+            heapq.heapify(self._heap)
+
+    def unschedule(self, ref: CourseRef):
+        self.entries.pop(ref, None)
+
+    def clear(self):
+        self.entries = {}
+        self._heap = []
+
+    def pop_due(self, now: Optional[float] = None) -> List[Tuple[CourseRef, float]]:
+        """弹出提醒时间已到的课程，返回 [(课程, 上课时间戳)]，并把这些课程安排到下一周
+
+        长时间没有检查时，已经开始上课的课程不再返回。
+        """
+        now = self.clock() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire, ref = heapq.heappop(self._heap)
+            if self.entries.get(ref) != fire:
+                continue
+            course = self.lookup(ref)
+            if course is None:
+                self.entries.pop(ref, None)
+                continue
+            start = fire + self.lead
+            if start > now:
+                due.append((ref, start))
+            self.schedule(ref, course.day, course.start_time, after=max(start, now))
+        return due
+
+def mutation(method):
+    """修改某个用户数据的方法（第一个参数为邮箱）持有该用户所在分段的锁，保证快照和日志的一致性"""
+    @functools.wraps(method)
+    def wrapper(self, email, *args, **kwargs):
+        with self._stripe(email):
+            return method(self, email, *args, **kwargs)
+    return wrapper
 
 class DataStore:
-    def __init__(self):
+    """内存数据存储（每个进程一份）
+
+    可以挂接一个追加日志（journal.Journal），每次修改都会写入一条紧凑记录，
+    配合定期快照在重启后恢复数据，见 journal.open_journaled_store。
+
+    请求处理和提醒定时任务线程会并发访问，每个用户（以及每个聊天室）的数据由
+    所在分段的锁保护；读取方法返回副本，调用方拿到的数据不会被其他线程改动。
+    """
+    # 数据是否在多个worker进程之间共享
+    shared = False
+
+    def __init__(self, chat_history_capacity: int = CHAT_HISTORY_CAPACITY, clock: Callable[[], float] = time.time):
+        self._stripes = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        # 全局递增的版本号来源，不同用户的版本号也不会重复（用户换邮箱后缓存不会串）
+        self._versions = itertools.count(1)
+        self.journal = None  # 追加日志，None表示不持久化
+        self.compactor = None  # 定期写快照的后台线程
         # 用户数据: email -> User
         self.users: Dict[str, User] = {
-            "test1@example.com": User(email="test1@example.com", username="张三", password="123456"),
-            "test2@example.com": User(email="test2@example.com", username="李四", password="123456"),
-            "test3@example.com": User(email="test3@example.com", username="王五", password="123456")
+            email: User(email=email, username=username, password=password)
+            for email, username, password in TEST_USERS
         }
+        # 二级索引，由修改方法增量维护；值用dict当作保持插入顺序的集合
+        self._index_lock = threading.Lock()  # 索引被不同用户共享，单独加锁（只在持有用户分段锁之后获取）
+        self._username_index: Dict[str, Dict[str, None]] = {}           # 用户名 -> 邮箱
+        self._weekday_index: Dict[Union[int, str], Dict[CourseRef, None]] = {}  # 星期(0-6) -> 课程
+        self._location_index: Dict[str, Dict[CourseRef, None]] = {}     # 地点 -> 课程
+        self.reminders = ReminderSchedule(self._lookup_course, clock=clock)  # 课程 -> 下一次提醒时间
+        self._rebuild_indexes()
         
-        # 聊天消息列表
-        self.chat_messages: List[ChatMessage] = [
-            ChatMessage(username="张三", content="大家好！", timestamp=datetime.now()),
-            ChatMessage(username="李四", content="你好啊！", timestamp=datetime.now()),
-            ChatMessage(username="王五", content="今天天气真不错", timestamp=datetime.now())
-        ]
+        # 聊天记录（每个聊天室一个有界缓冲区）: room -> ChatHistory
+        self.chat_history_capacity = chat_history_capacity
+        self.chat_rooms: Dict[str, ChatHistory] = {}
+        self.add_message("张三", "大家好！")
+        self.add_message("李四", "你好啊！")
+        self.add_message("王五", "今天天气真不错")
         
-        # 视频会议用户: username -> VideoUser
-        self.video_users: Dict[str, VideoUser] = {
-            "张三": VideoUser(username="张三", peer_id="模拟数据"),
-            "李四": VideoUser(username="李四", peer_id="模拟数据")
-        }
+        # 视频会议用户租约: username -> VideoUser
+        self.video_users = VideoLeaseRegistry()
+        self.video_users.register("张三", "模拟数据")
+        self.video_users.register("李四", "模拟数据")
+
+    def _stripe(self, key: str) -> threading.RLock:
+        """返回保护某个用户（或聊天室）的锁"""
+        return self._stripes[hash(key) % LOCK_STRIPES]
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """按固定顺序获取全部分段锁，用于导出或替换整个数据集"""
+        with contextlib.ExitStack() as stack:
+            for lock in self._stripes:
+                stack.enter_context(lock)
+            yield
+
+    # ====== 二级索引 ======
+
+    @staticmethod
+    def _index_add(index: dict, key, value):
+        index.setdefault(key, {})[value] = None
+
+    @staticmethod
+    def _index_remove(index: dict, key, value):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(value, None)
+            if not bucket:
+                del index[key]
+
+    def _index_courses(self, email: str, courses: Iterable[Tuple[int, Course]]):
+        with self._index_lock:
+            now = self.reminders.clock()
+            for course_id, course in courses:
+                # 各索引和提醒时间表共用同一个引用元组
+                ref = (email, course_id)
+                self._index_add(self._weekday_index, course.day, ref)
+                self._index_add(self._location_index, course.location, ref)
+                self.reminders.schedule(ref, course.day, course.start_time, now)
+
+    def _lookup_course(self, ref: CourseRef) -> Optional[Course]:
+        # 课程修改时先从提醒时间表中移除再改字段，时间表中存在的课程读到的总是一致的星期和上课时间
+        user = self.users.get(ref[0])
+        return user.timetable.get(ref[1]) if user is not None else None
+
+    def _unindex_courses(self, email: str, courses: Iterable[Tuple[int, Course]]):
+        with self._index_lock:
+            for course_id, course in courses:
+                ref = (email, course_id)
+                self._index_remove(self._weekday_index, course.day, ref)
+                self._index_remove(self._location_index, course.location, ref)
+                self.reminders.unschedule(ref)
+
+    def _rebuild_indexes(self):
+        with self._index_lock:
+            self._username_index = {}
+            self._weekday_index = {}
+            self._location_index = {}
+            self.reminders.clear()
+        for email, user in self.users.items():
+            with self._index_lock:
+                self._index_add(self._username_index, user.username, email)
+            self._index_courses(email, user.timetable.items())
+
+    def find_emails_by_username(self, username: str) -> List[str]:
+        """按用户名查找邮箱（用户名不唯一，可能有多个）"""
+        with self._index_lock:
+            return list(self._username_index.get(username, ()))
+
+    def _resolve_courses(self, refs: List[CourseRef]) -> List[dict]:
+        """把课程引用转换为带email、username和id的课程字典，期间被删除的课程跳过"""
+        courses = []
+        for email, course_id in refs:
+            with self._stripe(email):
+                user = self.users.get(email)
+                course = user.timetable.get(course_id) if user is not None else None
+                if course is not None:
+                    courses.append(dict(course.to_dict(), id=course_id, email=email, username=user.username))
+        return courses
+
+    def _page_courses(self, index: dict, key, limit: int, cursor: Optional[int]) -> Tuple[List[dict], Optional[int]]:
+        """按课程加入索引的先后顺序分页，cursor为之前各页已经返回的条数，返回 (课程列表, 下一页游标或None)"""
+        offset = cursor or 0
+        limit = max(limit, 0)
+        with self._index_lock:
+            refs = list(itertools.islice(index.get(key, ()), offset, offset + limit + 1))
+        next_cursor = offset + limit if len(refs) > limit else None
+        return self._resolve_courses(refs[:limit]), next_cursor
+
+    def get_courses_on_weekday(self, weekday: int, limit: int = 50,
+                               cursor: Optional[int] = None) -> Tuple[List[dict], Optional[int]]:
+        """分页返回所有用户在某个星期几（0为周一）的课程"""
+        return self._page_courses(self._weekday_index, weekday, limit, cursor)
+
+    def get_courses_at_location(self, location: str, limit: int = 50,
+                                cursor: Optional[int] = None) -> Tuple[List[dict], Optional[int]]:
+        """分页返回所有用户在某个地点的课程"""
+        return self._page_courses(self._location_index, location, limit, cursor)
+
+    def _log(self, op: str, *args):
+        """把一次修改追加到日志"""
+        if self.journal is not None:
+            self.journal.append([op, *args])
 
     # 用户相关方法
+    @mutation
     def add_user(self, email: str, username: str, password: str) -> bool:
         if email in self.users:
             return False
         self.users[email] = User(email=email, username=username, password=password)
+        with self._index_lock:
+            self._index_add(self._username_index, username, email)
+        self._log("add_user", email, username, password)
         return True
 
     def get_user(self, email: str) -> Optional[User]:
         return self.users.get(email)
 
     def verify_user(self, email: str, password: str) -> Optional[User]:
+        """同步校验密码（会阻塞调用线程），异步接口应使用passwords.check_password_async"""
         user = self.get_user(email)
-        if user and user.password == password:
+        if user and check_password(password, user.password)[0]:
             return user
         return None
+
+    @mutation
+    def rehash_password(self, email: str, old: str, new: str) -> bool:
+        """密码仍为old时替换为新的哈希new，避免覆盖期间被修改的密码"""
+        user = self.users.get(email)
+        if user is None or user.password != old:
+            return False
+        user.password = new
+        self._log("rehash_password", email, old, new)
+        return True
+
+    # 与上面的get_user重复（原有代码），后定义的这个生效，两者行为相同
     def get_user(self, email: str):
         """根据邮箱获取用户信息"""
         return self.users.get(email)
     
+    @mutation
     def update_user(self, email: str, **kwargs):
         """更新用户信息"""
         user = self.users.get(email)
         if user:
+            old_username = user.username
             for key, value in kwargs.items():
                 if hasattr(user, key) and value is not None:
                     setattr(user, key, value)
+            if user.username != old_username:
+                with self._index_lock:
+                    self._index_remove(self._username_index, old_username, email)
+                    self._index_add(self._username_index, user.username, email)
+            self._log("update_user", email, kwargs)
             return True
         return False
     
@@ -77,89 +573,233 @@ class DataStore:
     
     def change_user_email(self, old_email: str, new_email: str):
         """更改用户邮箱（更新字典键）"""
-        if old_email in self.users and new_email not in self.users:
-            user = self.users.pop(old_email)
-            user.email = new_email
-            self.users[new_email] = user
-            return True
-        return False
+        # 同时持有新旧邮箱的分段锁，按分段顺序获取避免死锁
+        indexes = sorted({hash(old_email) % LOCK_STRIPES, hash(new_email) % LOCK_STRIPES})
+        with contextlib.ExitStack() as stack:
+            for index in indexes:
+                stack.enter_context(self._stripes[index])
+            if old_email in self.users and new_email not in self.users:
+                user = self.users.pop(old_email)
+                user.email = new_email
+                self.users[new_email] = user
+                # 索引中的引用包含邮箱，需要改写该用户的所有条目
+                self._unindex_courses(old_email, user.timetable.items())
+                self._index_courses(new_email, user.timetable.items())
+                with self._index_lock:
+                    self._index_remove(self._username_index, user.username, old_email)
+                    self._index_add(self._username_index, user.username, new_email)
+                self._log("change_user_email", old_email, new_email)
+                return True
+            return False
     # 聊天消息相关方法
-    def add_message(self, username: str, content: str):
-        message = ChatMessage(
-            username=username,
-            content=content,
-            timestamp=datetime.now()
-        )
-        self.chat_messages.append(message)
+    def add_message(self, username: str, content: str, room: str = DEFAULT_ROOM,
+                    timestamp: Optional[datetime] = None) -> ChatMessage:
+        with self._stripe(room):
+            history = self.chat_rooms.get(room)
+            if history is None:
+                history = self.chat_rooms[room] = ChatHistory(self.chat_history_capacity)
+            message = history.append(username, content, timestamp)
+            self._log("add_message", username, content, room, message.timestamp.isoformat())
+            return message
+
+    def get_messages(self, room: str = DEFAULT_ROOM) -> List[ChatMessage]:
+        """返回聊天室缓冲区中的全部消息（分页请使用get_history）"""
+        with self._stripe(room):
+            history = self.chat_rooms.get(room)
+            if history is None:
+                return []
+            return history.page(limit=len(history))
 
-    def get_messages(self) -> List[ChatMessage]:
-        return self.chat_messages
+    def get_history(self, before: Optional[int] = None, limit: int = 50, room: str = DEFAULT_ROOM):
+        """分页获取聊天记录，返回(消息列表, 下一页的before游标或None)"""
+        with self._stripe(room):
+            history = self.chat_rooms.get(room)
+            if history is None:
+                return [], None
+            messages = history.page(before, limit)
+        next_before = None
+        if messages and messages[0].seq > history.first_seq:
+            next_before = messages[0].seq
+        return messages, next_before
 
     # 视频会议相关方法
-    def add_video_user(self, username: str, peer_id: str):
-        print(f"[Debug] 添加视频用户: username={username}, peer_id={peer_id}")
-        self.video_users[username] = VideoUser(username=username, peer_id=peer_id)
-        print(f"[Debug] 当前在线视频用户: {list(self.video_users.keys())}")
-
-    def remove_video_user(self, username: str):
-        print(f"[Debug] 尝试移除视频用户: username={username}")
-        if username in self.video_users:
-            del self.video_users[username]
-            print(f"[Debug] 成功移除用户 {username}")
-        else:
-            print(f"[Debug] 用户 {username} 不在视频用户列表中")
-        print(f"[Debug] 当前在线视频用户: {list(self.video_users.keys())}")
+    def add_video_user(self, username: str, peer_id: str) -> bool:
+        """添加视频用户或为其续约，返回在线列表是否发生变化"""
+        return self.video_users.register(username, peer_id)
+
+    def remove_video_user(self, username: str) -> bool:
+        """移除视频用户，返回是否确实移除了"""
+        return self.video_users.remove(username)
 
     def get_video_users(self) -> List[VideoUser]:
-        users = list(self.video_users.values())
-        print(f"[Debug] 获取视频用户列表: {[user.username for user in users]}")
-        return users
+        return self.video_users.values()
+
+    def expire_video_users(self, now: Optional[float] = None) -> List[str]:
+        """清理租约到期的视频用户，返回被清理的用户名"""
+        return self.video_users.expire(now)
+
+    def _timetable_changed(self, user: User):
+        user.timetable_version = next(self._versions)
+        user.timetable_snapshot = None
+
+    def _tasks_changed(self, user: User):
+        user.tasks_version = next(self._versions)
+        user.tasks_snapshot = None
+
+    def get_timetable_snapshot(self, email: str) -> Tuple[int, Tuple[dict, ...]]:
+        """返回 (版本号, 课表快照)；同一版本多次读取返回同一个元组，调用方不能修改其中的字典"""
+        with self._stripe(email):
+            user = self.users.get(email)
+            if user is None:
+                raise KeyError("用户不存在")
+            if user.timetable_snapshot is None:
+                user.timetable_snapshot = tuple(
+                    dict(course.to_dict(), id=course_id) for course_id, course in user.timetable.items()
+                )
+            return user.timetable_version, user.timetable_snapshot
+
+    def get_tasks_snapshot(self, email: str) -> Tuple[int, Tuple[dict, ...]]:
+        """返回 (版本号, 任务快照)，规则同get_timetable_snapshot"""
+        with self._stripe(email):
+            user = self.users.get(email)
+            if user is None:
+                raise KeyError("用户不存在")
+            if user.tasks_snapshot is None:
+                user.tasks_snapshot = tuple(
+                    dict(task.to_dict(), id=task_id) for task_id, task in user.tasks.items()
+                )
+            return user.tasks_version, user.tasks_snapshot
+
+    @staticmethod
+    def _put_task(user: User, task_id: int, task: dict):
+        """添加或替换任务，同时维护截止日期索引"""
+        old = user.tasks.get(task_id)
+        new = user.tasks[task_id] = Task.from_dict(task)
+        if old is not None:
+            if old.due_date == new.due_date:
+                return
+            del user.due_index[bisect.bisect_left(user.due_index, (old.due_date, task_id))]
+        bisect.insort(user.due_index, (new.due_date, task_id))
+
+    @staticmethod
+    def _drop_task(user: User, task_id: int) -> bool:
+        task = user.tasks.pop(task_id, None)
+        if task is None:
+            return False
+        del user.due_index[bisect.bisect_left(user.due_index, (task.due_date, task_id))]
+        return True
+
+    def query_tasks(self, email: str, start: Optional[str] = None, end: Optional[str] = None,
+                    limit: int = 50, cursor: Optional[Tuple[str, int]] = None) -> Tuple[List[dict], Optional[Tuple[str, int]]]:
+        """按截止日期升序查询 start <= due_date <= end 的任务（两端可省略）
+
+        cursor为上一页最后一个任务的 (due_date, id)，返回 (任务列表, 下一页游标或None)。
+        通过二分查找定位起点，只访问本页的任务。
+        """
+        with self._stripe(email):
+            user = self.users.get(email)
+            if user is None:
+                raise KeyError("用户不存在")
+            index = user.due_index
+            lo = bisect.bisect_left(index, (start, 0)) if start is not None else 0
+            if cursor is not None:
+                lo = max(lo, bisect.bisect_right(index, cursor))
+            hi = bisect.bisect_right(index, (end, float("inf"))) if end is not None else len(index)
+            page = index[lo:min(hi, lo + max(limit, 0))]
+            tasks = [dict(user.tasks[task_id].to_dict(), id=task_id) for _, task_id in page]
+            next_cursor = page[-1] if page and lo + len(page) < hi else None
+            return tasks, next_cursor
 
+    def _next_id(self, user: "User") -> int:
+        """分配用户下一个课程/任务ID，ID只增不减，删除后也不会复用"""
+        item_id = user.next_id
+        user.next_id += 1
+        return item_id
+
+    @mutation
     def add_timetable(self, email: str, entries: List[dict]):
         if email not in self.users:
             raise KeyError("用户不存在")
-        # 清空旧课表后添加新条目
-        self.users[email].timetable = [dict(entry) for entry in entries]
-        new_entries = []
-        for entry in entries:
-            new_entry = dict(entry)
-            new_entry['last_reminder'] = None  # 添加提醒标记字段
-            new_entries.append(new_entry)
-        self.users[email].timetable = new_entries
-        
-    def get_timetable(self, email: str) -> List[dict]:
-        user = self.users.get(email)
-        if not user:
-            raise KeyError("用户不存在")
-        return user.timetable.copy()  # 返回副本防止数据被意外修改
-    
+        user = self.users[email]
+        self._unindex_courses(email, user.timetable.items())
+        # 替换为新课表，提醒标记清空
+        user.timetable = {
+            self._next_id(user): Course(*(entry[key] for key in COURSE_FIELDS)) for entry in entries
+        }
+        self._index_courses(email, user.timetable.items())
+        self._timetable_changed(user)
+        self._log("add_timetable", email, entries)
     
     # ====== 任务管理方法 ======
 
-    def add_task(self, email: str, task: dict):
+    @mutation
+    def add_task(self, email: str, task: dict) -> int:
+        """添加任务，返回新任务的ID"""
         if email not in self.users:
             raise KeyError("用户不存在")
-        self.users[email].tasks.append(task)
+        user = self.users[email]
+        task_id = self._next_id(user)
+        self._put_task(user, task_id, task)
+        self._tasks_changed(user)
+        self._log("add_task", email, task)
+        return task_id
 
     def get_tasks(self, email: str) -> List[dict]:
+        """按添加顺序返回任务（副本），每个任务带id"""
+        return [dict(task) for task in self.get_tasks_snapshot(email)[1]]
+
+    @mutation
+    def delete_task(self, email: str, task_id: int):
         if email not in self.users:
             raise KeyError("用户不存在")
-        return self.users[email].tasks.copy()
+        user = self.users[email]
+        if not self._drop_task(user, task_id):
+            raise IndexError("任务不存在")
+        self._tasks_changed(user)
+        self._log("delete_task", email, task_id)
 
-    def delete_task(self, email: str, index: int):
+    @mutation
+    def edit_task(self, email: str, task_id: int, updated_task: dict):
         if email not in self.users:
             raise KeyError("用户不存在")
-        if 0 <= index < len(self.users[email].tasks):
-            del self.users[email].tasks[index]
+        user = self.users[email]
+        if task_id not in user.tasks:
+            raise IndexError("任务不存在")
+        self._put_task(user, task_id, updated_task)
+        self._tasks_changed(user)
+        self._log("edit_task", email, task_id, updated_task)
 
-    def edit_task(self, email: str, index: int, updated_task: dict):
+    @mutation
+    def apply_task_batch(self, email: str, operations: List[dict]) -> List[dict]:
+        """在一次加锁内执行一组任务操作：先全部校验，全部有效才执行，版本号只更新一次
+
+        返回每个操作的结果 {"op", "id"}，add的id为新分配的任务ID。
+        """
         if email not in self.users:
             raise KeyError("用户不存在")
-        if 0 <= index < len(self.users[email].tasks):
-            self.users[email].tasks[index] = updated_task
+        user = self.users[email]
+        check_task_batch(operations, user.tasks)
+        results = []
+        for operation in operations:
+            op = operation["op"]
+            if op == "add":
+                task_id = self._next_id(user)
+                self._put_task(user, task_id, operation["task"])
+            elif op == "edit":
+                task_id = operation["id"]
+                self._put_task(user, task_id, operation["task"])
+            else:
+                task_id = operation["id"]
+                self._drop_task(user, task_id)
+            results.append({"op": op, "id": task_id})
+        if operations:
+            self._tasks_changed(user)
+            self._log("apply_task_batch", email, operations)
+        return results
 
     #课表相关方法
     
+    @mutation
     def update_course(self, email: str, course_id: int, updated_course: dict) -> bool:
         """更新指定用户的课程信息"""
         try:
@@ -167,13 +807,16 @@ class DataStore:
                 return False
                 
             user = self.users[email]
-            
-            # 检查课程ID是否有效
-            if course_id < 0 or course_id >= len(user.timetable):
+            course = user.timetable.get(course_id)
+            if course is None:
                 return False
                 
-            # 更新课程信息
-            user.timetable[course_id].update(updated_course)
+            # 更新课程信息，星期或地点变化时同步索引
+            self._unindex_courses(email, [(course_id, course)])
+            course.update(updated_course)
+            self._index_courses(email, [(course_id, course)])
+            self._timetable_changed(user)
+            self._log("update_course", email, course_id, updated_course)
             
             return True
             
@@ -181,20 +824,21 @@ class DataStore:
             print(f"更新课程失败: {str(e)}")
             return False
 
+    @mutation
     def delete_course(self, email: str, course_id: int) -> bool:
         """删除指定用户的课程"""
         try:
             if email not in self.users:
                 return False
                 
+            # 删除课程，其他课程的ID不受影响
             user = self.users[email]
-            
-            # 检查课程ID是否有效
-            if course_id < 0 or course_id >= len(user.timetable):
+            course = user.timetable.pop(course_id, None)
+            if course is None:
                 return False
-                
-            # 删除课程
-            del user.timetable[course_id]
+            self._unindex_courses(email, [(course_id, course)])
+            self._timetable_changed(user)
+            self._log("delete_course", email, course_id)
             
             return True
             
@@ -203,43 +847,135 @@ class DataStore:
             return False
 
     def get_course(self, email: str, course_id: int) -> dict:
-        """获取指定用户的单个课程信息"""
+        """获取指定用户的单个课程信息（副本）"""
         try:
-            if email not in self.users:
-                return None
-                
-            user = self.users[email]
-            
-            # 检查课程ID是否有效
-            if course_id < 0 or course_id >= len(user.timetable):
-                return None
-                
-            return user.timetable[course_id]
+            with self._stripe(email):
+                if email not in self.users:
+                    return None
+
+                course = self.users[email].timetable.get(course_id)
+                if course is None:
+                    return None
+
+                return course.to_dict()
             
         except Exception as e:
             print(f"获取课程失败: {str(e)}")
             return None
 
-    # 修改现有的 get_timetable 方法，为每个课程添加索引ID
     def get_timetable(self, email: str) -> List[dict]:
-        """获取指定用户的课表，包含索引ID"""
-        if email in self.users:
-            timetable_with_id = []
-            for index, course in enumerate(self.users[email].timetable):
-                course_with_id = course.copy()
-                course_with_id['id'] = index  # 添加索引作为ID
-                timetable_with_id.append(course_with_id)
-            return timetable_with_id
-        return []
+        """获取指定用户的课表（副本），每门课程带id"""
+        try:
+            return [dict(course) for course in self.get_timetable_snapshot(email)[1]]
+        except KeyError:
+            return []
     
-    def add_single_course(self, email: str, course: dict):
-        """添加单个课程到用户课表"""
+    @mutation
+    def add_single_course(self, email: str, course: dict) -> int:
+        """添加单个课程到用户课表，返回新课程的ID"""
         if email not in self.users:
             raise KeyError("用户不存在")
         
         # 添加提醒标记字段
         course['last_reminder'] = None
-        self.users[email].timetable.append(course)
-        
+        user = self.users[email]
+        course_id = self._next_id(user)
+        user.timetable[course_id] = Course.from_dict(course)
+        self._index_courses(email, [(course_id, user.timetable[course_id])])
+        self._timetable_changed(user)
+        self._log("add_single_course", email, course)
+        return course_id
+
+    # ====== 课程提醒 ======
+
+    def pop_due_reminders(self, now: Optional[float] = None) -> List[Tuple[str, dict]]:
+        """取出提醒时间已到的课程，返回 [(上课日期YYYY-MM-DD, 带email、username和id的课程)]
+
+        每门课每次上课只会被取出一次（除非期间被修改），调用方仍应根据last_reminder去重。
+        """
+        with self._index_lock:
+            due = self.reminders.pop_due(now)
+        dates = {ref: datetime.fromtimestamp(start, REMINDER_TIMEZONE).date().isoformat() for ref, start in due}
+        return [(dates[(course["email"], course["id"])], course) for course in self._resolve_courses(list(dates))]
+
+    @mutation
+    def mark_reminded(self, email: str, course_id: int, date: str, expected: Optional[dict] = None) -> bool:
+        """记录课程在某天已发送过提醒
+
+        expected为调用方之前读到的课程，如果期间课程被修改（例如改了上课时间），则不做标记。
+        """
+        user = self.users.get(email)
+        course = user.timetable.get(course_id) if user is not None else None
+        if course is None:
+            return False
+        if expected is not None and any(getattr(course, key) != expected.get(key) for key in COURSE_IDENTITY_FIELDS):
+            return False
+        course.last_reminder = date
+        self._timetable_changed(user)
+        self._log("mark_reminded", email, course_id, date)
+        return True
+
+    # ====== 快照 ======
+
+    def dump_state(self) -> dict:
+        """导出可JSON序列化的完整数据副本（视频用户租约不持久化）"""
+        with self.exclusive():
+            return {
+                "users": [
+                    [user.email, user.username, user.password, user.next_id,
+                     [dict(course.to_dict(), id=course_id) for course_id, course in user.timetable.items()],
+                     [dict(task.to_dict(), id=task_id) for task_id, task in user.tasks.items()]]
+                    for user in self.users.values()
+                ],
+                "chat_rooms": {
+                    room: [history._next_seq, [
+                        [m.seq, m.username, m.content, m.timestamp.isoformat()]
+                        for m in history.page(limit=len(history))
+                    ]]
+                    for room, history in self.chat_rooms.items()
+                },
+            }
+
+    def load_state(self, state: dict):
+        """用dump_state导出的数据替换当前数据"""
+        with self.exclusive():
+            self.users = {
+                email: User(email=email, username=username, password=password, next_id=next_id,
+                            timetable={course["id"]: Course.from_dict(course) for course in timetable},
+                            tasks={task["id"]: Task.from_dict(task) for task in tasks})
+                for email, username, password, next_id, timetable, tasks in state["users"]
+            }
+            for user in self.users.values():
+                user.due_index = sorted((task.due_date, task_id) for task_id, task in user.tasks.items())
+            self._rebuild_indexes()
+            self.chat_rooms = {}
+            for room, (next_seq, messages) in state["chat_rooms"].items():
+                history = self.chat_rooms[room] = ChatHistory(self.chat_history_capacity)
+                history.restore([
+                    ChatMessage(username=username, content=content,
+                                timestamp=datetime.fromisoformat(timestamp), seq=seq)
+                    for seq, username, content, timestamp in messages
+                ], next_seq)
+
+    def close(self):
+        """停止快照线程并把日志刷到磁盘"""
+        if self.compactor is not None:
+            self.compactor.stop()
+        if self.journal is not None:
+            self.journal.close()
+
+def create_data_store():
+    """根据环境变量 DATA_STORE_BACKEND 创建数据存储: memory（默认）、journal 或 sqlite"""
+    backend = os.environ.get("DATA_STORE_BACKEND", "memory")
+    if backend == "journal":
+        from journal import open_journaled_store
+        return open_journaled_store(os.environ.get("JOURNAL_DIR", "data"))
+    if backend == "sqlite":
+        from sqlite_store import SQLiteDataStore
+        return SQLiteDataStore(os.environ.get("SQLITE_PATH", "smart_learning.db"))
+    if backend == "memory":
+        return DataStore()
+    raise ValueError(f"未知的数据存储类型: {backend}")
+
 # 创建全局数据存储实例
-data_store = DataStore()
\ No newline at end of file
+data_store = create_data_store()
\ No newline at end of file
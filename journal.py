@@ -0,0 +1,227 @@
+import gc
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from data_store import DataStore
+
+# 日志配置
+JOURNAL_FLUSH_INTERVAL = float(os.environ.get("JOURNAL_FLUSH_INTERVAL", "0.05"))   # 组提交fsync的最长间隔（秒）
+JOURNAL_SNAPSHOT_INTERVAL = float(os.environ.get("JOURNAL_SNAPSHOT_INTERVAL", "300"))  # 定期快照间隔（秒）
+JOURNAL_SNAPSHOT_RECORDS = int(os.environ.get("JOURNAL_SNAPSHOT_RECORDS", "100000"))  # 日志达到这么多条时提前快照
+
+SEGMENT_PATTERN = re.compile(r"^journal-(\d{6})\.log$")
+SNAPSHOT_PATTERN = re.compile(r"^snapshot-(\d{6})\.json$")
+
+def segment_path(directory: str, number: int) -> str:
+    return os.path.join(directory, f"journal-{number:06d}.log")
+
+def snapshot_path(directory: str, number: int) -> str:
+    return os.path.join(directory, f"snapshot-{number:06d}.json")
+
+def list_files(directory: str, pattern) -> List[Tuple[int, str]]:
+    """返回目录中匹配的 (编号, 路径)，按编号升序"""
+    found = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(found)
+
+class Journal:
+    """追加日志：每条修改记录是一行紧凑JSON
+
+    append只写入进程内缓冲区，后台线程每隔JOURNAL_FLUSH_INTERVAL把这段时间内的所有记录
+    一次性fsync（组提交），进程崩溃最多丢失这一小段时间内的修改。
+    日志按段存放，snapshot-N.json 包含编号小于N的所有段的内容。
+    """
+    def __init__(self, directory: str, segment: int, flush_interval: float = JOURNAL_FLUSH_INTERVAL):
+        self.directory = directory
+        self.segment = segment
+        self.flush_interval = flush_interval
+        self.records = 0  # 当前段已写入的记录数
+        self.stats = {"appended": 0, "fsyncs": 0}
+        self._cond = threading.Condition()
+        self._file = open(segment_path(directory, segment), "a", encoding="utf-8")
+        self._dirty = False
+        self._closed = False
+        self._flusher = threading.Thread(target=self._run_flusher, name="journal-flusher", daemon=True)
+        self._flusher.start()
+
+    def append(self, record: list):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._cond:
+            self._file.write(line + "\n")
+            self.records += 1
+            self.stats["appended"] += 1
+            if not self._dirty:
+                self._dirty = True
+                self._cond.notify()
+
+    def flush(self):
+        """把已追加的记录写入磁盘并等待fsync完成"""
+        with self._cond:
+            self._sync()
+
+    def rotate(self) -> int:
+        """结束当前段并开始新段，返回新段编号"""
+        with self._cond:
+            self._sync()
+            self._file.close()
+            self.segment += 1
+            self.records = 0
+            self._file = open(segment_path(self.directory, self.segment), "a", encoding="utf-8")
+            return self.segment
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._sync()
+            self._file.close()
+            self._closed = True
+            self._cond.notify()
+        self._flusher.join()
+
+    def _sync(self):
+        # 调用方需持有self._cond
+        if self._dirty:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._dirty = False
+            self.stats["fsyncs"] += 1
+
+    def _run_flusher(self):
+        with self._cond:
+            while not self._closed:
+                if not self._dirty:
+                    self._cond.wait()
+                    continue
+                # 等一小段时间，让并发的写入共用同一次fsync
+                self._cond.wait(self.flush_interval)
+                if not self._closed:
+                    self._sync()
+
+def write_snapshot(directory: str, number: int, state: dict):
+    """原子地写入快照：先写临时文件并fsync，再重命名"""
+    path = snapshot_path(directory, number)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def apply_record(store: DataStore, record: list):
+    """把一条日志记录重新应用到数据存储"""
+    op, *args = record
+    if op == "update_user":
+        email, fields = args
+        store.update_user(email, **fields)
+    elif op == "add_message":
+        username, content, room, timestamp = args
+        store.add_message(username, content, room, datetime.fromisoformat(timestamp))
+    else:
+        getattr(store, op)(*args)
+
+def replay_segment(store: DataStore, path: str) -> int:
+    """重放一个日志段，返回应用的记录数；崩溃时写了一半的最后一行会被忽略"""
+    applied = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print(f"日志 {path} 末尾有不完整的记录，已忽略")
+                break
+            apply_record(store, record)
+            applied += 1
+    return applied
+
+class Compactor:
+    """后台压缩线程：定期把数据存储写成快照，并删除快照已覆盖的日志段"""
+    def __init__(self, store: DataStore, interval: float = JOURNAL_SNAPSHOT_INTERVAL,
+                 max_records: int = JOURNAL_SNAPSHOT_RECORDS):
+        self.store = store
+        self.interval = interval
+        self.max_records = max_records
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="journal-compactor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def compact(self) -> int:
+        """写一次快照，返回快照编号"""
+        journal = self.store.journal
+        # 持有全部分段锁导出数据并切换日志段，保证快照与新段的起点一致
+        with self.store.exclusive():
+            state = self.store.dump_state()
+            number = journal.rotate()
+        # 序列化和写盘在锁外进行，不阻塞请求
+        write_snapshot(journal.directory, number, state)
+        for old, path in list_files(journal.directory, SEGMENT_PATTERN):
+            if old < number:
+                os.unlink(path)
+        for old, path in list_files(journal.directory, SNAPSHOT_PATTERN):
+            if old < number:
+                os.unlink(path)
+        return number
+
+    def _run(self):
+        last = time.monotonic()
+        # 每秒检查一次：到了快照间隔，或者当前段记录太多时压缩
+        while not self._stop.wait(1.0):
+            records = self.store.journal.records
+            if records and (records >= self.max_records or time.monotonic() - last >= self.interval):
+                try:
+                    self.compact()
+                except OSError as e:
+                    print(f"写入快照失败: {e}")
+                last = time.monotonic()
+
+def open_journaled_store(directory: str, **store_kwargs) -> DataStore:
+    """加载最新快照并重放其后的日志段，返回挂接了日志和压缩线程的DataStore"""
+    os.makedirs(directory, exist_ok=True)
+    started = time.perf_counter()
+    store = DataStore(**store_kwargs)
+    snapshots = list_files(directory, SNAPSHOT_PATTERN)
+    base = 0
+    replayed = 0
+    # 恢复期间只创建长期存活的对象，暂停分代GC可以省掉大量无用的扫描
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if snapshots:
+            base, path = snapshots[-1]
+            with open(path, "r", encoding="utf-8") as f:
+                store.load_state(json.load(f))
+        last_segment = base
+        for number, path in list_files(directory, SEGMENT_PATTERN):
+            if number >= base:
+                replayed += replay_segment(store, path)
+                last_segment = number
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    # 总是从新段开始追加，避免接在不完整的记录后面
+    store.journal = Journal(directory, last_segment + 1)
+    compactor = Compactor(store)
+    if not snapshots:
+        # 首次启动时立即写快照，固定预置数据
+        compactor.compact()
+    compactor.start()
+    store.compactor = compactor
+    print(f"数据已从 {directory} 恢复: {len(store.users)} 个用户，重放 {replayed} 条日志，"
+          f"耗时 {time.perf_counter() - started:.2f}s")
+    return store
@@ -0,0 +1,107 @@
+"""登录高峰压测：大量登录同时到达时，事件循环是否还能及时处理聊天记录请求
+
+先空闲运行一段时间，测量聊天记录请求（每--interval秒一次，直接调用get_chat_history）的延迟，
+再同时发起--logins个登录，测量登录期间同样请求的延迟和登录吞吐量。延迟从请求本应发出的
+时间算起，事件循环被阻塞时排队的请求也计入。--inline在事件循环线程中直接校验密码，
+用来对比不使用哈希线程池时的情况。有登录失败，或者登录期间延迟的p99超过--max-p99-ms时以非0状态退出。
+
+    python login_bench.py
+    python login_bench.py --inline
+    python login_bench.py --logins 200 --iterations 100000 --max-p99-ms 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+async def probe(server, interval: float, latencies: list, until: asyncio.Future):
+    """按固定间隔请求聊天记录，记录从计划发出到完成的时间，直到until给出的结束时间"""
+    loop = asyncio.get_running_loop()
+    scheduled = loop.time()
+    while True:
+        scheduled += interval
+        # 事件循环被阻塞期间本应发出的请求也要补上
+        if until.done() and scheduled > until.result():
+            return
+        await asyncio.sleep(max(0.0, scheduled - loop.time()))
+        await server.get_chat_history(limit=50)
+        latencies.append(loop.time() - scheduled)
+
+async def measure(server, interval: float, start_work):
+    """执行start_work()期间持续请求聊天记录，返回它的结果和请求延迟"""
+    loop = asyncio.get_running_loop()
+    latencies = []
+    until = loop.create_future()
+    task = asyncio.create_task(probe(server, interval, latencies, until))
+    # 让探测任务先开始计时，再发起要测量的请求
+    await asyncio.sleep(0)
+    result = await start_work()
+    until.set_result(loop.time())
+    await task
+    return result, latencies
+
+async def storm(server, logins: int, idle: float, interval: float) -> dict:
+    _, idle_latencies = await measure(server, interval, lambda: asyncio.sleep(idle))
+    began = time.perf_counter()
+    results, storm_latencies = await measure(server, interval, lambda: asyncio.gather(
+        *(server.login(server.UserLogin(email=f"student{number}@bench.test", password="bench"))
+          for number in range(logins)),
+        return_exceptions=True,
+    ))
+    return {
+        "seconds": time.perf_counter() - began,
+        "failed": sum(1 for result in results if not isinstance(result, dict)),
+        "idle": idle_latencies,
+        "storm": storm_latencies,
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="登录高峰时聊天记录请求的延迟")
+    parser.add_argument("--logins", type=int, default=40, help="同时发起的登录数")
+    parser.add_argument("--iterations", type=int, default=600000, help="PBKDF2迭代次数（PASSWORD_HASH_ITERATIONS）")
+    parser.add_argument("--workers", type=int, default=None, help="哈希线程数（PASSWORD_HASH_WORKERS），默认为CPU核数")
+    parser.add_argument("--interval", type=float, default=0.005, help="聊天记录请求的间隔秒数")
+    parser.add_argument("--idle", type=float, default=1.0, help="登录前空闲测量的秒数")
+    parser.add_argument("--inline", action="store_true", help="在事件循环线程中直接校验密码（对比用）")
+    parser.add_argument("--max-p99-ms", type=float, default=None, help="登录期间请求延迟p99的上限（毫秒），超过时返回1")
+    args = parser.parse_args()
+
+    # passwords在导入时读取这些配置，data_store等模块也会导入它，必须在导入它们之前设置
+    os.environ["PASSWORD_HASH_ITERATIONS"] = str(args.iterations)
+    if args.workers is not None:
+        os.environ["PASSWORD_HASH_WORKERS"] = str(args.workers)
+    import passwords
+    import server
+    from reminder_bench import tick_summary
+
+    # 所有用户的密码相同，只计算一次哈希
+    stored = passwords.hash_password("bench")
+    for number in range(args.logins):
+        server.data_store.add_user(f"student{number}@bench.test", f"学生{number}", stored)
+    if args.inline:
+        async def check_inline(password: str, stored: str):
+            return passwords.check_password(password, stored)
+        server.check_password_async = check_inline
+
+    result = asyncio.run(storm(server, args.logins, args.idle, args.interval))
+    result["idle"], result["storm"] = tick_summary(result["idle"]), tick_summary(result["storm"])
+    mode = "事件循环内校验" if args.inline else f"哈希线程池（{passwords.PASSWORD_HASH_WORKERS} 个线程）"
+    print(f"{args.logins} 个登录，PBKDF2 {args.iterations} 次迭代，{mode}：{result['seconds']:.2f}s，"
+          f"{args.logins / result['seconds']:.1f} 次/秒")
+    for name, label in (("idle", "空闲时"), ("storm", "登录期间")):
+        summary = result[name]
+        print(f"{label}聊天记录请求 {summary['count']} 次：p50 {summary['p50_ms']:.2f}ms  p95 {summary['p95_ms']:.2f}ms  "
+              f"p99 {summary['p99_ms']:.2f}ms  max {summary['max_ms']:.2f}ms")
+
+    failures = []
+    if result["failed"]:
+        failures.append(f"{result['failed']} 个登录失败")
+    if args.max_p99_ms is not None and result["storm"]["p99_ms"] > args.max_p99_ms:
+        failures.append(f"登录期间请求延迟p99 {result['storm']['p99_ms']:.2f}ms 超过上限 {args.max_p99_ms}ms")
+    for failure in failures:
+        print(f"❌ {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+import contextlib
+import os
+import smtplib
+import ssl
+import threading
+import time
+from email.message import Message
+from typing import Callable, List, Optional, Tuple
+
+# SMTP连接池配置
+MAIL_POOL_SIZE = int(os.environ.get("MAIL_POOL_SIZE", "4"))                # 最多同时保持的已登录连接数
+MAIL_NOOP_AFTER = float(os.environ.get("MAIL_NOOP_AFTER", "10"))           # 连接空闲超过这么多秒，复用前先发NOOP确认仍然可用
+MAIL_IDLE_TIMEOUT = float(os.environ.get("MAIL_IDLE_TIMEOUT", "120"))      # 空闲超过这么多秒直接关闭重连（服务器多半已断开）
+MAIL_CONNECT_TIMEOUT = float(os.environ.get("MAIL_CONNECT_TIMEOUT", "30"))  # 连接和每条命令的超时（秒）
+
+def is_stale_error(error: BaseException) -> bool:
+    """异常是否说明连接已不可用（断开、网络错误、421），应当丢弃重连
+
+    smtplib.SMTPException是OSError的子类，收件人被拒等协议错误不代表连接失效。
+    """
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+def is_permanent_error(error: BaseException) -> bool:
+    """重试也不会成功的错误：收件人被拒、5xx响应（登录失败除外，可能只是配置待修正）"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False
+    return isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600
+
+class SMTPPool:
+    """SMTP连接池：复用已完成TLS握手和登录的连接，避免每封邮件都重新连接
+
+    取出空闲连接时检查是否过期：空闲较久的先发NOOP探测，太久的直接重连；
+    发送过程中发现连接已断开，会换一个新连接重试一次。可以被多个线程同时使用。
+    在session()块内，当前线程的所有发送共用同一个连接。
+    """
+    def __init__(self, host: str, port: int, user: Optional[str] = None, password: Optional[str] = None,
+                 use_ssl: bool = True, ssl_context: Optional[ssl.SSLContext] = None, size: int = MAIL_POOL_SIZE, noop_after: float = MAIL_NOOP_AFTER,
+                 idle_timeout: float = MAIL_IDLE_TIMEOUT, timeout: float = MAIL_CONNECT_TIMEOUT,
+                 clock: Callable[[], float] = time.monotonic):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_ssl = use_ssl
+        self.ssl_context = ssl_context
+        self.noop_after = noop_after
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.clock = clock
+        self.stats = {"connects": 0, "sent": 0, "noops": 0, "reconnects": 0}
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[smtplib.SMTP, float]] = []  # (连接, 上次使用时间)，后进先出
+        self._closed = False
+        self._local = threading.local()  # 当前线程session()中占用的连接
+
+    def _connect(self) -> smtplib.SMTP:
+        if self.use_ssl:
+            conn = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout, context=self.ssl_context)
+        else:
+            conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.user:
+                conn.login(self.user, self.password)
+        except Exception:
+            self._discard(conn)
+            raise
+        with self._lock:
+            self.stats["connects"] += 1
+        return conn
+
+    @staticmethod
+    def _discard(conn: smtplib.SMTP):
+        try:
+            conn.quit()
+        except Exception:
+            conn.close()
+
+    def _take(self) -> smtplib.SMTP:
+        """取出一个可用连接，没有空闲连接时新建"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+            idle = self.clock() - last_used
+            if idle > self.idle_timeout:
+                self._discard(conn)
+                continue
+            if idle > self.noop_after:
+                with self._lock:
+                    self.stats["noops"] += 1
+                try:
+                    if conn.noop()[0] == 250:
+                        return conn
+                except OSError:
+                    pass
+                self._discard(conn)
+                continue
+            return conn
+        return self._connect()
+
+    def _give_back(self, conn: smtplib.SMTP):
+        with self._lock:
+            if not self._closed:
+                self._idle.append((conn, self.clock()))
+                return
+        self._discard(conn)
+
+    @staticmethod
+    def _reset(conn: smtplib.SMTP) -> bool:
+        """协议层错误（如收件人被拒）后连接仍可继续使用，先RSET清掉未完成的事务；返回连接是否可用"""
+        try:
+            conn.rset()
+            return True
+        except OSError:
+            return False
+
+    @contextlib.contextmanager
+    def connection(self):
+        """借出一个已登录的连接；块内抛出连接类异常时该连接被丢弃，否则归还连接池"""
+        with self._slots:
+            conn = self._take()
+            try:
+                yield conn
+            except smtplib.SMTPException as e:
+                if not is_stale_error(e) and self._reset(conn):
+                    self._give_back(conn)
+                else:
+                    self._discard(conn)
+                raise
+            except BaseException:
+                self._discard(conn)
+                raise
+            else:
+                self._give_back(conn)
+
+    @contextlib.contextmanager
+    def session(self):
+        """在块内占用一个连接，当前线程的send/sendmail都通过它发送，省去每封邮件借还连接
+
+        用于一次发送一批邮件；块内某封邮件失败不影响后续邮件，连接断开时自动换新连接。
+        """
+        if getattr(self._local, "session", False):
+            yield
+            return
+        with self._slots:
+            self._local.session = True
+            self._local.conn = None
+            try:
+                yield
+            finally:
+                conn, self._local.conn = self._local.conn, None
+                self._local.session = False
+                if conn is not None:
+                    self._give_back(conn)
+
+    def _session_send(self, action: Callable[[smtplib.SMTP], object]):
+        """用session占用的连接发送（名额已由session占用），出错时的处理与connection()相同"""
+        conn = self._local.conn
+        if conn is None:
+            conn = self._local.conn = self._take()
+        try:
+            action(conn)
+        except smtplib.SMTPException as e:
+            if not is_stale_error(e) and self._reset(conn):
+                raise
+            self._local.conn = None
+            self._discard(conn)
+            raise
+        except BaseException:
+            self._local.conn = None
+            self._discard(conn)
+            raise
+
+    def _send(self, action: Callable[[smtplib.SMTP], object]):
+        """用一个连接执行发送；连接在使用中被服务器断开时换新连接重试一次"""
+        try:
+            self._send_once(action)
+        except OSError as e:
+            if not is_stale_error(e):
+                raise
+            with self._lock:
+                self.stats["reconnects"] += 1
+            self._send_once(action)
+        with self._lock:
+            self.stats["sent"] += 1
+
+    def _send_once(self, action: Callable[[smtplib.SMTP], object]):
+        if getattr(self._local, "session", False):
+            self._session_send(action)
+        else:
+            with self.connection() as conn:
+                action(conn)
+
+    def send(self, msg: Message):
+        """发送一个email.message对象"""
+        self._send(lambda conn: conn.send_message(msg))
+
+    def sendmail(self, from_addr: str, to_addrs: List[str], data: bytes):
+        """发送已经编码好的邮件（例如reminder_email生成的字节串），省去email包的序列化"""
+        self._send(lambda conn: conn.sendmail(from_addr, to_addrs, data))
+
+    def close(self):
+        """关闭所有空闲连接，借出中的连接归还时关闭"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
@@ -0,0 +1,125 @@
+"""内存占用压测：用tracemalloc测量聊天记录和课表、任务在内存存储中占用的字节数
+
+课程和任务的字符串逐个用"".join重新生成，模拟从CSV/JSON解析出的互不共享的字符串；
+作为对比，同样的课表也按每门课一个dict的形式保存一份并测量。每个用户的占用包括二级索引
+和提醒时间表，--top可以输出写入用户时分配内存最多的代码行。
+每条消息或每个用户的平均占用超过上限时以非0状态退出。
+
+    python memory_bench.py                                    # 100万条消息，10万个用户
+    python memory_bench.py --messages 100000 --users 10000 --top 10
+    python memory_bench.py --max-message-bytes 200 --max-user-bytes 10000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from data_store import DataStore
+
+COURSE_DAYS = ["周一", "周二", "周三", "周四", "周五"]
+COURSE_SLOTS = [("08:00", "09:40"), ("10:00", "11:40"), ("14:00", "15:40"), ("16:00", "17:40"), ("19:00", "20:40")]
+COURSE_ROOMS = [f"教{building}-{floor}0{room}" for building in range(1, 6) for floor in range(1, 6) for room in range(10)]
+COURSE_NAMES = [f"课程{number}" for number in range(300)]
+
+def traced_mb() -> float:
+    return tracemalloc.get_traced_memory()[0] / 2**20
+
+def parsed_timetable(rng: random.Random, courses: int) -> list:
+    """每个字符串都是新对象，和解析上传文件得到的课表一样"""
+    entries = []
+    for _ in range(courses):
+        start, end = rng.choice(COURSE_SLOTS)
+        entries.append({
+            "course_name": "".join(rng.choice(COURSE_NAMES)), "day_of_week": "".join(rng.choice(COURSE_DAYS)),
+            "start_time": "".join(start), "end_time": "".join(end), "location": "".join(rng.choice(COURSE_ROOMS)),
+        })
+    return entries
+
+def parsed_tasks(tasks: int) -> list:
+    return [{"title": f"作业{number}", "description": "".join("完成习题"), "due_date": "2026-11-%02d" % (number + 1)}
+            for number in range(tasks)]
+
+def measure_messages(store: DataStore, messages: int) -> dict:
+    base = traced_mb()
+    began = time.perf_counter()
+    for number in range(messages):
+        store.add_message(f"学生{number % 500}", "今天的作业是第三章习题", "course:高等数学")
+    used = traced_mb() - base
+    return {"mb": used, "bytes_each": used * 2**20 / messages, "seconds": time.perf_counter() - began}
+
+def measure_users(store: DataStore, users: int, courses: int, tasks: int, seed: int, top: int = 0) -> dict:
+    rng = random.Random(seed)
+    before = tracemalloc.take_snapshot() if top else None
+    base = traced_mb()
+    began = time.perf_counter()
+    for number in range(users):
+        email = f"student{number}@bench.test"
+        store.add_user(email, f"学生{number}", "bench")
+        store.add_timetable(email, parsed_timetable(rng, courses))
+        for task in parsed_tasks(tasks):
+            store.add_task(email, task)
+    used = traced_mb() - base
+    seconds = time.perf_counter() - began
+    lines = tracemalloc.take_snapshot().compare_to(before, "lineno")[:top] if top else []
+    return {"mb": used, "bytes_each": used * 2**20 / users, "seconds": seconds, "top": lines}
+
+def measure_dicts(users: int, courses: int, tasks: int, seed: int) -> dict:
+    """同样的数据每门课、每个任务保存为一个dict时的占用"""
+    rng = random.Random(seed)
+    base = traced_mb()
+    data = {}
+    for number in range(users):
+        timetable = {course_id: dict(entry, last_reminder=None)
+                     for course_id, entry in enumerate(parsed_timetable(rng, courses), 1)}
+        task_list = {task_id: task for task_id, task in enumerate(parsed_tasks(tasks), courses + 1)}
+        data[f"student{number}@bench.test"] = {"timetable": timetable, "tasks": task_list}
+    used = traced_mb() - base
+    del data
+    return {"mb": used, "bytes_each": used * 2**20 / users}
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="聊天记录和课表的内存占用")
+    parser.add_argument("--messages", type=int, default=1000000, help="聊天消息数（聊天记录容量同样设为该值）")
+    parser.add_argument("--users", type=int, default=100000, help="用户数")
+    parser.add_argument("--courses", type=int, default=10, help="每个用户的课程数")
+    parser.add_argument("--tasks", type=int, default=5, help="每个用户的任务数")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    parser.add_argument("--top", type=int, default=0, help="输出写入用户时分配内存最多的N行代码")
+    parser.add_argument("--max-message-bytes", type=float, default=None, help="每条消息平均占用的上限（字节），超过时返回1")
+    parser.add_argument("--max-user-bytes", type=float, default=None, help="每个用户平均占用的上限（字节），超过时返回1")
+    args = parser.parse_args()
+
+    store = DataStore(chat_history_capacity=args.messages)
+    tracemalloc.start()
+    messages = measure_messages(store, args.messages)
+    print(f"聊天消息 {args.messages}：{messages['mb']:.1f}MB，{messages['bytes_each']:.0f} 字节/条，"
+          f"写入 {messages['seconds']:.1f}s")
+    users = measure_users(store, args.users, args.courses, args.tasks, args.seed, args.top)
+    print(f"用户 {args.users}（每人 {args.courses} 门课、{args.tasks} 个任务）：{users['mb']:.1f}MB，"
+          f"{users['bytes_each']:.0f} 字节/用户，写入 {users['seconds']:.1f}s")
+    for stat in users["top"]:
+        frame = stat.traceback[0]
+        print(f"    {os.path.basename(frame.filename)}:{frame.lineno}  {stat.size_diff / 2**20:.1f}MB  {stat.count_diff} 个对象")
+    dicts = measure_dicts(args.users, args.courses, args.tasks, args.seed)
+    print(f"同样的课表和任务保存为dict：{dicts['mb']:.1f}MB，{dicts['bytes_each']:.0f} 字节/用户")
+    tracemalloc.stop()
+
+    began = time.perf_counter()
+    for number in range(0, args.users, 10):
+        store.get_timetable(f"student{number}@bench.test")
+    reads = len(range(0, args.users, 10))
+    print(f"get_timetable {reads} 次：{(time.perf_counter() - began) / reads * 1e6:.1f}us/次")
+
+    failures = []
+    if args.max_message_bytes is not None and messages["bytes_each"] > args.max_message_bytes:
+        failures.append(f"每条消息 {messages['bytes_each']:.0f} 字节，超过上限 {args.max_message_bytes}")
+    if args.max_user_bytes is not None and users["bytes_each"] > args.max_user_bytes:
+        failures.append(f"每个用户 {users['bytes_each']:.0f} 字节，超过上限 {args.max_user_bytes}")
+    for failure in failures:
+        print(f"❌ {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import time
+from typing import Callable, Dict, Optional
+
+# 事件总线配置
+BUS_BACKEND = os.environ.get("CHAT_BUS_BACKEND", "inprocess")  # "inprocess" 单进程 / "unix" 同机多worker
+BUS_DIR = os.environ.get("CHAT_BUS_DIR", os.path.join(tempfile.gettempdir(), "smart-learning-bus"))
+MAX_DATAGRAM_SIZE = 64 * 1024       # 单个事件序列化后的最大字节数
+PEER_REFRESH_INTERVAL = 2.0         # 重新扫描其他worker套接字的间隔（秒）
+
+EventHandler = Callable[[dict], None]
+
+class InProcessBus:
+    """单进程事件总线：发布的事件直接交给本进程的处理函数"""
+    def __init__(self):
+        self.worker_id = str(os.getpid())
+        self.stats = {"published": 0, "received": 0, "dropped": 0}
+        # 发现其他worker退出时回调 (worker_id)
+        self.on_peer_lost: Optional[Callable[[str], None]] = None
+        self._handler: Optional[EventHandler] = None
+
+    async def start(self, handler: EventHandler):
+        self._handler = handler
+
+    def publish(self, event: dict):
+        """发布事件，本进程的处理函数会同步收到该事件"""
+        event["origin"] = self.worker_id
+        self.stats["published"] += 1
+        if self._handler is not None:
+            self._handler(event)
+
+    async def close(self):
+        self._handler = None
+
+class UnixSocketBus(InProcessBus):
+    """同一台机器上的多个worker通过Unix数据报套接字互相转发事件，不需要外部消息代理
+
+    每个worker在bus_dir下绑定一个以自身进程号命名的套接字文件，
+    发布事件时先交给本进程处理，再逐个发送给目录中其他worker的套接字。
+    """
+    def __init__(self, bus_dir: str = BUS_DIR):
+        super().__init__()
+        self.bus_dir = bus_dir
+        self._path = os.path.join(bus_dir, f"{self.worker_id}.sock")
+        self._sock: Optional[socket.socket] = None
+        self._peers: Dict[str, str] = {}  # worker_id -> 套接字路径
+        self._peers_refreshed = 0.0
+
+    async def start(self, handler: EventHandler):
+        await super().start(handler)
+        os.makedirs(self.bus_dir, exist_ok=True)
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self._path)
+        self._sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), self._on_readable)
+
+    async def close(self):
+        if self._sock is not None:
+            asyncio.get_running_loop().remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+        await super().close()
+
+    def publish(self, event: dict):
+        super().publish(event)
+        if self._sock is None:
+            return
+        data = json.dumps(event, ensure_ascii=False).encode("utf-8")
+        if len(data) > MAX_DATAGRAM_SIZE:
+            self.stats["dropped"] += 1
+            return
+        for worker_id, path in list(self._get_peers().items()):
+            try:
+                self._sock.sendto(data, path)
+            except BlockingIOError:
+                # 对方接收缓冲区已满，丢弃这条事件而不是阻塞事件循环
+                self.stats["dropped"] += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 对方worker已退出，清理残留的套接字文件
+                self._remove_peer(worker_id, path)
+            except OSError:
+                self.stats["dropped"] += 1
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self._sock.recv(MAX_DATAGRAM_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                event = json.loads(data)
+            except ValueError:
+                continue
+            origin = event.get("origin")
+            if origin and origin != self.worker_id and origin not in self._peers:
+                # 新启动的worker，马上加入发送列表
+                self._peers[origin] = os.path.join(self.bus_dir, f"{origin}.sock")
+            self.stats["received"] += 1
+            self._handler(event)
+
+    def _get_peers(self) -> Dict[str, str]:
+        now = time.monotonic()
+        if now - self._peers_refreshed >= PEER_REFRESH_INTERVAL:
+            peers = {}
+            for name in os.listdir(self.bus_dir):
+                if name.endswith(".sock") and name != f"{self.worker_id}.sock":
+                    peers[name[:-len(".sock")]] = os.path.join(self.bus_dir, name)
+            self._peers = peers
+            self._peers_refreshed = now
+        return self._peers
+
+    def _remove_peer(self, worker_id: str, path: str):
+        self._peers.pop(worker_id, None)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        if self.on_peer_lost is not None:
+            self.on_peer_lost(worker_id)
+
+def create_bus(backend: str = BUS_BACKEND) -> InProcessBus:
+    """根据配置创建事件总线"""
+    if backend == "unix":
+        return UnixSocketBus()
+    if backend == "inprocess":
+        return InProcessBus()
+    raise ValueError(f"未知的事件总线类型: {backend}")
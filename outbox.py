@@ -0,0 +1,337 @@
+import contextlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, ContextManager, Dict, List, Optional, Tuple
+
+# 发件箱配置
+OUTBOX_PATH = os.environ.get("OUTBOX_PATH", "outbox.db")
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "4"))                     # 投递线程数
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "20"))              # 投递线程每次取出的消息数，同一批共用一个SMTP会话
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))           # 最多尝试次数，之后进入死信
+OUTBOX_RETRY_BASE = float(os.environ.get("OUTBOX_RETRY_BASE", "5"))             # 第一次重试的等待秒数，之后每次翻倍
+OUTBOX_RETRY_MAX = float(os.environ.get("OUTBOX_RETRY_MAX", "300"))             # 重试等待的上限（秒）
+OUTBOX_LEASE = float(os.environ.get("OUTBOX_LEASE", "120"))                     # 取出后多久没有结果视为投递线程已失效
+OUTBOX_DEFAULT_RATE = float(os.environ.get("OUTBOX_DEFAULT_RATE", "20"))        # 每个收件域名默认每秒最多发送的封数
+OUTBOX_MAX_RATE_WAIT = 1.0  # 被限速时投递线程最多原地等待的秒数，超过则推迟这条消息去处理别的
+OUTBOX_KEEP_SENT = float(os.environ.get("OUTBOX_KEEP_SENT", str(7 * 86400)))   # 已送达消息保留的秒数（用于去重）
+# 按收件域名单独限速，例如 "qq.com=10,163.com=5"
+OUTBOX_RATE_LIMITS = os.environ.get("OUTBOX_RATE_LIMITS", "")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    recipient TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    expires_at REAL,
+    last_error TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox(status, next_attempt);
+"""
+
+SQL_CLAIM = ("UPDATE outbox SET status = 'sending', next_attempt = ?, updated = ? WHERE id IN "
+             "(SELECT id FROM outbox WHERE status IN ('pending', 'sending') AND next_attempt <= ? "
+             "ORDER BY next_attempt LIMIT ?) RETURNING id, key, recipient, payload, attempts, expires_at")
+
+def parse_rate_limits(spec: str) -> Dict[str, float]:
+    """解析 "域名=每秒封数,..." 格式的限速配置"""
+    limits = {}
+    for item in spec.split(","):
+        if item.strip():
+            domain, rate = item.split("=")
+            limits[domain.strip().lower()] = float(rate)
+    return limits
+
+def recipient_domain(recipient: str) -> str:
+    return recipient.rpartition("@")[2].lower()
+
+class Outbox:
+    """持久化的发件箱（SQLite）：每条消息有唯一键，重复入队会被忽略
+
+    状态: pending 等待投递 / sending 投递中 / sent 已送达 / dead 死信（重试耗尽、永久错误或已过期）。
+    sending状态的消息在租约（OUTBOX_LEASE）到期后可以被重新取出，进程崩溃后不会丢失。
+    """
+    def __init__(self, path: str = OUTBOX_PATH, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 retry_base: float = OUTBOX_RETRY_BASE, retry_max: float = OUTBOX_RETRY_MAX,
+                 lease: float = OUTBOX_LEASE, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lease = lease
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def enqueue(self, key: str, recipient: str, payload: dict, expires_at: Optional[float] = None) -> bool:
+        """加入一条消息，返回是否为新消息（同一个键已存在时不重复加入）"""
+        now = self.clock()
+        with self._lock:
+            return self._conn.execute(
+                "INSERT OR IGNORE INTO outbox (key, recipient, payload, next_attempt, expires_at, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, recipient, json.dumps(payload, ensure_ascii=False), now, expires_at, now)
+            ).rowcount == 1
+
+    def enqueue_many(self, messages: List[Tuple[str, str, dict, Optional[float]]]) -> int:
+        """在一个事务中加入多条 (键, 收件人, payload, 过期时间) 消息，返回新加入的条数"""
+        now = self.clock()
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO outbox (key, recipient, payload, next_attempt, expires_at, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(key, recipient, json.dumps(payload, ensure_ascii=False), now, expires_at, now)
+                     for key, recipient, payload, expires_at in messages]
+                )
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return self._conn.total_changes - before
+
+    def claim(self) -> Optional[dict]:
+        """取出一条到期的消息并标记为投递中，没有时返回None"""
+        messages = self.claim_batch(1)
+        return messages[0] if messages else None
+
+    def claim_batch(self, limit: int) -> List[dict]:
+        """取出最多limit条到期的消息并标记为投递中，按入队顺序返回"""
+        now = self.clock()
+        with self._lock:
+            rows = self._conn.execute(SQL_CLAIM, (now + self.lease, now, now, limit)).fetchall()
+        rows.sort()
+        return [{"id": row[0], "key": row[1], "recipient": row[2], "payload": json.loads(row[3]),
+                 "attempts": row[4], "expires_at": row[5]} for row in rows]
+
+    def next_due(self) -> Optional[float]:
+        """最早一条待投递消息的时间"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT MIN(next_attempt) FROM outbox WHERE status IN ('pending', 'sending')"
+            ).fetchone()[0]
+
+    def backlog(self) -> int:
+        """已到期还没投递的消息和正在投递的消息总数，为0时说明当前没有待处理的消息"""
+        now = self.clock()
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = 'sending' OR (status = 'pending' AND next_attempt <= ?)",
+                (now,)
+            ).fetchone()[0]
+
+    def complete(self, message_id: int):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET status = 'sent', updated = ? WHERE id = ?",
+                               (self.clock(), message_id))
+
+    def defer(self, message_id: int, delay: float):
+        """被限速时推迟投递，不计入尝试次数"""
+        now = self.clock()
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET status = 'pending', next_attempt = ?, updated = ? WHERE id = ?",
+                               (now + delay, now, message_id))
+
+    def fail(self, message: dict, error: str, permanent: bool = False) -> bool:
+        """记录一次失败，按指数退避安排重试；返回消息是否进入了死信"""
+        now = self.clock()
+        attempts = message["attempts"] + 1
+        expires_at = message["expires_at"]
+        dead = permanent or attempts >= self.max_attempts
+        if not dead:
+            # 指数退避，随机取后一半避免大量消息同时重试
+            delay = min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+            next_attempt = now + random.uniform(delay / 2, delay)
+            dead = expires_at is not None and next_attempt >= expires_at
+        else:
+            next_attempt = now
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, last_error = ?, updated = ? WHERE id = ?",
+                ("dead" if dead else "pending", attempts, next_attempt, error, now, message["id"])
+            )
+        return dead
+
+    def expire(self, message: dict):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET status = 'dead', last_error = '已过期', updated = ? WHERE id = ?",
+                               (self.clock(), message["id"]))
+
+    def dead_letters(self, limit: int = 100) -> List[dict]:
+        """最近的死信"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, key, recipient, attempts, last_error, updated FROM outbox WHERE status = 'dead' "
+                "ORDER BY updated DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [dict(zip(("id", "key", "recipient", "attempts", "last_error", "updated"), row)) for row in rows]
+
+    def retry_dead(self, message_id: int) -> bool:
+        """把一条死信重新放回待投递队列"""
+        now = self.clock()
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt = ?, expires_at = NULL, updated = ? "
+                "WHERE id = ? AND status = 'dead'", (now, now, message_id)
+            ).rowcount == 1
+
+    def purge(self, keep: float = OUTBOX_KEEP_SENT) -> int:
+        """删除送达时间早于keep秒之前的消息，返回删除的条数"""
+        with self._lock:
+            return self._conn.execute("DELETE FROM outbox WHERE status = 'sent' AND updated < ?",
+                                      (self.clock() - keep,)).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+class RateLimiter:
+    """按收件域名的令牌桶限速，每个域名允许瞬时发送不超过一秒的额度"""
+    def __init__(self, default_rate: float = OUTBOX_DEFAULT_RATE, limits: Optional[Dict[str, float]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.default_rate = default_rate
+        self.limits = limits if limits is not None else parse_rate_limits(OUTBOX_RATE_LIMITS)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, List[float]] = {}  # 域名 -> [剩余令牌, 上次补充时间]
+
+    def reserve(self, domain: str) -> float:
+        """尝试占用一个发送额度：成功返回0，否则返回还需等待的秒数"""
+        rate = self.limits.get(domain, self.default_rate)
+        if rate <= 0:
+            return 0.0
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(domain)
+            if bucket is None:
+                bucket = self._buckets[domain] = [max(rate, 1.0), now]
+            bucket[0] = min(max(rate, 1.0), bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / rate
+
+class OutboxDispatcher:
+    """固定数量的投递线程，从发件箱取出消息调用deliver发送
+
+    deliver(收件人, payload) 抛出异常表示失败：permanent_error判断为永久错误的直接进入死信，
+    其他错误按指数退避重试。投递成功后调用on_delivered(payload)。
+    每个线程一次取出batch_size条消息，在session()返回的上下文中逐条投递（例如SMTPPool.session，
+    一批邮件共用一个SMTP连接）。
+    """
+    def __init__(self, outbox: Outbox, deliver: Callable[[str, dict], None],
+                 on_delivered: Optional[Callable[[dict], None]] = None,
+                 permanent_error: Callable[[BaseException], bool] = lambda e: False,
+                 workers: int = OUTBOX_WORKERS, limiter: Optional[RateLimiter] = None,
+                 poll_interval: float = 1.0, batch_size: int = OUTBOX_BATCH_SIZE,
+                 session: Callable[[], ContextManager] = contextlib.nullcontext):
+        self.outbox = outbox
+        self.deliver = deliver
+        self.on_delivered = on_delivered
+        self.permanent_error = permanent_error
+        self.workers = workers
+        self.batch_size = batch_size
+        self.session = session
+        self.limiter = limiter or RateLimiter()
+        self.poll_interval = poll_interval
+        self.stats = {"delivered": 0, "failed": 0, "dead": 0, "deferred": 0}
+        self._stats_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._stopping = False
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"outbox-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """等待正在投递的消息完成后停止；未投递的消息留在发件箱中，下次启动继续"""
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def notify(self):
+        """有新消息入队时唤醒空闲的投递线程"""
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _run(self):
+        while not self._stopping:
+            messages = self.outbox.claim_batch(self.batch_size)
+            if not messages:
+                next_due = self.outbox.next_due()
+                timeout = self.poll_interval
+                if next_due is not None:
+                    timeout = min(timeout, max(next_due - self.outbox.clock(), 0.01))
+                with self._wakeup:
+                    if not self._stopping:
+                        self._wakeup.wait(timeout)
+                continue
+            with self.session():
+                for message in messages:
+                    if self._stopping:
+                        # 停止时这一批还没投递的消息放回队列，不必等租约到期
+                        self.outbox.defer(message["id"], 0)
+                    else:
+                        self._process(message)
+
+    def _process(self, message: dict):
+        if message["expires_at"] is not None and self.outbox.clock() >= message["expires_at"]:
+            self.outbox.expire(message)
+            self._count("dead")
+            print(f"提醒已过期，未发送: {message['key']}")
+            return
+        domain = recipient_domain(message["recipient"])
+        waited = 0.0
+        while True:
+            delay = self.limiter.reserve(domain)
+            if delay <= 0:
+                break
+            if waited + delay > OUTBOX_MAX_RATE_WAIT:
+                self.outbox.defer(message["id"], delay)
+                self._count("deferred")
+                return
+            time.sleep(delay)
+            waited += delay
+        try:
+            self.deliver(message["recipient"], message["payload"])
+        except Exception as e:
+            self._count("failed")
+            if self.outbox.fail(message, str(e), permanent=self.permanent_error(e)):
+                self._count("dead")
+                print(f"❌ 邮件投递失败，已放入死信: {message['key']}: {e}")
+            return
+        self.outbox.complete(message["id"])
+        self._count("delivered")
+        if self.on_delivered is not None:
+            try:
+                self.on_delivered(message["payload"])
+            except Exception as e:
+                print(f"投递回调失败: {e}")
@@ -0,0 +1,57 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+# 密码哈希配置
+PASSWORD_HASH_ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", "600000"))  # PBKDF2迭代次数，越大越慢越安全
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))  # 哈希线程数
+PASSWORD_SALT_BYTES = 16
+
+ALGORITHM = "pbkdf2_sha256"
+
+# hashlib.pbkdf2_hmac计算时会释放GIL，放在线程池中既不阻塞事件循环，也能利用多核；
+# 线程数固定，登录高峰时多余的请求在队列中等待，而不是同时抢占所有CPU
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+def hash_password(password: str, iterations: Optional[int] = None) -> str:
+    """返回 pbkdf2_sha256$迭代次数$盐$哈希 格式的字符串"""
+    iterations = iterations or PASSWORD_HASH_ITERATIONS
+    salt = secrets.token_bytes(PASSWORD_SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"{ALGORITHM}${iterations}${_b64(salt)}${_b64(digest)}"
+
+def is_hashed(stored: str) -> bool:
+    return stored.startswith(ALGORITHM + "$")
+
+def check_password(password: str, stored: str) -> Tuple[bool, bool]:
+    """校验密码，返回 (是否匹配, 是否需要重新哈希)
+
+    旧数据中的明文密码同样可以校验，匹配时要求重新哈希；迭代次数低于当前配置的哈希也需要重新哈希。
+    """
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8")), True
+    try:
+        _, iterations, salt, expected = stored.split("$")
+        iterations = int(iterations)
+        salt = base64.b64decode(salt)
+        expected = base64.b64decode(expected)
+    except ValueError:
+        return False, False
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return hmac.compare_digest(digest, expected), iterations < PASSWORD_HASH_ITERATIONS
+
+async def hash_password_async(password: str) -> str:
+    """在哈希线程池中计算密码哈希"""
+    return await asyncio.get_running_loop().run_in_executor(_executor, hash_password, password)
+
+async def check_password_async(password: str, stored: str) -> Tuple[bool, bool]:
+    """在哈希线程池中校验密码"""
+    return await asyncio.get_running_loop().run_in_executor(_executor, check_password, password, stored)
@@ -0,0 +1,324 @@
+"""课程提醒压测：用模拟时钟驱动check_reminders走完一段时间，邮件发到本地SMTP服务
+
+生成一批用户和课表，从--start（本地时间0点）开始每--tick秒调用一次check_reminders，
+每次等发件箱投递完再推进时钟。结束后输出每次检查的耗时分位数、每秒发送的邮件数和峰值内存；
+检查耗时的p99超过--max-tick-p99（全部检查）或--max-busy-tick-p99（有提醒发出的检查），
+或者有课程没有收到提醒、有消息进入死信时，以非0状态退出。
+
+    python reminder_bench.py                                  # 1000个用户，每人20门课，一周
+    python reminder_bench.py --users 100000 --courses 20      # 大规模
+    python reminder_bench.py --digest --duplicates 0.2 --max-busy-tick-p99 50
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from data_store import REMINDER_LEAD, REMINDER_TIMEZONE, WEEKDAY_INDEX, WEEKDAY_NAMES, DataStore, next_course_start
+
+# 课表生成用的数据：每天6个时间段，周一到周五
+COURSE_SLOTS = [("08:00", "09:35"), ("09:55", "11:30"), ("13:30", "15:05"),
+                ("15:25", "17:00"), ("18:30", "20:05"), ("20:15", "21:50")]
+COURSE_DAYS = WEEKDAY_NAMES[:5]
+COURSE_NAMES = ["高等数学", "大学英语", "大学物理", "有机化学", "计算机基础", "中国近代史",
+                "线性代数", "概率论", "体育", "音乐鉴赏", "微观经济学", "心理学导论"]
+COURSE_BUILDINGS = ["教一", "教二", "实验楼", "体育馆", "图书馆"]
+
+class SimulatedClock:
+    """可以手动推进的时钟，传给DataStore、Outbox等的clock参数"""
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """只接收不投递的本地SMTP服务，统计会话数、登录数、邮件数和字节数
+
+    delay为每封邮件DATA之后的等待秒数，用来模拟远端服务器的处理时间；greeting_delay为
+    连接建立后发送欢迎语之前的等待秒数，模拟建立连接的网络往返。给出ssl_context时
+    以隐式TLS（SMTP_SSL）提供服务。reject中的收件人在RCPT时返回550。
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, delay: float = 0.0, greeting_delay: float = 0.0, ssl_context=None, reject=()):
+        super().__init__(("127.0.0.1", 0), SMTPSinkHandler)
+        self.delay = delay
+        self.greeting_delay = greeting_delay
+        self.ssl_context = ssl_context
+        self.reject = set(reject)
+        self.lock = threading.Lock()
+        self.stats = {"sessions": 0, "logins": 0, "messages": 0, "rejected": 0, "bytes": 0}
+        self.connections = set()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def count(self, key: str, amount: int = 1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def get_request(self):
+        sock, address = super().get_request()
+        # 响应都很短，关闭Nagle算法，避免和客户端的延迟ACK叠加出约40ms的等待
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.ssl_context is not None:
+            # 握手放到处理线程中进行，不阻塞接受新连接
+            sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, address
+
+    def drop_connections(self):
+        """断开所有当前连接，模拟服务器重启或空闲超时断开"""
+        with self.lock:
+            connections = list(self.connections)
+        for sock in connections:
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: bytes):
+        self.wfile.write(line + b"\r\n")
+
+    def handle(self):
+        sink = self.server
+        if sink.ssl_context is not None:
+            self.request.do_handshake()
+        with sink.lock:
+            sink.connections.add(self.request)
+        try:
+            if sink.greeting_delay:
+                time.sleep(sink.greeting_delay)
+            self.converse(sink)
+        except OSError:
+            pass  # 连接被drop_connections断开
+        finally:
+            with sink.lock:
+                sink.connections.discard(self.request)
+
+    def converse(self, sink: SMTPSink):
+        self.reply(b"220 sink")
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                sink.count("sessions")
+                self.reply(b"250-sink")
+                self.reply(b"250 AUTH PLAIN")
+            elif command == b"AUTH":
+                # 任何用户名密码都接受
+                sink.count("logins")
+                self.reply(b"235 authenticated")
+            elif command == b"RCPT":
+                address = line[line.find(b"<") + 1:line.rfind(b">")].decode("utf-8", "replace")
+                if address in sink.reject:
+                    sink.count("rejected")
+                    self.reply(b"550 no such user")
+                else:
+                    self.reply(b"250 OK")
+            elif command == b"DATA":
+                self.reply(b"354 end with .")
+                size = 0
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+                if sink.delay:
+                    time.sleep(sink.delay)
+                sink.count("messages")
+                sink.count("bytes", size)
+                self.reply(b"250 OK")
+            elif command == b"QUIT":
+                self.reply(b"221 bye")
+                return
+            else:
+                self.reply(b"250 OK")
+
+def generate_population(store, users: int, courses: int, duplicates: float, seed: int,
+                        start: float, end: float) -> int:
+    """生成用户和课表，返回在[start, end]内应当收到提醒的课程数
+
+    每个用户从周一到周五的30个时间段中选courses个（超过30个时允许重复）；
+    duplicates为重复导入的比例，这部分课程会在课表中出现两次。
+    """
+    rng = random.Random(seed)
+    slots = [(day, start_time, end_time) for day in COURSE_DAYS for start_time, end_time in COURSE_SLOTS]
+    expected = 0
+    for number in range(users):
+        email = f"student{number}@bench.test"
+        store.add_user(email, f"学生{number}", "bench")
+        chosen = rng.sample(slots, courses) if courses <= len(slots) else rng.choices(slots, k=courses)
+        entries = []
+        for day, start_time, end_time in chosen:
+            course = {"course_name": rng.choice(COURSE_NAMES), "day_of_week": day, "start_time": start_time,
+                      "end_time": end_time, "location": f"{rng.choice(COURSE_BUILDINGS)}-{rng.randint(101, 520)}"}
+            copies = 2 if rng.random() < duplicates else 1
+            entries.extend(dict(course) for _ in range(copies))
+            if next_course_start(WEEKDAY_INDEX[day], start_time, start) - REMINDER_LEAD <= end:
+                expected += copies
+        store.add_timetable(email, entries)
+    return expected
+
+def count_reminded(store, users: int) -> int:
+    """已经记录了last_reminder的课程数"""
+    return sum(1 for number in range(users)
+               for course in store.get_timetable(f"student{number}@bench.test") if course["last_reminder"])
+
+def percentile(values, q: float) -> float:
+    """最近秩法计算分位数，values已排序"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(len(values) * q + 0.5) - 1))]
+
+def peak_memory_mb() -> float:
+    if resource is None:
+        return 0.0
+    # Linux上ru_maxrss的单位是KB，macOS上是字节
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def tick_summary(durations) -> dict:
+    durations = sorted(durations)
+    return {
+        "count": len(durations),
+        "p50_ms": percentile(durations, 0.50) * 1000,
+        "p95_ms": percentile(durations, 0.95) * 1000,
+        "p99_ms": percentile(durations, 0.99) * 1000,
+        "max_ms": (durations[-1] if durations else 0.0) * 1000,
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="课程提醒压测（模拟时钟 + 本地SMTP服务）")
+    parser.add_argument("--users", type=int, default=1000, help="用户数")
+    parser.add_argument("--courses", type=int, default=20, help="每个用户的课程数")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="重复导入的课程比例")
+    parser.add_argument("--days", type=float, default=7, help="模拟的天数")
+    parser.add_argument("--start", default="2024-09-02", help="模拟开始的日期（本地时间0点）")
+    parser.add_argument("--tick", type=float, default=60, help="两次检查之间的模拟秒数")
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory", help="数据存储")
+    parser.add_argument("--digest", action="store_true", help="开启合并提醒（REMINDER_DIGEST=1）")
+    parser.add_argument("--workers", type=int, default=4, help="投递线程数")
+    parser.add_argument("--smtp-delay", type=float, default=0.0, help="SMTP服务每封邮件的处理秒数")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    parser.add_argument("--max-tick-p99", type=float, default=None, help="全部检查耗时p99的上限（毫秒），超过时返回1")
+    parser.add_argument("--max-busy-tick-p99", type=float, default=None,
+                        help="有提醒的检查耗时p99的上限（毫秒），超过时返回1")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.smtp_delay)
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    workdir = tempfile.mkdtemp(prefix="reminder-bench-")
+    # server在导入时读取这些配置：邮件发到本地SMTP服务，发件箱放在临时目录，不限速
+    os.environ.update({
+        "SMTP_HOST": "127.0.0.1", "SMTP_PORT": str(sink.port), "SMTP_SSL": "0", "SMTP_USER": "",
+        "OUTBOX_PATH": os.path.join(workdir, "outbox.db"), "OUTBOX_WORKERS": str(args.workers),
+        "OUTBOX_DEFAULT_RATE": "0", "OUTBOX_RATE_LIMITS": "",
+        "REMINDER_DIGEST": "1" if args.digest else "0", "DATA_STORE_BACKEND": "memory",
+    })
+    import server
+
+    start = REMINDER_TIMEZONE.localize(datetime.strptime(args.start, "%Y-%m-%d")).timestamp()
+    end = start + args.days * 86400
+    clock = SimulatedClock(start)
+    if args.backend == "sqlite":
+        from sqlite_store import SQLiteDataStore
+        store = SQLiteDataStore(os.path.join(workdir, "bench.db"), clock=clock)
+    else:
+        store = DataStore(clock=clock)
+    server.data_store = store
+    server.outbox.clock = clock
+
+    began = time.perf_counter()
+    expected = generate_population(store, args.users, args.courses, args.duplicates, args.seed, start, end)
+    build_seconds = time.perf_counter() - began
+    build_memory = peak_memory_mb()
+
+    tick_durations = []
+    busy_durations = []
+    drain_seconds = 0.0
+    dispatcher = server.outbox_dispatcher
+    # 每封邮件都会打印一行，压测时丢弃
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        dispatcher.start()
+        ticks = int(args.days * 86400 // args.tick)
+        for number in range(ticks + 1):
+            clock.now = start + number * args.tick
+            before = sink.stats["messages"]
+            began = time.perf_counter()
+            server.check_reminders()
+            elapsed = time.perf_counter() - began
+            tick_durations.append(elapsed)
+            began = time.perf_counter()
+            while server.outbox.backlog():
+                time.sleep(0.002)
+            if sink.stats["messages"] > before:
+                busy_durations.append(elapsed)
+                drain_seconds += time.perf_counter() - began
+        dispatcher.stop()
+    server.mail_pool.close()
+
+    reminded = count_reminded(store, args.users)
+    counts = server.outbox.counts()
+    result = {
+        "users": args.users,
+        "courses": args.users * args.courses,
+        "days": args.days,
+        "backend": args.backend,
+        "digest": args.digest,
+        "build_seconds": build_seconds,
+        "ticks": tick_summary(tick_durations),
+        "busy_ticks": tick_summary(busy_durations),
+        "emails": sink.stats["messages"],
+        "smtp_sessions": sink.stats["sessions"],
+        "email_bytes": sink.stats["bytes"],
+        "emails_per_second": sink.stats["messages"] / drain_seconds if drain_seconds else 0.0,
+        "reminders_expected": expected,
+        "reminders_marked": reminded,
+        "outbox": counts,
+        "build_memory_mb": build_memory,
+        "peak_memory_mb": peak_memory_mb(),
+    }
+    failures = []
+    for name, label, limit in (("ticks", "全部检查", args.max_tick_p99), ("busy_ticks", "有提醒的检查", args.max_busy_tick_p99)):
+        if limit is not None and result[name]["p99_ms"] > limit:
+            failures.append(f"{label}耗时p99 {result[name]['p99_ms']:.2f}ms 超过上限 {limit}ms")
+    if reminded < expected:
+        failures.append(f"{expected - reminded} 门课程没有收到提醒")
+    if counts.get("dead"):
+        failures.append(f"{counts['dead']} 条消息进入死信")
+    result["failures"] = failures
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        print(f"用户 {args.users}，课程 {result['courses']}，模拟 {args.days} 天，存储 {args.backend}，"
+              f"合并提醒 {'开' if args.digest else '关'}")
+        print(f"生成数据 {build_seconds:.1f}s，内存 {build_memory:.0f}MB")
+        for name, label in (("ticks", "全部检查"), ("busy_ticks", "有提醒的检查")):
+            summary = result[name]
+            print(f"{label} {summary['count']} 次：p50 {summary['p50_ms']:.2f}ms  p95 {summary['p95_ms']:.2f}ms  "
+                  f"p99 {summary['p99_ms']:.2f}ms  max {summary['max_ms']:.2f}ms")
+        print(f"邮件 {result['emails']} 封（SMTP会话 {result['smtp_sessions']} 个，{result['email_bytes'] / 1e6:.1f}MB），"
+              f"投递 {result['emails_per_second']:.0f} 封/秒")
+        print(f"提醒课程 {reminded}/{expected}，发件箱 {counts}")
+        print(f"峰值内存 {result['peak_memory_mb']:.0f}MB")
+        for failure in failures:
+            print(f"❌ {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,430 @@
+import base64
+import functools
+import html
+import re
+import secrets
+from datetime import datetime
+from email.header import Header
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pytz import timezone
+
+# 模板中的字段写作 {{字段名}}，其余内容（包括CSS的花括号）原样输出
+SLOT_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+
+class Template:
+    """编译后的模板：静态片段和字段名交替保存，渲染时只做一次字符串拼接
+
+    bind填入一部分字段后得到新模板，相邻的静态片段合并，之后只需要填剩下的字段。
+    raw中的字段原样填入，不经过escape（用于填入已经渲染好的模板片段）。
+    """
+    def __init__(self, source: str, escape: Callable[[str], str] = str, raw: Tuple[str, ...] = ()):
+        parts = SLOT_PATTERN.split(source)
+        self.literals: List[str] = parts[0::2]
+        self.slots: List[str] = parts[1::2]
+        self.escape = escape
+        self.raw = raw
+
+    def _value(self, slot: str, value) -> str:
+        return str(value) if slot in self.raw else self.escape(str(value))
+
+    def bind(self, **values) -> "Template":
+        bound = Template("", self.escape, self.raw)
+        literals = [self.literals[0]]
+        slots = []
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            if slot in values:
+                literals[-1] += self._value(slot, values[slot]) + literal
+            else:
+                slots.append(slot)
+                literals.append(literal)
+        bound.literals = literals
+        bound.slots = slots
+        return bound
+
+    def render(self, **values) -> str:
+        pieces = [self.literals[0]]
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            pieces.append(self._value(slot, values[slot]))
+            pieces.append(literal)
+        return "".join(pieces)
+
+def escape_html(value: str) -> str:
+    return html.escape(value, quote=False)
+
+# HTML邮件模板，分为三段：开头（样式和问候）、一门课程的信息、结尾（提示和页脚）；
+# 合并提醒在开头和结尾之间放多门课程
+_HTML_HEAD = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <style>
+            body {
+                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
+                line-height: 1.6;
+                color: #333;
+                max-width: 600px;
+                margin: 0 auto;
+                background-color: #f5f5f5;
+            }
+            .container {
+                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                padding: 0;
+                border-radius: 10px;
+                box-shadow: 0 10px 25px rgba(0,0,0,0.1);
+                overflow: hidden;
+            }
+            .header {
+                background: rgba(255,255,255,0.1);
+                color: white;
+                padding: 30px 20px;
+                text-align: center;
+                border-bottom: 1px solid rgba(255,255,255,0.2);
+            }
+            .header h1 {
+                margin: 0;
+                font-size: 28px;
+                font-weight: 300;
+            }
+            .content {
+                background: white;
+                padding: 30px;
+            }
+            .alert-box {
+                background: linear-gradient(135deg, #ff6b6b, #ee5a24);
+                color: white;
+                padding: 20px;
+                border-radius: 8px;
+                text-align: center;
+                margin-bottom: 25px;
+                font-size: 18px;
+                font-weight: bold;
+            }
+            .course-info {
+                background: #f8f9fa;
+                border-left: 4px solid #667eea;
+                padding: 20px;
+                margin: 20px 0;
+                border-radius: 0 8px 8px 0;
+            }
+            .info-row {
+                display: flex;
+                justify-content: space-between;
+                align-items: center;
+                padding: 8px 0;
+                border-bottom: 1px solid #eee;
+            }
+            .info-row:last-child {
+                border-bottom: none;
+            }
+            .info-label {
+                font-weight: 600;
+                color: #666;
+                min-width: 80px;
+            }
+            .info-value {
+                color: #333;
+                font-weight: 500;
+            }
+            .countdown {
+                background: linear-gradient(135deg, #ffeaa7, #fdcb6e);
+                color: #2d3436;
+                padding: 15px;
+                border-radius: 8px;
+                text-align: center;
+                margin: 20px 0;
+                font-size: 16px;
+                font-weight: bold;
+            }
+            .tips {
+                background: #e8f4fd;
+                border: 1px solid #bee5eb;
+                border-radius: 8px;
+                padding: 15px;
+                margin: 20px 0;
+            }
+            .tips h3 {
+                color: #0c5460;
+                margin-top: 0;
+                font-size: 16px;
+            }
+            .tips ul {
+                margin: 10px 0;
+                padding-left: 20px;
+            }
+            .tips li {
+                margin: 5px 0;
+                color: #155724;
+            }
+            .footer {
+                background: #f8f9fa;
+                padding: 20px;
+                text-align: center;
+                color: #666;
+                font-size: 14px;
+                border-top: 1px solid #eee;
+            }
+            .emoji {
+                font-size: 24px;
+                margin-right: 10px;
+            }
+            .highlight {
+                color: #667eea;
+                font-weight: bold;
+            }
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <div class="header">
+                <h1>{{icon}} {{greeting}}，{{user_name}}！</h1>
+                <p>您的课程提醒到啦</p>
+            </div>
+            
+            <div class="content">
+"""
+
+_HTML_COURSE = """                <div class="alert-box">
+                    ⏰ 距离上课还有 <span class="highlight">{{minutes_left}}</span> 分钟
+                </div>
+                
+                <div class="course-info">
+                    <div class="info-row">
+                        <span class="info-label">{{course_icon}} 课程</span>
+                        <span class="info-value">{{course_name}}</span>
+                    </div>
+                    <div class="info-row">
+                        <span class="info-label">📅 时间</span>
+                        <span class="info-value">{{day_of_week}} {{start_time}} - {{end_time}}</span>
+                    </div>
+                    <div class="info-row">
+                        <span class="info-label">📍 地点</span>
+                        <span class="info-value">{{location}}</span>
+                    </div>
+                    <div class="info-row">
+                        <span class="info-label">⏱️ 时段</span>
+                        <span class="info-value">{{period}}课程</span>
+                    </div>
+                </div>
+                
+"""
+
+_HTML_FOOT = """                <div class="countdown">
+                    🏃‍♀️ 建议现在开始准备出发！
+                </div>
+                
+                <div class="tips">
+                    <h3>📝 温馨提示：</h3>
+                    <ul>
+                        <li>🎒 请检查是否携带了相关课本和学习用品</li>
+                        <li>🚗 考虑当前交通状况，合理规划出行路线</li>
+                        <li>☔ 留意天气变化，必要时携带雨具</li>
+                        <li>🔋 确保手机电量充足，以备不时之需</li>
+                        <li>💧 记得携带水杯，保持水分充足</li>
+                    </ul>
+                </div>
+                
+                <div style="background: #fff3cd; border: 1px solid #ffeaa7; border-radius: 8px; padding: 15px; margin: 20px 0;">
+                    <strong>🎯 今日目标：</strong> 准时到达，积极参与，收获满满！
+                </div>
+            </div>
+            
+            <div class="footer">
+                <p>📧 这是一封自动发送的课程提醒邮件</p>
+                <p>🕐 发送时间：{{sent_at}}</p>
+                <p>💝 祝您学习愉快，天天进步！</p>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+
+REMINDER_HTML = Template(_HTML_HEAD + _HTML_COURSE + _HTML_FOOT, escape=escape_html)
+DIGEST_COURSE_HTML = Template(_HTML_COURSE, escape=escape_html)
+DIGEST_HTML = Template(_HTML_HEAD + "{{courses}}" + _HTML_FOOT, escape=escape_html, raw=("courses",))
+
+# 纯文本内容（作为备用）
+_TEXT_HEAD = """
+{{greeting}}，{{user_name}}！
+
+【课程提醒】
+"""
+
+_TEXT_COURSE = """距离上课还有 {{minutes_left}} 分钟
+
+课程信息：
+- 课程：{{course_name}}
+- 时间：{{day_of_week}} {{start_time}} - {{end_time}}
+- 地点：{{location}}
+- 时段：{{period}}课程
+
+"""
+
+_TEXT_FOOT = """温馨提示：
+- 请检查是否携带了相关课本和学习用品
+- 考虑当前交通状况，合理规划出行路线
+- 留意天气变化，必要时携带雨具
+- 确保手机电量充足，以备不时之需
+- 记得携带水杯，保持水分充足
+
+今日目标：准时到达，积极参与，收获满满！
+
+发送时间：{{sent_at}}
+祝您学习愉快，天天进步！
+    """
+
+REMINDER_TEXT = Template(_TEXT_HEAD + _TEXT_COURSE + _TEXT_FOOT)
+DIGEST_COURSE_TEXT = Template(_TEXT_COURSE)
+DIGEST_TEXT = Template(_TEXT_HEAD + "{{courses}}" + _TEXT_FOOT)
+
+# 课程类型图标映射
+COURSE_ICONS = {
+    '数学': '🔢', '高数': '🔢', 'math': '🔢',
+    '英语': '🔤', 'english': '🔤',
+    '物理': '⚛️', 'physics': '⚛️',
+    '化学': '🧪', 'chemistry': '🧪',
+    '生物': '🧬', 'biology': '🧬',
+    '历史': '📜', 'history': '📜',
+    '地理': '🌍', 'geography': '🌍',
+    '政治': '🏛️', 'politics': '🏛️',
+    '语文': '📚', '中文': '📚',
+    '计算机': '💻', '编程': '💻', 'computer': '💻',
+    '体育': '⚽', 'sports': '⚽', '运动': '⚽',
+    '音乐': '🎵', 'music': '🎵',
+    '美术': '🎨', 'art': '🎨',
+    '经济': '💰', 'economics': '💰',
+    '管理': '📊', 'management': '📊',
+    '心理': '🧠', 'psychology': '🧠',
+    '医学': '⚕️', 'medicine': '⚕️',
+    '法律': '⚖️', 'law': '⚖️',
+    '实验': '🔬', 'lab': '🔬',
+}
+
+@functools.lru_cache(maxsize=4096)
+def get_course_icon(course_name: str) -> str:
+    """根据课程名称返回相应的图标（按课程名缓存）"""
+    course_name_lower = course_name.lower()
+    for keyword, icon in COURSE_ICONS.items():
+        if keyword in course_name_lower:
+            return icon
+    # 默认图标
+    return '📖'
+
+@functools.lru_cache(maxsize=1024)
+def _parse_time(start_time: str):
+    return datetime.strptime(start_time, "%H:%M").time()
+
+def reminder_fields(course: dict, now: Optional[datetime] = None) -> Dict[str, object]:
+    """计算邮件中除称呼以外的所有字段"""
+    now = now or datetime.now(timezone('Asia/Shanghai'))
+    course_time = _parse_time(course['start_time'])
+    # 计算剩余时间
+    time_diff = datetime.combine(now.date(), course_time) - now.replace(tzinfo=None)
+    # 根据课程时间段判断上课性质
+    hour = course_time.hour
+    if 8 <= hour < 12:
+        period, greeting, icon = "上午", "早上好", "🌅"
+    elif 12 <= hour < 18:
+        period, greeting, icon = "下午", "下午好", "☀️"
+    else:
+        period, greeting, icon = "晚上", "晚上好", "🌙"
+    return {
+        "icon": icon,
+        "greeting": greeting,
+        "period": period,
+        "minutes_left": int(time_diff.total_seconds() / 60),
+        "course_icon": get_course_icon(course['course_name']),
+        "course_name": course['course_name'],
+        "day_of_week": course['day_of_week'],
+        "start_time": course['start_time'],
+        "end_time": course['end_time'],
+        "location": course['location'],
+        "sent_at": now.strftime('%Y年%m月%d日 %H:%M'),
+    }
+
+def _encode_body(content: str) -> bytes:
+    """base64编码，每行76个字符（与email包的输出相同）"""
+    encoded = base64.b64encode(content.encode("utf-8"))
+    return b"\r\n".join([encoded[i:i + 76] for i in range(0, len(encoded), 76)]) + b"\r\n"
+
+def _encode_header(value: str) -> str:
+    return value if value.isascii() else Header(value, "utf-8").encode(linesep="\r\n")
+
+class PreparedMessage:
+    """除收件地址和称呼外都已生成好的邮件
+
+    html和text是只剩user_name一个字段的模板，邮件主题和各MIME部分的头只生成一次，
+    每个收件人只需填入称呼和收件地址，再做一次base64编码。
+    """
+    def __init__(self, sender: str, subject: str, html: Template, text: Template):
+        self.html = html
+        self.text = text
+        boundary = "=" * 15 + secrets.token_hex(10) + "=="
+        self.head = (
+            f'Content-Type: multipart/alternative; boundary="{boundary}"\r\n'
+            f"MIME-Version: 1.0\r\n"
+            f"Subject: {_encode_header(subject)}\r\n"
+            f"From: {sender}\r\n"
+            f"To: "
+        ).encode("utf-8")
+        part_head = ('\r\n--{boundary}\r\nContent-Type: text/{subtype}; charset="utf-8"\r\n'
+                     'MIME-Version: 1.0\r\nContent-Transfer-Encoding: base64\r\n\r\n')
+        self.text_head = ("\r\n" + part_head.format(boundary=boundary, subtype="plain")).encode("ascii")
+        self.html_head = part_head.format(boundary=boundary, subtype="html").encode("ascii")
+        self.tail = f"\r\n--{boundary}--\r\n".encode("ascii")
+
+    def render(self, to_email: str, user_name: str) -> bytes:
+        """返回可以直接交给SMTP DATA命令的完整邮件"""
+        return b"".join((
+            self.head, _encode_header(to_email).encode("utf-8"), self.text_head,
+            _encode_body(self.text.render(user_name=user_name)), self.html_head,
+            _encode_body(self.html.render(user_name=user_name)), self.tail,
+        ))
+
+class SlotMessage(PreparedMessage):
+    """同一时间段同一门课的提醒邮件，所有收件人共用"""
+    def __init__(self, sender: str, fields: Dict[str, object]):
+        super().__init__(sender, f"📚 课程提醒：{fields['course_name']} ({fields['start_time']})",
+                         REMINDER_HTML.bind(**fields), REMINDER_TEXT.bind(**fields))
+
+@functools.lru_cache(maxsize=256)
+def _slot_message(sender: str, fields: Tuple[Tuple[str, object], ...]) -> SlotMessage:
+    return SlotMessage(sender, dict(fields))
+
+def reminder_message(sender: str, to_email: str, course: dict, user_name: str = "同学",
+                     now: Optional[datetime] = None) -> bytes:
+    """生成一封提醒邮件；同一时间段同一门课的收件人共用缓存的SlotMessage"""
+    fields = reminder_fields(course, now)
+    return _slot_message(sender, tuple(fields.items())).render(to_email, user_name)
+
+
+@functools.lru_cache(maxsize=1024)
+def _digest_course(fields: Tuple[Tuple[str, object], ...]) -> Tuple[str, str]:
+    """合并提醒中一门课程的HTML和文本片段，同一时间段同一门课的所有收件人共用"""
+    values = dict(fields)
+    return DIGEST_COURSE_HTML.render(**values), DIGEST_COURSE_TEXT.render(**values)
+
+def digest_message(sender: str, to_email: str, courses: List[dict], user_name: str = "同学",
+                   now: Optional[datetime] = None) -> bytes:
+    """把一个用户同时到期的多门课程合并成一封邮件，按上课时间排序
+
+    重复导入的相同课程（课程名、时间、地点都相同）只列一次；只剩一门课时与reminder_message相同。
+    """
+    unique = {}
+    for course in sorted(courses, key=lambda course: course['start_time']):
+        fields = reminder_fields(course, now)
+        identity = (fields['course_name'], fields['day_of_week'], fields['start_time'], fields['end_time'], fields['location'])
+        unique.setdefault(identity, fields)
+    items = list(unique.values())
+    if len(items) == 1:
+        return _slot_message(sender, tuple(items[0].items())).render(to_email, user_name)
+    parts = [_digest_course(tuple(fields.items())) for fields in items]
+    first = items[0]
+    header = {key: first[key] for key in ("icon", "greeting", "sent_at")}
+    subject = f"📚 课程提醒：{first['course_name']} 等{len(items)}门课程 ({first['start_time']})"
+    return PreparedMessage(
+        sender, subject,
+        DIGEST_HTML.bind(courses="".join(part[0] for part in parts), **header),
+        DIGEST_TEXT.bind(courses="".join(part[1] for part in parts), **header),
+    ).render(to_email, user_name)
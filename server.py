@@ -1,19 +1,32 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException ,UploadFile, File, Form
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException ,UploadFile, File, Form, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from typing import Callable, Dict, List, Literal, Optional, Set, Tuple, Union
 from datetime import datetime, timedelta
 from pytz import timezone
 import json
-from data_store import data_store, User
+import asyncio
+import os
+import time
+import struct
+import hashlib
+from collections import OrderedDict
+from data_store import data_store, User, COURSE_FIELDS, REMINDER_TIMEZONE, iso_date, VIDEO_LEASE_TTL, WEEKDAY_INDEX
+from message_bus import BUS_DIR, create_bus
+from passwords import check_password_async, hash_password_async
+from mailer import SMTPPool, is_permanent_error
+from outbox import Outbox, OutboxDispatcher
+from reminder_email import digest_message, reminder_message
 from pydantic import BaseModel,field_validator
 import csv
 from io import StringIO
 from apscheduler.schedulers.background import BackgroundScheduler
-import smtplib
 from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from pydantic import BaseModel, EmailStr, field_validator
 import re
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只能单进程运行
+    fcntl = None
 
 # 定义请求模型
 class UserLogin(BaseModel):
@@ -36,43 +49,271 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 聊天推送配置
+CHAT_SEND_QUEUE_SIZE = 256          # 每个连接待发送队列的上限
+CHAT_SLOW_CONSUMER_POLICY = "drop"  # 队列已满时的策略: "drop" 丢弃该连接的这条消息, "evict" 断开该连接
+DEFAULT_ROOM = "lobby"              # 所有连接默认加入的公共聊天室
+COURSE_ROOM_PREFIX = "course:"      # 课程聊天室: "course:<课程名>"
+PRESENCE_ROOM = "presence"          # 视频在线用户推送频道（只推送，不能发聊天消息）
+CHAT_HEARTBEAT_INTERVAL = 20        # 连接空闲超过该秒数后服务器发送ping
+CHAT_IDLE_TIMEOUT = 60              # 超过该秒数没有收到任何消息（包括pong）则视为死连接并清理
+CHAT_CLOSE_TIMEOUT = 5              # 关闭死连接时最多等待的秒数
+PING_FRAME = json.dumps({"type": "ping"})
+PONG_FRAME = json.dumps({"type": "pong"})
+
+# 聊天消息的传输格式，按连接协商（查询参数 encoding=binary 或子协议 chat.binary），默认JSON
+CHAT_ENCODINGS = ("json", "binary")
+CHAT_SUBPROTOCOLS = {"chat.json": "json", "chat.binary": "binary"}
+# 紧凑二进制格式（网络字节序）：
+#   类型(u8)=1 | 序号(u32) | 时间,当天分钟数(u16) | 聊天室长度(u16) | 用户名长度(u16) | 内容长度(u32)
+#   之后依次是UTF-8编码的聊天室、用户名、内容；不包含固定的头像地址和isSelf字段
+CHAT_BINARY_HEADER = struct.Struct("!BIHHHI")
+CHAT_BINARY_TYPE_MESSAGE = 1
+
+Frame = Union[str, bytes]
+
+def chat_payload(seq: int, room: str, username: str, content: str, sent_time: str) -> dict:
+    """发给客户端的聊天消息；JSON格式原样发送，二进制格式只取其中的seq、room、username、content、time"""
+    return {
+        "seq": seq,
+        "room": room,
+        "username": username,
+        "content": content,
+        "time": sent_time,
+        "avatar": "https://via.placeholder.com/30",
+        "isSelf": False
+    }
+
+def encode_chat_frame(payload: dict, encoding: str) -> Frame:
+    """把一条聊天消息编码为指定格式的帧"""
+    if encoding == "binary":
+        room = payload["room"].encode("utf-8")
+        username = payload["username"].encode("utf-8")
+        content = payload["content"].encode("utf-8")
+        hour, minute = payload["time"].split(":")
+        header = CHAT_BINARY_HEADER.pack(
+            CHAT_BINARY_TYPE_MESSAGE, payload["seq"], int(hour) * 60 + int(minute),
+            len(room), len(username), len(content)
+        )
+        return b"".join((header, room, username, content))
+    return json.dumps(payload)
+
+class ClientConnection:
+    """单个WebSocket连接，拥有独立的发送队列和写任务"""
+    def __init__(self, websocket: WebSocket, user_email: str, queue_size: int, encoding: str = "json"):
+        self.websocket = websocket
+        self.user_email = user_email
+        self.encoding = encoding
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.writer_task: Optional[asyncio.Task] = None
+        self.rooms: Set[str] = set()
+        self.last_seen = time.monotonic()  # 最近一次收到客户端消息的时间
+
+    def enqueue(self, message: Frame) -> bool:
+        """非阻塞入队，队列已满时返回False"""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
 # 存储WebSocket连接
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.user_connections: dict = {}  # 存储用户邮箱和对应的websocket连接
-
-    async def connect(self, websocket: WebSocket, user_email: str):
-        await websocket.accept()
-        # 如果用户已经有连接，先断开旧连接
-        if user_email in self.user_connections:
-            old_websocket = self.user_connections[user_email]
-            await old_websocket.close()
-            self.active_connections.remove(old_websocket)
-        
-        self.active_connections.append(websocket)
-        self.user_connections[user_email] = websocket
+    """双向索引的连接注册表: websocket -> 连接, 用户邮箱 -> 该用户的全部连接
+
+    注册和注销都是O(1)，同一用户可以同时有多个连接（例如多个标签页）。
+    每个聊天室维护自己的订阅者集合，发布消息只遍历该聊天室的订阅者。
+    """
+    def __init__(self, queue_size: int = CHAT_SEND_QUEUE_SIZE, policy: str = CHAT_SLOW_CONSUMER_POLICY,
+                 heartbeat_interval: float = CHAT_HEARTBEAT_INTERVAL, idle_timeout: float = CHAT_IDLE_TIMEOUT):
+        self.queue_size = queue_size
+        self.policy = policy
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        self.user_connections: Dict[str, Dict[WebSocket, ClientConnection]] = {}
+        self.rooms: Dict[str, Dict[WebSocket, ClientConnection]] = {}
+        self.stats = {"dropped": 0, "evicted": 0, "send_errors": 0, "pings": 0, "reaped": 0}
+        # 用户第一个连接建立/最后一个连接断开时回调 (邮箱, 是否在线)
+        self.on_presence: Optional[Callable[[str, bool], None]] = None
+
+    async def connect(self, websocket: WebSocket, user_email: str, encoding: str = "json",
+                      subprotocol: Optional[str] = None) -> ClientConnection:
+        await websocket.accept(subprotocol=subprotocol)
+        conn = ClientConnection(websocket, user_email, self.queue_size, encoding)
+        conn.writer_task = asyncio.create_task(self._writer(conn))
+        self.active_connections[websocket] = conn
+        sockets = self.user_connections.setdefault(user_email, {})
+        sockets[websocket] = conn
+        if len(sockets) == 1 and self.on_presence is not None:
+            self.on_presence(user_email, True)
+        return conn
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        conn = self.active_connections.pop(websocket, None)
+        if conn is None:
+            return
         # 清理用户连接记录
-        for email, ws in list(self.user_connections.items()):
-            if ws == websocket:
-                del self.user_connections[email]
-                break
+        sockets = self.user_connections.get(conn.user_email)
+        if sockets is not None:
+            sockets.pop(websocket, None)
+            if not sockets:
+                del self.user_connections[conn.user_email]
+                if self.on_presence is not None:
+                    self.on_presence(conn.user_email, False)
+        for room in list(conn.rooms):
+            self.leave(websocket, room)
+        # 停止写任务（写任务自身出错时不能取消自己）
+        if conn.writer_task and conn.writer_task is not asyncio.current_task():
+            conn.writer_task.cancel()
+
+    def get_user_connections(self, user_email: str) -> List[ClientConnection]:
+        return list(self.user_connections.get(user_email, {}).values())
+
+    def join(self, websocket: WebSocket, room: str) -> bool:
+        conn = self.active_connections.get(websocket)
+        if conn is None:
+            return False
+        self.rooms.setdefault(room, {})[websocket] = conn
+        conn.rooms.add(room)
+        return True
+
+    def leave(self, websocket: WebSocket, room: str):
+        conn = self.active_connections.get(websocket)
+        if conn is not None:
+            conn.rooms.discard(room)
+        subscribers = self.rooms.get(room)
+        if subscribers is not None:
+            subscribers.pop(websocket, None)
+            if not subscribers:
+                del self.rooms[room]
+
+    async def _writer(self, conn: ClientConnection):
+        """按顺序发送队列中的消息，发送失败只影响当前连接"""
+        try:
+            while True:
+                message = await conn.queue.get()
+                if isinstance(message, bytes):
+                    await conn.websocket.send_bytes(message)
+                else:
+                    await conn.websocket.send_text(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.stats["send_errors"] += 1
+            self.disconnect(conn.websocket)
+            # 注销后也要关闭连接，否则客户端仍然连着却收不到任何消息
+            asyncio.create_task(self._close(conn.websocket, code=1011))
+
+    async def _close(self, websocket: WebSocket, code: int = 1000):
+        try:
+            # 半开连接上的close可能一直等不到回应
+            await asyncio.wait_for(websocket.close(code=code), CHAT_CLOSE_TIMEOUT)
+        except Exception:
+            pass
+
+    def touch(self, websocket: WebSocket):
+        """收到客户端消息时刷新活跃时间"""
+        conn = self.active_connections.get(websocket)
+        if conn is not None:
+            conn.last_seen = time.monotonic()
+
+    def check_heartbeats(self, now: Optional[float] = None) -> int:
+        """向空闲连接发送ping，清理超时未响应的连接，返回本次清理的连接数"""
+        now = time.monotonic() if now is None else now
+        reaped = 0
+        for conn in list(self.active_connections.values()):
+            idle = now - conn.last_seen
+            if idle >= self.idle_timeout:
+                reaped += 1
+                self.disconnect(conn.websocket)
+                asyncio.create_task(self._close(conn.websocket, code=1001))
+            elif idle >= self.heartbeat_interval:
+                self.stats["pings"] += 1
+                conn.enqueue(PING_FRAME)
+        self.stats["reaped"] += reaped
+        return reaped
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+    async def run_reaper(self):
+        """后台任务：定期检查心跳"""
+        interval = max(1.0, min(self.heartbeat_interval, self.idle_timeout) / 2)
+        while True:
+            await asyncio.sleep(interval)
+            self.check_heartbeats()
+
+    def broadcast(self, message: str):
+        """把消息放入每个连接的发送队列，不等待实际发送"""
+        self._deliver(list(self.active_connections.values()), message)
+
+    def publish(self, room: str, message: str):
+        """只把消息放入该聊天室订阅者的发送队列"""
+        subscribers = self.rooms.get(room)
+        if subscribers:
+            self._deliver(list(subscribers.values()), message)
+
+    def publish_chat(self, room: str, payload: dict):
+        """按各连接协商的格式发布聊天消息，每种格式只编码一次，所有接收者共享同一份帧"""
+        subscribers = self.rooms.get(room)
+        if not subscribers:
+            return
+        frames: Dict[str, Optional[Frame]] = {}
+        for conn in list(subscribers.values()):
+            if conn.encoding not in frames:
+                try:
+                    frames[conn.encoding] = encode_chat_frame(payload, conn.encoding)
+                except (AttributeError, TypeError, ValueError, struct.error) as e:
+                    # 某种格式编码失败只跳过使用该格式的连接，不影响其他接收者
+                    print(f"聊天消息编码失败（{conn.encoding}）: {e}")
+                    frames[conn.encoding] = None
+            frame = frames[conn.encoding]
+            if frame is not None:
+                self._enqueue(conn, frame)
+
+    def _deliver(self, connections: List[ClientConnection], message: Frame):
+        for conn in connections:
+            self._enqueue(conn, message)
+
+    def _enqueue(self, conn: ClientConnection, message: Frame):
+        if conn.enqueue(message):
+            return
+        # 慢连接处理
+        if self.policy == "evict":
+            self.stats["evicted"] += 1
+            self.disconnect(conn.websocket)
+            asyncio.create_task(self._close(conn.websocket, code=1013))
+        else:
+            self.stats["dropped"] += 1
 
 manager = ConnectionManager()
 
+# 跨worker事件总线：聊天消息和在线状态通过它转发到所有worker
+bus = create_bus()
+# 其他worker上的在线用户: worker_id -> 用户邮箱集合
+remote_online_users: Dict[str, Set[str]] = {}
+
+def publish_presence(user_email: str, online: bool):
+    bus.publish({"type": "presence", "user": user_email, "online": online})
+
+manager.on_presence = publish_presence
+
+
+async def authenticate(email: str, password: str) -> Optional[User]:
+    """在哈希线程池中校验密码，不阻塞事件循环；明文或迭代次数过低的旧密码校验通过后重新哈希"""
+    user = data_store.get_user(email)
+    if user is None:
+        return None
+    stored = user.password
+    matched, needs_rehash = await check_password_async(password, stored)
+    if not matched:
+        return None
+    if needs_rehash:
+        data_store.rehash_password(email, stored, await hash_password_async(password))
+    return user
 
 # 登录接口
 @app.post("/api/login")
 async def login(login_data: UserLogin):
-    user = data_store.verify_user(login_data.email, login_data.password)
+    user = await authenticate(login_data.email, login_data.password)
     if user:
         return {
             "user": {
@@ -85,10 +326,13 @@ async def login(login_data: UserLogin):
 # 注册接口
 @app.post("/api/register")
 async def register(user_data: UserRegister):
+    # 先检查邮箱，已注册时不必计算哈希
+    if data_store.email_exists(user_data.email):
+        raise HTTPException(status_code=400, detail="邮箱已被注册")
     success = data_store.add_user(
         email=user_data.email,
         username=user_data.username,
-        password=user_data.password
+        password=await hash_password_async(user_data.password)
     )
     if success:
         return {"message": "注册成功"}
@@ -169,12 +413,13 @@ async def update_user_profile(user_update: UserUpdate):
         # 检查是否有任何实际更新
         has_updates = False
         updated_fields = {}
+        current_email = user_update.email
         
         # 更新用户名
         if user_update.new_username is not None and user_update.new_username.strip():
             new_username = user_update.new_username.strip()
             if new_username != user.username:
-                user.username = new_username
+                data_store.update_user(user_update.email, username=new_username)
                 updated_fields['username'] = new_username
                 has_updates = True
         
@@ -187,22 +432,22 @@ async def update_user_profile(user_update: UserUpdate):
                     raise HTTPException(status_code=400, detail="新邮箱已被其他用户使用")
                 
                 # 更新邮箱（需要特殊处理，因为邮箱是主键）
-                old_email = user_update.email
-                user.email = new_email
-                # 在数据存储中更新邮箱键
-                data_store.users[new_email] = data_store.users.pop(old_email)
+                if not data_store.change_user_email(user_update.email, new_email):
+                    raise HTTPException(status_code=400, detail="新邮箱已被其他用户使用")
+                current_email = new_email
                 updated_fields['email'] = new_email
                 has_updates = True
         
         # 更新密码
         if user_update.new_password is not None and user_update.new_password.strip():
-            user.password = user_update.new_password.strip()  # 实际项目中应该加密
+            data_store.update_user(current_email, password=await hash_password_async(user_update.new_password.strip()))
             updated_fields['password'] = '已更新'
             has_updates = True
         
         if not has_updates:
             raise HTTPException(status_code=400, detail="没有检测到任何更改")
         
+        user = data_store.get_user(current_email)
         return {
             "message": "用户信息更新成功",
             "updated_fields": updated_fields,
@@ -225,11 +470,13 @@ async def update_user_profile(user_update: UserUpdate):
 async def verify_password(email: str = Form(...), password: str = Form(...)):
     """验证用户密码"""
     try:
-        user = data_store.verify_user(email, password)
+        user = await authenticate(email, password)
         if user:
             return {"message": "密码验证成功"}
         else:
             raise HTTPException(status_code=401, detail="密码错误")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 # WebSocket连接处理
@@ -239,49 +486,260 @@ async def websocket_endpoint(websocket: WebSocket):
         # 获取连接信息
         params = websocket.query_params
         user_email = params.get("user_email", "anonymous")
+        encoding, subprotocol = negotiate_encoding(websocket)
         
-        await manager.connect(websocket, user_email)
+        await manager.connect(websocket, user_email, encoding, subprotocol)
+        # 默认加入公共聊天室和用户课表中课程对应的聊天室
+        allowed_rooms = {DEFAULT_ROOM} | course_rooms_for(user_email)
+        for room in allowed_rooms:
+            manager.join(websocket, room)
         
         while True:
             data = await websocket.receive_text()
-            message_data = json.loads(data)
+            manager.touch(websocket)
+            try:
+                message_data = json.loads(data)
+            except ValueError:
+                message_data = None
+            # 合法JSON但不是对象（如 [1,2]、"x"、5），或聊天室不是字符串，同样按格式错误处理
+            room = message_data.get("room", DEFAULT_ROOM) if isinstance(message_data, dict) else None
+            if not isinstance(room, str):
+                send_control(websocket, {"type": "error", "detail": "消息格式错误"})
+                continue
+            message_type = message_data.get("type", "message")
+
+            # 心跳
+            if message_type == "pong":
+                continue
+            if message_type == "ping":
+                conn = manager.active_connections.get(websocket)
+                if conn is None:
+                    # 连接已被清理（超时、慢消费者或发送出错），不再处理
+                    break
+                conn.enqueue(PONG_FRAME)
+                continue
+
+            # 加入/离开聊天室
+            if message_type in ("join", "leave"):
+                if message_type == "join":
+                    # 课表变化后可以重新加入新课程的聊天室
+                    allowed_rooms = {DEFAULT_ROOM} | course_rooms_for(user_email)
+                    if room not in allowed_rooms:
+                        send_control(websocket, {"type": "error", "detail": "无权加入该聊天室", "room": room})
+                        continue
+                    manager.join(websocket, room)
+                else:
+                    manager.leave(websocket, room)
+                send_control(websocket, {"type": message_type, "room": room})
+                continue
+
+            # 订阅视频在线用户：先发送一次完整快照，之后只推送加入/离开的增量
+            if message_type in ("subscribe", "unsubscribe"):
+                if message_data.get("channel") != PRESENCE_ROOM:
+                    send_control(websocket, {"type": "error", "detail": "未知的订阅频道"})
+                elif message_type == "subscribe":
+                    manager.join(websocket, PRESENCE_ROOM)
+                    send_control(websocket, {"type": "presence_snapshot", "users": video_user_list()})
+                else:
+                    manager.leave(websocket, PRESENCE_ROOM)
+                continue
+
+            conn = manager.active_connections.get(websocket)
+            if conn is None:
+                break
+            if room == PRESENCE_ROOM or room not in conn.rooms:
+                send_control(websocket, {"type": "error", "detail": "尚未加入该聊天室", "room": room})
+                continue
             
-            # 获取用户信息并存储消息
             username = message_data.get("username", "匿名用户")
             content = message_data.get("content", "")
-            data_store.add_message(username, content)
-            
-            # 构造返回消息
-            response = {
+            if not isinstance(username, str) or not isinstance(content, str):
+                send_control(websocket, {"type": "error", "detail": "消息格式错误"})
+                continue
+
+            # 通过事件总线发布，由每个worker推送给本地订阅者
+            event = {
+                "type": "chat",
+                "room": room,
                 "username": username,
                 "content": content,
-                "time": datetime.now().strftime("%H:%M"),
-                "avatar": "https://via.placeholder.com/30",
-                "isSelf": False
+                "time": datetime.now().strftime("%H:%M")
             }
-            
-            await manager.broadcast(json.dumps(response))
+            if data_store.shared:
+                # 多个worker共享的存储只需写入一次，序号随事件一起转发
+                event["seq"] = data_store.add_message(event["username"], event["content"], room).seq
+            bus.publish(event)
             
     except WebSocketDisconnect:
+        pass
+    finally:
+        # 无论因何退出都要注销连接，避免残留死连接
         manager.disconnect(websocket)
 
-        
+def negotiate_encoding(websocket: WebSocket):
+    """确定连接使用的聊天消息格式，返回(格式, 需要回应的子协议)"""
+    for subprotocol in websocket.scope.get("subprotocols", []):
+        if subprotocol in CHAT_SUBPROTOCOLS:
+            return CHAT_SUBPROTOCOLS[subprotocol], subprotocol
+    encoding = websocket.query_params.get("encoding", "json")
+    if encoding not in CHAT_ENCODINGS:
+        encoding = "json"
+    return encoding, None
+
+def course_rooms_for(user_email: str) -> Set[str]:
+    """根据用户课表得到可加入的课程聊天室"""
+    try:
+        timetable = data_store.get_timetable(user_email)
+    except KeyError:
+        return set()
+    return {COURSE_ROOM_PREFIX + course["course_name"] for course in timetable}
+
+def send_control(websocket: WebSocket, payload: dict):
+    """只发给当前连接的控制消息"""
+    conn = manager.active_connections.get(websocket)
+    if conn is not None:
+        conn.enqueue(json.dumps(payload))
+
+def handle_bus_event(event: dict):
+    """处理事件总线上的事件（包括本worker自己发布的）"""
+    event_type = event.get("type")
+    origin = event.get("origin")
+    if event_type == "chat":
+        # 各worker独立的存储由每个worker各自写入，序号由本worker的聊天记录分配
+        room = event["room"]
+        seq = event.get("seq")
+        if seq is None:
+            seq = data_store.add_message(event["username"], event["content"], room).seq
+        response = chat_payload(seq, room, event["username"], event["content"], event["time"])
+        manager.publish_chat(room, response)
+    elif event_type == "video_presence":
+        apply_video_presence(event)
+    elif origin == bus.worker_id:
+        # 本worker的在线状态直接由manager维护
+        return
+    elif event_type == "presence":
+        users = remote_online_users.setdefault(origin, set())
+        if event["online"]:
+            users.add(event["user"])
+        else:
+            users.discard(event["user"])
+    elif event_type == "presence_sync":
+        # 新启动的worker请求其他worker上报当前在线用户
+        bus.publish({"type": "presence_state", "users": list(manager.user_connections)})
+    elif event_type == "presence_state":
+        remote_online_users[origin] = set(event["users"])
+
+def drop_worker_presence(worker_id: str):
+    """其他worker退出后清除它上报的在线用户"""
+    remote_online_users.pop(worker_id, None)
+
+def get_online_users() -> Set[str]:
+    online = set(manager.user_connections)
+    for users in remote_online_users.values():
+        online |= users
+    return online
+
+@app.get("/api/chat/stats")
+async def get_chat_stats():
+    """本worker的聊天连接统计（慢连接丢弃、心跳清理等计数）"""
+    return {
+        "worker": bus.worker_id,
+        "connections": len(manager.active_connections),
+        "users": len(manager.user_connections),
+        "rooms": len(manager.rooms),
+        "counters": dict(manager.stats),
+        "bus": dict(bus.stats)
+    }
+
+@app.get("/api/chat/online")
+async def get_chat_online_users():
+    """所有worker上当前在线的聊天用户"""
+    users = []
+    for email in sorted(get_online_users()):
+        user = data_store.get_user(email)
+        users.append({"email": email, "username": user.username if user else email})
+    return {"count": len(users), "users": users}
+
+
+# 聊天记录分页接口
+CHAT_HISTORY_MAX_PAGE = 200
+
+@app.get("/api/chat/history")
+async def get_chat_history(before: Optional[int] = None, limit: int = 50, room: str = DEFAULT_ROOM,
+                           email: Optional[str] = None):
+    """按序号倒序分页获取聊天记录，before为上一页返回的游标
+
+    课程聊天室的记录只有课表中有这门课的用户（email）可以查看，与WebSocket加入聊天室的限制相同。
+    """
+    if room != DEFAULT_ROOM and (email is None or room not in course_rooms_for(email)):
+        raise HTTPException(status_code=403, detail="无权查看该聊天室")
+    limit = max(1, min(limit, CHAT_HISTORY_MAX_PAGE))
+    messages, next_before = data_store.get_history(before, limit, room)
+    return {
+        "messages": [
+            {
+                "seq": m.seq,
+                "username": m.username,
+                "content": m.content,
+                "time": m.timestamp.strftime("%H:%M")
+            }
+            for m in messages
+        ],
+        "next_before": next_before
+    }
+
+# 检查视频用户租约到期的间隔（秒）
+VIDEO_EXPIRE_INTERVAL = 5
+
+# 视频在线用户列表
+def video_user_list() -> List[dict]:
+    return [{"username": user.username, "peer_id": user.peer_id} for user in data_store.get_video_users()]
+
+def apply_video_presence(event: dict):
+    """把视频用户的加入/离开应用到本worker的数据，只有实际发生变化时才推送增量"""
+    joined = []
+    for user in event.get("joined", []):
+        if data_store.add_video_user(user["username"], user["peer_id"]):
+            joined.append(user)
+    left = [username for username in event.get("left", []) if data_store.remove_video_user(username)]
+    if joined or left:
+        manager.publish(PRESENCE_ROOM, json.dumps({"type": "presence_delta", "joined": joined, "left": left}))
+
+async def run_video_lease_expiry():
+    """后台任务：清理未按时续约的视频用户（每个worker各自清理自己的副本）"""
+    while True:
+        await asyncio.sleep(VIDEO_EXPIRE_INTERVAL)
+        left = data_store.expire_video_users()
+        if left:
+            manager.publish(PRESENCE_ROOM, json.dumps({"type": "presence_delta", "joined": [], "left": left}))
+
 # 添加视频用户接口
 @app.post("/api/video/register")
 async def register_video_user(data: dict):
-    data_store.add_video_user(data["username"], data["peer_id"])
+    bus.publish({
+        "type": "video_presence",
+        "joined": [{"username": data["username"], "peer_id": data["peer_id"]}]
+    })
     return {"message": "success"}
 
+# 视频用户心跳续约接口（租约过期后再次心跳会重新加入）
+@app.post("/api/video/heartbeat")
+async def heartbeat_video_user(data: dict):
+    bus.publish({
+        "type": "video_presence",
+        "joined": [{"username": data["username"], "peer_id": data["peer_id"]}]
+    })
+    return {"message": "success", "ttl": VIDEO_LEASE_TTL}
+
 # 获取在线视频用户接口
 @app.get("/api/video/users")
 async def get_video_users():
-    users = data_store.get_video_users()
-    return {"users": [{"username": user.username, "peer_id": user.peer_id} for user in users]}
+    return {"users": video_user_list()}
 
 # 用户退出视频接口
 @app.post("/api/video/unregister")
 async def unregister_video_user(data: dict):
-    data_store.remove_video_user(data["username"])
+    bus.publish({"type": "video_presence", "left": [data["username"]]})
     return {"message": "success"}
 
 # 课表数据模型
@@ -336,387 +794,144 @@ async def upload_timetable(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# 已编码响应的缓存: (类型, 邮箱) -> (数据版本号, ETag, 响应体)，数据修改后版本号变化即失效
+RESPONSE_CACHE_SIZE = 10000
+response_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match中是否有与etag相同的标签（弱比较，忽略W/前缀）"""
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+def cached_json_response(request: Request, kind: str, email: str, version: int, build: Callable[[], dict]) -> Response:
+    """返回按数据版本号缓存的JSON响应；请求带有匹配的If-None-Match时返回304"""
+    key = (kind, email)
+    entry = response_cache.get(key)
+    if entry is None or entry[0] != version:
+        # 与JSONResponse相同的编码方式
+        body = json.dumps(build(), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        entry = (version, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', body)
+        response_cache[key] = entry
+        if len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
+    else:
+        response_cache.move_to_end(key)
+    _, etag, body = entry
+    # no-cache: 浏览器每次都带上ETag来验证，数据没变时只收到304
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.get("/api/timetable")
-async def get_timetable(email: str):
+async def get_timetable(email: str, request: Request):
     try:
-        timetable = data_store.get_timetable(email)
-        if not timetable:
-            raise HTTPException(status_code=404, detail="未找到课表数据")
-        return {"timetable": timetable}
+        version, timetable = data_store.get_timetable_snapshot(email)
     except KeyError:
         raise HTTPException(status_code=404, detail="用户不存在")
+    if not timetable:
+        raise HTTPException(status_code=404, detail="未找到课表数据")
+    return cached_json_response(request, "timetable", email, version, lambda: {"timetable": timetable})
 
 
-# 邮件配置（需替换为实际值）
+# 邮件配置（需替换为实际值，也可以用环境变量覆盖，例如压测时指向本地SMTP服务）
 SMTP_CONFIG = {
-    "host": "smtp.qq.com",
-    "port": 465,
-    "user": "859766083@qq.com",
-    "password": "egtlxbbogzqvbbia"
+    "host": os.environ.get("SMTP_HOST", "smtp.qq.com"),
+    "port": int(os.environ.get("SMTP_PORT", "465")),
+    "user": os.environ.get("SMTP_USER", "859766083@qq.com"),       # 为空时不登录
+    "password": os.environ.get("SMTP_PASSWORD", "egtlxbbogzqvbbia"),
+    "use_ssl": os.environ.get("SMTP_SSL", "1") == "1"
 }
-def create_reminder_email_content(course: dict, user_name: str = "同学"):
-    """创建丰富的HTML邮件内容 - 返回HTML和纯文本内容"""
-    
-    # 获取当前时间和课程时间
-    tz = timezone('Asia/Shanghai')
-    now = datetime.now(tz)
-    course_time = datetime.strptime(course['start_time'], "%H:%M").time()
-    course_datetime = datetime.combine(now.date(), course_time)
-    
-    # 计算剩余时间
-    time_diff = course_datetime - now.replace(tzinfo=None)
-    minutes_left = int(time_diff.total_seconds() / 60)
-    
-    # 根据课程时间段判断上课性质
-    hour = course_time.hour
-    if 8 <= hour < 12:
-        period = "上午"
-        greeting = "早上好"
-        icon = "🌅"
-    elif 12 <= hour < 18:
-        period = "下午"
-        greeting = "下午好"
-        icon = "☀️"
-    else:
-        period = "晚上"
-        greeting = "晚上好"
-        icon = "🌙"
-    
-    # 课程类型图标（可以根据课程名称智能判断）
-    course_icon = get_course_icon(course['course_name'])
-    
-    # HTML邮件模板
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <style>
-            body {{
-                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
-                line-height: 1.6;
-                color: #333;
-                max-width: 600px;
-                margin: 0 auto;
-                background-color: #f5f5f5;
-            }}
-            .container {{
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                padding: 0;
-                border-radius: 10px;
-                box-shadow: 0 10px 25px rgba(0,0,0,0.1);
-                overflow: hidden;
-            }}
-            .header {{
-                background: rgba(255,255,255,0.1);
-                color: white;
-                padding: 30px 20px;
-                text-align: center;
-                border-bottom: 1px solid rgba(255,255,255,0.2);
-            }}
-            .header h1 {{
-                margin: 0;
-                font-size: 28px;
-                font-weight: 300;
-            }}
-            .content {{
-                background: white;
-                padding: 30px;
-            }}
-            .alert-box {{
-                background: linear-gradient(135deg, #ff6b6b, #ee5a24);
-                color: white;
-                padding: 20px;
-                border-radius: 8px;
-                text-align: center;
-                margin-bottom: 25px;
-                font-size: 18px;
-                font-weight: bold;
-            }}
-            .course-info {{
-                background: #f8f9fa;
-                border-left: 4px solid #667eea;
-                padding: 20px;
-                margin: 20px 0;
-                border-radius: 0 8px 8px 0;
-            }}
-            .info-row {{
-                display: flex;
-                justify-content: space-between;
-                align-items: center;
-                padding: 8px 0;
-                border-bottom: 1px solid #eee;
-            }}
-            .info-row:last-child {{
-                border-bottom: none;
-            }}
-            .info-label {{
-                font-weight: 600;
-                color: #666;
-                min-width: 80px;
-            }}
-            .info-value {{
-                color: #333;
-                font-weight: 500;
-            }}
-            .countdown {{
-                background: linear-gradient(135deg, #ffeaa7, #fdcb6e);
-                color: #2d3436;
-                padding: 15px;
-                border-radius: 8px;
-                text-align: center;
-                margin: 20px 0;
-                font-size: 16px;
-                font-weight: bold;
-            }}
-            .tips {{
-                background: #e8f4fd;
-                border: 1px solid #bee5eb;
-                border-radius: 8px;
-                padding: 15px;
-                margin: 20px 0;
-            }}
-            .tips h3 {{
-                color: #0c5460;
-                margin-top: 0;
-                font-size: 16px;
-            }}
-            .tips ul {{
-                margin: 10px 0;
-                padding-left: 20px;
-            }}
-            .tips li {{
-                margin: 5px 0;
-                color: #155724;
-            }}
-            .footer {{
-                background: #f8f9fa;
-                padding: 20px;
-                text-align: center;
-                color: #666;
-                font-size: 14px;
-                border-top: 1px solid #eee;
-            }}
-            .emoji {{
-                font-size: 24px;
-                margin-right: 10px;
-            }}
-            .highlight {{
-                color: #667eea;
-                font-weight: bold;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>{icon} {greeting}，{user_name}！</h1>
-                <p>您的课程提醒到啦</p>
-            </div>
-            
-            <div class="content">
-                <div class="alert-box">
-                    ⏰ 距离上课还有 <span class="highlight">{minutes_left}</span> 分钟
-                </div>
-                
-                <div class="course-info">
-                    <div class="info-row">
-                        <span class="info-label">{course_icon} 课程</span>
-                        <span class="info-value">{course['course_name']}</span>
-                    </div>
-                    <div class="info-row">
-                        <span class="info-label">📅 时间</span>
-                        <span class="info-value">{course['day_of_week']} {course['start_time']} - {course['end_time']}</span>
-                    </div>
-                    <div class="info-row">
-                        <span class="info-label">📍 地点</span>
-                        <span class="info-value">{course['location']}</span>
-                    </div>
-                    <div class="info-row">
-                        <span class="info-label">⏱️ 时段</span>
-                        <span class="info-value">{period}课程</span>
-                    </div>
-                </div>
-                
-                <div class="countdown">
-                    🏃‍♀️ 建议现在开始准备出发！
-                </div>
-                
-                <div class="tips">
-                    <h3>📝 温馨提示：</h3>
-                    <ul>
-                        <li>🎒 请检查是否携带了相关课本和学习用品</li>
-                        <li>🚗 考虑当前交通状况，合理规划出行路线</li>
-                        <li>☔ 留意天气变化，必要时携带雨具</li>
-                        <li>🔋 确保手机电量充足，以备不时之需</li>
-                        <li>💧 记得携带水杯，保持水分充足</li>
-                    </ul>
-                </div>
-                
-                <div style="background: #fff3cd; border: 1px solid #ffeaa7; border-radius: 8px; padding: 15px; margin: 20px 0;">
-                    <strong>🎯 今日目标：</strong> 准时到达，积极参与，收获满满！
-                </div>
-            </div>
-            
-            <div class="footer">
-                <p>📧 这是一封自动发送的课程提醒邮件</p>
-                <p>🕐 发送时间：{now.strftime('%Y年%m月%d日 %H:%M')}</p>
-                <p>💝 祝您学习愉快，天天进步！</p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    
-    # 纯文本内容（作为备用）
-    text_content = f"""
-{greeting}，{user_name}！
-
-【课程提醒】
-距离上课还有 {minutes_left} 分钟
-
-课程信息：
-- 课程：{course['course_name']}
-- 时间：{course['day_of_week']} {course['start_time']} - {course['end_time']}
-- 地点：{course['location']}
-- 时段：{period}课程
-
-温馨提示：
-- 请检查是否携带了相关课本和学习用品
-- 考虑当前交通状况，合理规划出行路线
-- 留意天气变化，必要时携带雨具
-- 确保手机电量充足，以备不时之需
-- 记得携带水杯，保持水分充足
-
-今日目标：准时到达，积极参与，收获满满！
-
-发送时间：{now.strftime('%Y年%m月%d日 %H:%M')}
-祝您学习愉快，天天进步！
-    """
-    
-    return html_content, text_content
+# 复用已登录的SMTP连接，同一时间段的大量提醒不必每封都重新握手登录
+mail_pool = SMTPPool(**SMTP_CONFIG)
+# 提醒邮件的发件人
+MAIL_FROM = os.environ.get("MAIL_FROM", "859766083@qq.com")
 
 def send_enhanced_reminder(to_email: str, course: dict, user_name: str = "同学"):
-    """发送增强版邮件提醒"""
-    
-    # 创建邮件内容
-    html_content, text_content = create_reminder_email_content(course, user_name)
-    
-    # 创建多部分邮件
-    msg = MIMEMultipart('alternative')
-    msg['Subject'] = f"📚 课程提醒：{course['course_name']} ({course['start_time']})"
-    msg['From'] = "859766083@qq.com"
-    msg['To'] = to_email
-    
-    # 添加纯文本和HTML部分
-    text_part = MIMEText(text_content, 'plain', 'utf-8')
-    html_part = MIMEText(html_content, 'html', 'utf-8')
-    
-    msg.attach(text_part)
-    msg.attach(html_part)
-    
+    """立即发送增强版邮件提醒（不经过发件箱）"""
     try:
-        with smtplib.SMTP_SSL(SMTP_CONFIG['host'], SMTP_CONFIG['port']) as server:
-            server.login(SMTP_CONFIG['user'], SMTP_CONFIG['password'])
-            server.send_message(msg)
+        mail_pool.sendmail(MAIL_FROM, [to_email], reminder_message(MAIL_FROM, to_email, course, user_name))
         print(f"✅ 增强版提醒邮件已发送至 {to_email}")
         return True
     except Exception as e:
         print(f"❌ 邮件发送失败：{str(e)}")
         return False
+   
 
-def get_course_icon(course_name: str) -> str:
-    """根据课程名称返回相应的图标"""
-    course_name_lower = course_name.lower()
-    
-    # 课程类型映射
-    course_icons = {
-        '数学': '🔢', '高数': '🔢', 'math': '🔢',
-        '英语': '🔤', 'english': '🔤',
-        '物理': '⚛️', 'physics': '⚛️',
-        '化学': '🧪', 'chemistry': '🧪',
-        '生物': '🧬', 'biology': '🧬',
-        '历史': '📜', 'history': '📜',
-        '地理': '🌍', 'geography': '🌍',
-        '政治': '🏛️', 'politics': '🏛️',
-        '语文': '📚', '中文': '📚',
-        '计算机': '💻', '编程': '💻', 'computer': '💻',
-        '体育': '⚽', 'sports': '⚽', '运动': '⚽',
-        '音乐': '🎵', 'music': '🎵',
-        '美术': '🎨', 'art': '🎨',
-        '经济': '💰', 'economics': '💰',
-        '管理': '📊', 'management': '📊',
-        '心理': '🧠', 'psychology': '🧠',
-        '医学': '⚕️', 'medicine': '⚕️',
-        '法律': '⚖️', 'law': '⚖️',
-        '实验': '🔬', 'lab': '🔬',
-    }
-    
-    # 尝试匹配课程名称
-    for keyword, icon in course_icons.items():
-        if keyword in course_name_lower:
-            return icon
-    
-    # 默认图标
-    return '📖'
+# 合并提醒：同一次检查中同一用户到期的所有课程（包括重复导入的相同课程）合并成一封邮件
+REMINDER_DIGEST = os.environ.get("REMINDER_DIGEST", "0") == "1"
 
-def send_enhanced_reminder(to_email: str, course: dict, user_name: str = "同学"):
-    """发送增强版邮件提醒"""
-    
-    # 创建邮件内容
-    html_content, text_content = create_reminder_email_content(course, user_name)
-    
-    # 创建多部分邮件
-    msg = MIMEMultipart('alternative')
-    msg['Subject'] = f"📚 课程提醒：{course['course_name']} ({course['start_time']})"
-    msg['From'] = "859766083@qq.com"
-    msg['To'] = to_email
-    
-    # 添加纯文本和HTML部分
-    text_part = MIMEText(text_content, 'plain', 'utf-8')
-    html_part = MIMEText(html_content, 'html', 'utf-8')
-    
-    msg.attach(text_part)
-    msg.attach(html_part)
-    
-    try:
-        with smtplib.SMTP_SSL(SMTP_CONFIG['host'], SMTP_CONFIG['port']) as server:
-            server.login(SMTP_CONFIG['user'], SMTP_CONFIG['password'])
-            server.send_message(msg)
-        print(f"✅ 增强版提醒邮件已发送至 {to_email}")
-        return True
-    except Exception as e:
-        print(f"❌ 邮件发送失败：{str(e)}")
-        return False
-   
+def deliver_reminder(to_email: str, payload: dict):
+    """发件箱投递线程调用：发送失败时抛出异常，由发件箱安排重试
+
+    邮件中的剩余分钟数和发送时间按发件箱的时钟计算（压测时为模拟时钟）。
+    """
+    now = datetime.fromtimestamp(outbox.clock(), REMINDER_TIMEZONE)
+    if 'courses' in payload:
+        message = digest_message(MAIL_FROM, to_email, payload['courses'], payload['username'], now)
+    else:
+        message = reminder_message(MAIL_FROM, to_email, payload['course'], payload['username'], now)
+    mail_pool.sendmail(MAIL_FROM, [to_email], message)
+    print(f"✅ 增强版提醒邮件已发送至 {to_email}")
+
+def reminder_delivered(payload: dict):
+    """确认送达后才记录已提醒；期间课程被修改则不记录"""
+    for course in payload.get('courses') or [payload['course']]:
+        data_store.mark_reminded(course['email'], course['id'], payload['date'], expected=course)
+
+# 课程提醒先写入持久化的发件箱，由固定数量的投递线程发送，SMTP慢或失败不会拖住定时任务；
+# 每个投递线程一次取出一批消息，用同一个SMTP连接发送
+outbox = Outbox()
+outbox_dispatcher = OutboxDispatcher(outbox, deliver_reminder, on_delivered=reminder_delivered,
+                                     permanent_error=is_permanent_error, session=lambda: mail_pool.session())
+
+def course_start_timestamp(date: str, start_time: str) -> float:
+    return REMINDER_TIMEZONE.localize(datetime.strptime(f"{date} {start_time}", "%Y-%m-%d %H:%M")).timestamp()
 
 def check_reminders():
-    """每分钟执行一次的提醒检查"""
-    tz = timezone('Asia/Shanghai')
-    now = datetime.now(tz)
-    weekday_map = {"周一":0, "周二":1, "周三":2, "周四":3, "周五":4, "周六":5, "周日":6}
-    
-    for user in data_store.users.values():
-        for entry in user.timetable:
-            # 检查星期匹配
-            if weekday_map.get(entry['day_of_week'].strip(), -1) != now.weekday():
-                continue
-            
-            # 解析课程时间
-            try:
-                course_time = datetime.strptime(entry['start_time'], "%H:%M").time()
-                course_dt = datetime.combine(now.date(), course_time).replace(tzinfo=tz)
-            except ValueError:
-                continue
-            
-            # 计算时间差
-            delta = (course_dt - now).total_seconds()
-            if 0 < delta <= 600:  # 10分钟内
-                if entry.get('last_reminder') != now.date().isoformat():
-                    # 使用增强版邮件提醒
-                    send_enhanced_reminder(user.email, entry, user.username)
-                    entry['last_reminder'] = now.date().isoformat()
+    """每分钟执行一次的提醒检查：把提醒时间已到（上课前10分钟内）的课程放入发件箱"""
+    due = [(date, entry) for date, entry in data_store.pop_due_reminders() if entry.get('last_reminder') != date]
+    # 同一门课同一天只入队一次；上课后还没发出的提醒不再发送
+    if REMINDER_DIGEST:
+        by_user: Dict[Tuple[str, str], List[dict]] = {}
+        for date, entry in due:
+            by_user.setdefault((entry['email'], date), []).append(entry)
+        messages = [
+            (f"digest:{email}:{date}:{','.join(str(course_id) for course_id in sorted(course['id'] for course in courses))}", email,
+             {'date': date, 'username': courses[0]['username'], 'courses': courses},
+             min(course_start_timestamp(date, course['start_time']) for course in courses))
+            for (email, date), courses in by_user.items()
+        ]
+    else:
+        messages = [
+            (f"reminder:{entry['email']}:{entry['id']}:{date}", entry['email'],
+             {'date': date, 'username': entry['username'], 'course': entry},
+             course_start_timestamp(date, entry['start_time']))
+            for date, entry in due
+        ]
+    if messages and outbox.enqueue_many(messages):
+        outbox_dispatcher.notify()
 
+@app.get("/api/reminders/stats")
+async def get_reminder_stats():
+    """发件箱各状态的消息数、最近的死信和投递统计"""
+    return {
+        "outbox": outbox.counts(),
+        "dead_letters": [
+            {key: letter[key] for key in ("key", "attempts", "last_error", "updated")}
+            for letter in outbox.dead_letters(limit=20)
+        ],
+        "dispatcher": dict(outbox_dispatcher.stats),
+        "mail_pool": dict(mail_pool.stats)
+    }
 
 def send_reminder(to_email:str, course: dict):
     """ 发送邮件提醒 """
@@ -730,10 +945,7 @@ def send_reminder(to_email:str, course: dict):
     msg['To'] = to_email
     
     try:
-        with smtplib.SMTP_SSL(SMTP_CONFIG['host'], SMTP_CONFIG['port']) as server:
-            
-            server.login(SMTP_CONFIG['user'], SMTP_CONFIG['password'])
-            server.send_message(msg)
+        mail_pool.send(msg)
         print(f"已发送提醒至 {to_email}")
     except Exception as e:
         print(f"邮件发送失败：{str(e)}")
@@ -741,11 +953,51 @@ def send_reminder(to_email:str, course: dict):
 # 初始化定时器
 scheduler = BackgroundScheduler()
 scheduler.add_job(check_reminders, 'interval', minutes=1)
+scheduler.add_job(outbox.purge, 'interval', hours=1)
+
+# 多worker运行时只允许一个worker执行定时提醒，避免重复发送邮件
+SCHEDULER_LOCK_FILE = os.path.join(BUS_DIR, "scheduler.lock")
+scheduler_lock = None
+
+def acquire_scheduler_lock() -> bool:
+    global scheduler_lock
+    if fcntl is None:
+        return True
+    os.makedirs(os.path.dirname(SCHEDULER_LOCK_FILE), exist_ok=True)
+    lock_file = open(SCHEDULER_LOCK_FILE, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    scheduler_lock = lock_file
+    return True
+
+background_tasks: List[asyncio.Task] = []
 
 @app.on_event("startup")
 async def startup():
-    print("定时任务启动")
-    scheduler.start()
+    bus.on_peer_lost = drop_worker_presence
+    await bus.start(handle_bus_event)
+    background_tasks.append(asyncio.create_task(manager.run_reaper()))
+    background_tasks.append(asyncio.create_task(run_video_lease_expiry()))
+    bus.publish({"type": "presence_sync"})
+    if acquire_scheduler_lock():
+        print("定时任务启动")
+        outbox_dispatcher.start()
+        scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await bus.close()
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    outbox_dispatcher.stop()
+    outbox.close()
+    data_store.close()
+    mail_pool.close()
 
 
 # 任务模型
@@ -757,8 +1009,7 @@ class Task(BaseModel):
     @classmethod
     def validate_date(cls, v):
         try:
-            datetime.strptime(v, '%Y-%m-%d')
-            return v
+            return iso_date(v)
         except ValueError:
             raise ValueError('截止日期必须为 YYYY-MM-DD 格式')
 @app.post("/api/tasks/add")
@@ -773,25 +1024,84 @@ async def add_task(
         raise HTTPException(status_code=400, detail="任务信息不能为空")
     
     try:
-        datetime.strptime(due_date, '%Y-%m-%d')
+        due_date = iso_date(due_date)
     except ValueError:
         raise HTTPException(status_code=422, detail="截止日期必须为 YYYY-MM-DD 格式")
 
     task = Task(title=title, description=description, due_date=due_date)
-    data_store.add_task(email, task.model_dump())
-    return {"message": "任务添加成功"}
+    try:
+        task_id = data_store.add_task(email, task.model_dump())
+    except KeyError:
+        raise HTTPException(status_code=404, detail="用户不存在")
+    return {"message": "任务添加成功", "id": task_id}
+
+# 任务查询：每页最多返回的任务数
+TASK_QUERY_DEFAULT_LIMIT = 50
+TASK_QUERY_MAX_LIMIT = 200
+TASK_CURSOR_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2}):(\d+)$")
+
+def parse_task_date(value: Optional[str], name: str) -> Optional[str]:
+    if value is None:
+        return None
+    try:
+        # 与保存的截止日期一样统一为补零的写法，才能按字符串比较
+        return iso_date(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} 必须为 YYYY-MM-DD 格式")
 
 # 获取任务接口
 @app.get("/api/tasks")
-async def get_tasks(email: str):
-    tasks = data_store.get_tasks(email)
-    return {"tasks": tasks}
+async def get_tasks(
+    email: str,
+    request: Request,
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    limit: Optional[int] = Query(None, ge=1, le=TASK_QUERY_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    view: Optional[Literal["overdue", "upcoming"]] = None,
+    days: int = Query(7, ge=0, le=3660)
+):
+    """不带查询参数时返回全部任务；带from/to/limit/cursor/view时按截止日期升序分页返回
+
+    view=overdue 只返回已过期（截止日期早于今天）的任务，view=upcoming 返回今天起days天内到期的任务，
+    与from/to同时给出时取交集。
+    """
+    if start is None and end is None and limit is None and cursor is None and view is None:
+        try:
+            version, tasks = data_store.get_tasks_snapshot(email)
+        except KeyError:
+            raise HTTPException(status_code=404, detail="用户不存在")
+        return cached_json_response(request, "tasks", email, version, lambda: {"tasks": tasks})
+
+    start = parse_task_date(start, "from")
+    end = parse_task_date(end, "to")
+    after = None
+    if cursor is not None:
+        match = TASK_CURSOR_PATTERN.match(cursor)
+        if not match:
+            raise HTTPException(status_code=400, detail="无效的分页游标")
+        after = (match.group(1), int(match.group(2)))
+    if view is not None:
+        today = datetime.now(timezone('Asia/Shanghai')).date()
+        if view == "overdue":
+            bounds = (None, (today - timedelta(days=1)).isoformat())
+        else:
+            bounds = (today.isoformat(), (today + timedelta(days=days)).isoformat())
+        if bounds[0] is not None and (start is None or bounds[0] > start):
+            start = bounds[0]
+        if end is None or bounds[1] < end:
+            end = bounds[1]
+    try:
+        tasks, next_cursor = data_store.query_tasks(email, start, end, limit or TASK_QUERY_DEFAULT_LIMIT, after)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="用户不存在")
+    return {"tasks": tasks, "next_cursor": f"{next_cursor[0]}:{next_cursor[1]}" if next_cursor else None}
 
 # 删除任务接口
 @app.post("/api/tasks/delete")
-async def delete_task(email: str = Form(...), task_index: int = Form(...)):
+async def delete_task(email: str = Form(...), task_id: int = Form(...)):
     try:
-        data_store.delete_task(email, task_index)
+        data_store.delete_task(email, task_id)
         return {"message": "任务删除成功"}
     except KeyError:
         raise HTTPException(status_code=404, detail="用户不存在")
@@ -800,14 +1110,14 @@ async def delete_task(email: str = Form(...), task_index: int = Form(...)):
 
 # 编辑任务接口
 @app.post("/api/tasks/edit")
-async def edit_task(email: str = Form(...), task_index: int = Form(...), title: str = Form(...), description: str = Form(...), due_date: str = Form(...)):
-    print(f"收到编辑任务请求: email={email}, task_index={task_index}, title={title}, description={description}, due_date={due_date}")
+async def edit_task(email: str = Form(...), task_id: int = Form(...), title: str = Form(...), description: str = Form(...), due_date: str = Form(...)):
+    print(f"收到编辑任务请求: email={email}, task_id={task_id}, title={title}, description={description}, due_date={due_date}")
     try:
         if not all([title.strip(), description.strip(), due_date.strip()]):
             raise HTTPException(status_code=400, detail="任务信息不能为空")
         
         try:
-            datetime.strptime(due_date, '%Y-%m-%d')
+            due_date = iso_date(due_date)
         except ValueError:
             raise HTTPException(status_code=422, detail="截止日期必须为 YYYY-MM-DD 格式")
 
@@ -816,15 +1126,43 @@ async def edit_task(email: str = Form(...), task_index: int = Form(...), title:
             "description": description,
             "due_date": due_date
         }
-        data_store.edit_task(email, task_index, updated_task)
-        print(f"任务编辑成功: email={email}, task_index={task_index}")
+        data_store.edit_task(email, task_id, updated_task)
+        print(f"任务编辑成功: email={email}, task_id={task_id}")
         return {"message": "任务编辑成功"}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except KeyError:
         raise HTTPException(status_code=404, detail="用户不存在")
     except IndexError:
-        raise HTTPException(status_code=404, detail="任务索引无效")
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+# 批量任务操作
+TASK_BATCH_MAX_OPERATIONS = 500
+
+class TaskOperation(BaseModel):
+    op: Literal["add", "edit", "delete"]
+    id: Optional[int] = None     # edit/delete 的任务ID
+    task: Optional[Task] = None  # add/edit 的任务内容
+
+class TaskBatch(BaseModel):
+    email: str
+    operations: List[TaskOperation]
+
+@app.post("/api/tasks/batch")
+async def apply_task_batch(batch: TaskBatch):
+    """一次请求提交多条任务增删改，全部校验通过后原子执行，任何一条无效则都不执行"""
+    if len(batch.operations) > TASK_BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"一次最多提交{TASK_BATCH_MAX_OPERATIONS}个操作")
+    operations = [operation.model_dump(exclude_none=True) for operation in batch.operations]
+    try:
+        results = data_store.apply_task_batch(batch.email, operations)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="用户不存在")
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": "批量操作成功", "results": results}
     
 # 课程更新请求模型
 class CourseUpdate(BaseModel):
@@ -869,6 +1207,8 @@ async def update_course(course_id: int, course_data: CourseUpdate):
         else:
             raise HTTPException(status_code=404, detail="课程不存在或更新失败")
             
+    except HTTPException:
+        raise
     except KeyError:
         raise HTTPException(status_code=404, detail="用户不存在")
     except Exception as e:
@@ -888,11 +1228,45 @@ async def delete_course(
         else:
             raise HTTPException(status_code=404, detail="课程不存在或删除失败")
             
+    except HTTPException:
+        raise
     except KeyError:
         raise HTTPException(status_code=404, detail="用户不存在")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ====== 索引查询接口 ======
+
+@app.get("/api/users/by-username")
+async def find_users_by_username(username: str):
+    """按用户名查找用户（聊天和视频在线列表只有用户名）"""
+    emails = data_store.find_emails_by_username(username)
+    return {"users": [{"email": email, "username": username} for email in emails]}
+
+COURSE_QUERY_MAX_LIMIT = 200
+
+def public_course_page(page: Tuple[List[dict], Optional[int]]) -> dict:
+    """跨用户的课程查询只返回课程信息和用户名，不暴露其他用户的邮箱"""
+    courses, next_cursor = page
+    return {
+        "courses": [{key: course[key] for key in COURSE_FIELDS + ("username",)} for course in courses],
+        "next_cursor": next_cursor
+    }
+
+@app.get("/api/courses/by-day")
+async def get_courses_by_day(day: str, limit: int = Query(50, ge=1, le=COURSE_QUERY_MAX_LIMIT),
+                             cursor: Optional[int] = Query(None, ge=0)):
+    """按星期分页查询所有用户的课程，day 为 周一~周日"""
+    if day not in WEEKDAY_INDEX:
+        raise HTTPException(status_code=400, detail="星期格式错误")
+    return public_course_page(data_store.get_courses_on_weekday(WEEKDAY_INDEX[day], limit, cursor))
+
+@app.get("/api/courses/by-location")
+async def get_courses_by_location(location: str, limit: int = Query(50, ge=1, le=COURSE_QUERY_MAX_LIMIT),
+                                  cursor: Optional[int] = Query(None, ge=0)):
+    """按上课地点分页查询所有用户的课程"""
+    return public_course_page(data_store.get_courses_at_location(location.strip(), limit, cursor))
+
 # 获取单个课程接口（可选，用于验证）
 @app.get("/api/timetable/{course_id}")
 async def get_course(course_id: int, email: str):
@@ -902,6 +1276,8 @@ async def get_course(course_id: int, email: str):
             return {"course": course}
         else:
             raise HTTPException(status_code=404, detail="课程不存在")
+    except HTTPException:
+        raise
     except KeyError:
         raise HTTPException(status_code=404, detail="用户不存在")
     except Exception as e:
@@ -950,9 +1326,9 @@ async def add_single_course(course_data: CourseAdd):
         }
         
         # 添加到用户的课表中
-        user.timetable.append(new_course)
+        course_id = data_store.add_single_course(course_data.email, new_course)
         
-        return {"message": "课程添加成功"}
+        return {"message": "课程添加成功", "id": course_id}
         
     except HTTPException:
         raise
@@ -961,4 +1337,10 @@ async def add_single_course(course_data: CourseAdd):
     
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="localhost", port=8082)
\ No newline at end of file
+    workers = int(os.environ.get("WORKERS", "1"))
+    if workers > 1:
+        # 多worker时使用Unix套接字事件总线（子进程继承环境变量）
+        os.environ.setdefault("CHAT_BUS_BACKEND", "unix")
+        uvicorn.run("server:app", host="localhost", port=8082, workers=workers)
+    else:
+        uvicorn.run(app, host="localhost", port=8082)
\ No newline at end of file
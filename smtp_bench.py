@@ -0,0 +1,208 @@
+"""SMTP连接池测试和压测：用本地SMTP服务（reminder_bench.SMTPSink）检查SMTPPool的连接复用和出错处理，
+再比较每封邮件新建连接登录和通过连接池发送的吞吐量
+
+检查项：多线程发送时连接数不超过连接池大小、session()内只用一个连接、收件人被拒后连接仍可复用、
+服务器断开连接后自动重连重发、空闲较久的连接先发NOOP探测、空闲太久的连接直接重连。
+有检查不通过时以非0状态退出。
+
+    python smtp_bench.py
+    python smtp_bench.py --messages 2000 --greeting-delay 0.005
+    python smtp_bench.py --certfile cert.pem --keyfile key.pem     # 隐式TLS（SMTP_SSL）
+"""
+import argparse
+import contextlib
+import smtplib
+import ssl
+import sys
+import threading
+import time
+
+from mailer import SMTPPool, is_permanent_error
+from reminder_bench import SimulatedClock, SMTPSink
+from reminder_email import reminder_message
+
+MAIL_FROM = "reminder@bench.test"
+REJECTED = "nobody@bench.test"
+SAMPLE_COURSE = {"course_name": "高等数学", "day_of_week": "周一", "start_time": "08:00",
+                 "end_time": "09:35", "location": "教一-101"}
+
+class Harness:
+    """按命令行参数创建本地SMTP服务和连接到它的连接池"""
+    def __init__(self, args):
+        self.args = args
+        self.server_context = None
+        self.client_context = None
+        if args.certfile:
+            self.server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.server_context.load_cert_chain(args.certfile, args.keyfile)
+            # 本地自签名证书，不校验
+            self.client_context = ssl.create_default_context()
+            self.client_context.check_hostname = False
+            self.client_context.verify_mode = ssl.CERT_NONE
+        self.message = reminder_message(MAIL_FROM, "student@bench.test", SAMPLE_COURSE)
+
+    @contextlib.contextmanager
+    def sink(self):
+        sink = SMTPSink(greeting_delay=self.args.greeting_delay, ssl_context=self.server_context, reject=[REJECTED])
+        threading.Thread(target=sink.serve_forever, daemon=True).start()
+        try:
+            yield sink
+        finally:
+            sink.shutdown()
+            sink.server_close()
+
+    def pool(self, sink: SMTPSink, **kwargs) -> SMTPPool:
+        return SMTPPool("127.0.0.1", sink.port, "bench", "bench", use_ssl=self.client_context is not None,
+                        ssl_context=self.client_context, **kwargs)
+
+    def connect(self, sink: SMTPSink) -> smtplib.SMTP:
+        if self.client_context is not None:
+            conn = smtplib.SMTP_SSL("127.0.0.1", sink.port, context=self.client_context)
+        else:
+            conn = smtplib.SMTP("127.0.0.1", sink.port)
+        conn.login("bench", "bench")
+        return conn
+
+    def send(self, pool: SMTPPool, to: str = "student@bench.test"):
+        pool.sendmail(MAIL_FROM, [to], self.message)
+
+def check_threads_share_pool(harness: Harness) -> bool:
+    with harness.sink() as sink:
+        pool = harness.pool(sink, size=2)
+        threads = [threading.Thread(target=lambda: [harness.send(pool) for _ in range(50)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.close()
+        connects = pool.stats["connects"]
+        return sink.stats["messages"] == 200 and connects <= 2 and sink.stats["logins"] == connects
+
+def check_session_pins_connection(harness: Harness) -> bool:
+    with harness.sink() as sink:
+        pool = harness.pool(sink, size=4)
+        with pool.session():
+            for _ in range(50):
+                harness.send(pool)
+        pool.close()
+        return sink.stats["messages"] == 50 and pool.stats["connects"] == 1
+
+def check_rejected_keeps_connection(harness: Harness) -> bool:
+    with harness.sink() as sink:
+        pool = harness.pool(sink, size=1)
+        harness.send(pool)
+        try:
+            harness.send(pool, REJECTED)
+            return False
+        except smtplib.SMTPRecipientsRefused as e:
+            permanent = is_permanent_error(e)
+        harness.send(pool)
+        pool.close()
+        return permanent and sink.stats["messages"] == 2 and pool.stats["connects"] == 1
+
+def check_reconnect_after_drop(harness: Harness) -> bool:
+    with harness.sink() as sink:
+        # 不发NOOP，断开要在发送时才发现
+        pool = harness.pool(sink, size=1, noop_after=float("inf"))
+        harness.send(pool)
+        sink.drop_connections()
+        harness.send(pool)
+        pool.close()
+        return sink.stats["messages"] == 2 and pool.stats["connects"] == 2 and pool.stats["reconnects"] == 1
+
+def check_idle_connections(harness: Harness) -> bool:
+    with harness.sink() as sink:
+        clock = SimulatedClock(0.0)
+        pool = harness.pool(sink, size=1, noop_after=10, idle_timeout=120, clock=clock)
+        harness.send(pool)
+        # 空闲超过noop_after：NOOP成功，继续用原连接
+        clock.now += 11
+        harness.send(pool)
+        reused = pool.stats["connects"] == 1 and pool.stats["noops"] == 1
+        # 空闲期间服务器断开：NOOP失败，换新连接，不算发送重试
+        sink.drop_connections()
+        clock.now += 11
+        harness.send(pool)
+        probed = pool.stats["connects"] == 2 and pool.stats["noops"] == 2 and pool.stats["reconnects"] == 0
+        # 空闲超过idle_timeout：不探测，直接重连
+        clock.now += 121
+        harness.send(pool)
+        expired = pool.stats["connects"] == 3 and pool.stats["noops"] == 2
+        pool.close()
+        return reused and probed and expired and sink.stats["messages"] == 4
+
+CHECKS = [
+    ("多线程共用连接池，连接数不超过连接池大小", check_threads_share_pool),
+    ("session()内的发送只用一个连接", check_session_pins_connection),
+    ("收件人被拒（永久错误）后连接继续使用", check_rejected_keeps_connection),
+    ("服务器断开连接后自动重连重发", check_reconnect_after_drop),
+    ("空闲连接先NOOP探测，探测失败或空闲太久时重连", check_idle_connections),
+]
+
+def throughput(harness: Harness, messages: int, threads: int) -> list:
+    """每种发送方式的 (名称, 封/秒, 建立的连接数)"""
+    results = []
+    with harness.sink() as sink:
+        began = time.perf_counter()
+        for _ in range(messages):
+            conn = harness.connect(sink)
+            conn.sendmail(MAIL_FROM, ["student@bench.test"], harness.message)
+            conn.quit()
+        results.append(("每封邮件新建连接并登录", messages / (time.perf_counter() - began), messages))
+
+        pool = harness.pool(sink, size=1)
+        began = time.perf_counter()
+        for _ in range(messages):
+            harness.send(pool)
+        results.append(("连接池（逐封借还连接）", messages / (time.perf_counter() - began), pool.stats["connects"]))
+        pool.close()
+
+        pool = harness.pool(sink, size=1)
+        began = time.perf_counter()
+        with pool.session():
+            for _ in range(messages):
+                harness.send(pool)
+        results.append(("连接池session()", messages / (time.perf_counter() - began), pool.stats["connects"]))
+        pool.close()
+
+        pool = harness.pool(sink, size=threads)
+        workers = [threading.Thread(target=lambda: [harness.send(pool) for _ in range(messages // threads)])
+                   for _ in range(threads)]
+        began = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        sent = messages // threads * threads
+        results.append((f"连接池，{threads} 个线程", sent / (time.perf_counter() - began), pool.stats["connects"]))
+        pool.close()
+    return results
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="SMTP连接池测试和吞吐量对比（本地SMTP服务）")
+    parser.add_argument("--messages", type=int, default=500, help="每种发送方式的邮件数")
+    parser.add_argument("--threads", type=int, default=4, help="多线程发送时的线程数（也是连接池大小）")
+    parser.add_argument("--greeting-delay", type=float, default=0.0, help="本地服务建立连接后的等待秒数，模拟网络往返")
+    parser.add_argument("--certfile", default=None, help="证书文件，给出时以隐式TLS提供服务")
+    parser.add_argument("--keyfile", default=None, help="证书私钥文件")
+    args = parser.parse_args()
+
+    harness = Harness(args)
+    failures = 0
+    for label, check in CHECKS:
+        try:
+            passed = check(harness)
+        except Exception as e:
+            print(f"   {label}: {e!r}")
+            passed = False
+        print(f"{'✅' if passed else '❌'} {label}")
+        failures += not passed
+
+    print(f"吞吐量（{'隐式TLS' if args.certfile else '明文'}，{len(harness.message)} 字节/封，"
+          f"建立连接等待 {args.greeting_delay * 1000:.0f}ms）：")
+    for label, rate, connects in throughput(harness, args.messages, args.threads):
+        print(f"  {label}：{rate:.0f} 封/秒，连接 {connects} 个")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,535 @@
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from data_store import (
+    CHAT_HISTORY_CAPACITY, COURSE_FIELDS, COURSE_IDENTITY_FIELDS, DEFAULT_ROOM, REMINDER_LEAD, REMINDER_TIMEZONE,
+    TASK_FIELDS, TEST_USERS, WEEKDAY_INDEX, WEEKDAY_NAMES, check_task_batch, next_course_start, normalize_date,
+    ChatMessage, User, VideoLeaseRegistry, VideoUser,
+)
+from passwords import check_password
+
+# 连接池大小（WAL模式下多个读连接可以和写连接并发）
+SQLITE_POOL_SIZE = 4
+# 遇到其他进程持有写锁时最多等待的毫秒数
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    email TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    password TEXT NOT NULL,
+    timetable_version INTEGER NOT NULL DEFAULT 0,
+    tasks_version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_by_username ON users(username);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS courses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL REFERENCES users(email) ON UPDATE CASCADE ON DELETE CASCADE,
+    course_name TEXT NOT NULL,
+    day_of_week TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    location TEXT NOT NULL,
+    last_reminder TEXT,
+    next_fire REAL
+);
+CREATE INDEX IF NOT EXISTS courses_by_email ON courses(email, id);
+CREATE INDEX IF NOT EXISTS courses_by_day ON courses(day_of_week);
+CREATE INDEX IF NOT EXISTS courses_by_location ON courses(location);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL REFERENCES users(email) ON UPDATE CASCADE ON DELETE CASCADE,
+    title TEXT NOT NULL,
+    description TEXT NOT NULL,
+    due_date TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_by_email ON tasks(email, id);
+CREATE INDEX IF NOT EXISTS tasks_by_due_date ON tasks(email, due_date, id);
+CREATE TABLE IF NOT EXISTS messages (
+    room TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (room, seq)
+) WITHOUT ROWID;
+"""
+
+
+# 预编译语句：sqlite3会按SQL文本缓存已编译的语句，这里统一使用固定的SQL常量
+SQL_GET_USER = "SELECT email, username, password FROM users WHERE email = ?"
+SQL_INSERT_USER = "INSERT OR IGNORE INTO users (email, username, password) VALUES (?, ?, ?)"
+SQL_COURSES = ("SELECT id, course_name, day_of_week, start_time, end_time, location, last_reminder "
+               "FROM courses WHERE email = ? ORDER BY id")
+SQL_COURSE = ("SELECT id, course_name, day_of_week, start_time, end_time, location, last_reminder "
+              "FROM courses WHERE id = ? AND email = ?")
+SQL_INSERT_COURSE = ("INSERT INTO courses (email, course_name, day_of_week, start_time, end_time, location, last_reminder, next_fire) "
+                     "VALUES (?, ?, ?, ?, ?, ?, NULL, ?)")
+SQL_COURSES_WITH_USER = ("SELECT c.id, c.course_name, c.day_of_week, c.start_time, c.end_time, c.location, "
+                         "c.last_reminder, c.email, u.username, c.next_fire FROM courses c JOIN users u ON u.email = c.email ")
+SQL_TASKS = "SELECT id, title, description, due_date FROM tasks WHERE email = ? ORDER BY id"
+SQL_INSERT_TASK = "INSERT INTO tasks (email, title, description, due_date) VALUES (?, ?, ?, ?)"
+
+def task_row(task: dict) -> tuple:
+    """任务字段的值，截止日期与内存版一样统一为补零的写法，tasks_by_due_date索引按字符串排序"""
+    return task["title"], task["description"], normalize_date(task["due_date"])
+SQL_LAST_SEQ = "SELECT MAX(seq) FROM messages WHERE room = ?"
+SQL_FIRST_SEQ = "SELECT MIN(seq) FROM messages WHERE room = ?"
+SQL_NEXT_VERSION = "UPDATE counters SET value = value + 1 WHERE name = 'version'"
+SQL_SET_TIMETABLE_VERSION = ("UPDATE users SET timetable_version = (SELECT value FROM counters WHERE name = 'version') "
+                             "WHERE email = ?")
+SQL_SET_TASKS_VERSION = ("UPDATE users SET tasks_version = (SELECT value FROM counters WHERE name = 'version') "
+                         "WHERE email = ?")
+SQL_INSERT_MESSAGE = "INSERT INTO messages (room, seq, username, content, timestamp) VALUES (?, ?, ?, ?, ?)"
+
+class SQLiteDataStore:
+    """SQLite（WAL模式）数据存储，方法与内存版DataStore一致，数据重启后不丢失
+
+    多个worker进程可以共享同一个数据库文件。get_user返回的User对象是查询结果的副本，
+    不包含课表和任务，修改数据必须通过本类的方法。视频用户租约仍保存在进程内存中。
+    """
+    shared = True
+
+    def __init__(self, path: str, pool_size: int = SQLITE_POOL_SIZE,
+                 chat_history_capacity: int = CHAT_HISTORY_CAPACITY, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.clock = clock
+        self.chat_history_capacity = chat_history_capacity
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._open())
+        self._local = threading.local()  # 当前线程正在进行的批量事务
+        with self._write() as conn:
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+            # 旧数据库补上版本号列
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+            for column in ("timetable_version", "tasks_version"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE users ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+            # 旧数据库补上提醒时间列，并为已有课程安排提醒
+            if "next_fire" not in {row[1] for row in conn.execute("PRAGMA table_info(courses)")}:
+                conn.execute("ALTER TABLE courses ADD COLUMN next_fire REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS courses_by_next_fire ON courses(next_fire)")
+            now = self.clock()
+            conn.executemany("UPDATE courses SET next_fire = ? WHERE id = ?", [
+                (self._next_fire(day, start_time, now), course_id) for course_id, day, start_time in
+                conn.execute("SELECT id, day_of_week, start_time FROM courses WHERE next_fire IS NULL").fetchall()
+            ])
+            conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('version', 0)")
+            conn.executemany(SQL_INSERT_USER, TEST_USERS)
+        self.video_users = VideoLeaseRegistry()
+
+    def _open(self) -> sqlite3.Connection:
+        # isolation_level=None: 由本类显式控制事务边界
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                               cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        return conn
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+    # ====== 连接池与事务 ======
+
+    @contextmanager
+    def _read(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def _write(self):
+        """写事务；在batch()内部时复用批量事务，不单独提交"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        with self.batch() as conn:
+            yield conn
+
+    @contextmanager
+    def batch(self):
+        """把多次修改合并为一个事务一次提交，例如批量导入"""
+        if getattr(self._local, "conn", None) is not None:
+            yield self._local.conn
+            return
+        conn = self._pool.get()
+        self._local.conn = conn
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            self._local.conn = None
+            self._pool.put(conn)
+
+    # 用户相关方法
+    def add_user(self, email: str, username: str, password: str) -> bool:
+        with self._write() as conn:
+            return conn.execute(SQL_INSERT_USER, (email, username, password)).rowcount == 1
+
+    def get_user(self, email: str) -> Optional[User]:
+        with self._read() as conn:
+            row = conn.execute(SQL_GET_USER, (email,)).fetchone()
+        if row is None:
+            return None
+        return User(email=row[0], username=row[1], password=row[2])
+
+    def verify_user(self, email: str, password: str) -> Optional[User]:
+        user = self.get_user(email)
+        if user and check_password(password, user.password)[0]:
+            return user
+        return None
+
+    def rehash_password(self, email: str, old: str, new: str) -> bool:
+        with self._write() as conn:
+            return conn.execute("UPDATE users SET password = ? WHERE email = ? AND password = ?",
+                                (new, email, old)).rowcount == 1
+
+    def update_user(self, email: str, **kwargs):
+        """更新用户信息（用户名、密码）"""
+        updates = {key: value for key, value in kwargs.items()
+                   if key in ("username", "password") and value is not None}
+        with self._write() as conn:
+            if conn.execute("SELECT 1 FROM users WHERE email = ?", (email,)).fetchone() is None:
+                return False
+            for key, value in updates.items():
+                conn.execute(f"UPDATE users SET {key} = ? WHERE email = ?", (value, email))
+        return True
+
+    def email_exists(self, email: str):
+        with self._read() as conn:
+            return conn.execute("SELECT 1 FROM users WHERE email = ?", (email,)).fetchone() is not None
+
+    def change_user_email(self, old_email: str, new_email: str):
+        """更改用户邮箱，课表和任务通过外键级联更新"""
+        with self._write() as conn:
+            try:
+                cursor = conn.execute("UPDATE users SET email = ? WHERE email = ?", (new_email, old_email))
+            except sqlite3.IntegrityError:
+                return False
+            return cursor.rowcount == 1
+
+    # 聊天消息相关方法
+    def add_message(self, username: str, content: str, room: str = DEFAULT_ROOM) -> ChatMessage:
+        timestamp = datetime.now()
+        with self._write() as conn:
+            seq = (conn.execute(SQL_LAST_SEQ, (room,)).fetchone()[0] or 0) + 1
+            conn.execute(SQL_INSERT_MESSAGE, (room, seq, username, content, timestamp.isoformat()))
+            # 只保留最近chat_history_capacity条
+            conn.execute("DELETE FROM messages WHERE room = ? AND seq <= ?",
+                         (room, seq - self.chat_history_capacity))
+        return ChatMessage(username=username, content=content, timestamp=timestamp, seq=seq)
+
+    def get_messages(self, room: str = DEFAULT_ROOM) -> List[ChatMessage]:
+        return self.get_history(None, self.chat_history_capacity, room)[0]
+
+    def get_history(self, before: Optional[int] = None, limit: int = 50, room: str = DEFAULT_ROOM):
+        """分页获取聊天记录，返回(消息列表, 下一页的before游标或None)"""
+        with self._read() as conn:
+            rows = conn.execute(
+                "SELECT seq, username, content, timestamp FROM messages "
+                "WHERE room = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (room, before if before is not None else 2 ** 62, max(limit, 0))
+            ).fetchall()
+            first_seq = conn.execute(SQL_FIRST_SEQ, (room,)).fetchone()[0]
+        messages = [
+            ChatMessage(username=username, content=content,
+                        timestamp=datetime.fromisoformat(timestamp), seq=seq)
+            for seq, username, content, timestamp in reversed(rows)
+        ]
+        next_before = None
+        if messages and messages[0].seq > first_seq:
+            next_before = messages[0].seq
+        return messages, next_before
+
+    # 视频会议相关方法（租约只保存在本进程内存中）
+    def add_video_user(self, username: str, peer_id: str) -> bool:
+        return self.video_users.register(username, peer_id)
+
+    def remove_video_user(self, username: str) -> bool:
+        return self.video_users.remove(username)
+
+    def get_video_users(self) -> List[VideoUser]:
+        return self.video_users.values()
+
+    def expire_video_users(self, now: Optional[float] = None) -> List[str]:
+        return self.video_users.expire(now)
+
+    # ====== 课表相关方法 ======
+
+    @staticmethod
+    def _timetable_changed(conn: sqlite3.Connection, email: str):
+        # 版本号取自全库递增的计数器，在修改所在的事务中更新
+        conn.execute(SQL_NEXT_VERSION)
+        conn.execute(SQL_SET_TIMETABLE_VERSION, (email,))
+
+    @staticmethod
+    def _tasks_changed(conn: sqlite3.Connection, email: str):
+        conn.execute(SQL_NEXT_VERSION)
+        conn.execute(SQL_SET_TASKS_VERSION, (email,))
+
+    def get_timetable_snapshot(self, email: str):
+        """返回 (版本号, 课表元组)"""
+        with self._read() as conn:
+            # 先读版本号再读数据：即使中间有其他写入，缓存的也只会是比版本号更新的数据，下次读取时会被替换
+            row = conn.execute("SELECT timetable_version FROM users WHERE email = ?", (email,)).fetchone()
+            if row is None:
+                raise KeyError("用户不存在")
+            rows = conn.execute(SQL_COURSES, (email,)).fetchall()
+        return row[0], tuple(self._course_dict(course, with_id=True) for course in rows)
+
+    def get_tasks_snapshot(self, email: str):
+        """返回 (版本号, 任务元组)"""
+        with self._read() as conn:
+            row = conn.execute("SELECT tasks_version FROM users WHERE email = ?", (email,)).fetchone()
+            if row is None:
+                raise KeyError("用户不存在")
+            rows = conn.execute(SQL_TASKS, (email,)).fetchall()
+        return row[0], tuple(dict(zip(TASK_FIELDS, task[1:]), id=task[0]) for task in rows)
+
+    def _require_user(self, conn: sqlite3.Connection, email: str):
+        if conn.execute("SELECT 1 FROM users WHERE email = ?", (email,)).fetchone() is None:
+            raise KeyError("用户不存在")
+
+    def add_timetable(self, email: str, entries: List[dict]):
+        """替换用户的整个课表，所有条目在一个事务中批量写入"""
+        with self._write() as conn:
+            self._require_user(conn, email)
+            conn.execute("DELETE FROM courses WHERE email = ?", (email,))
+            now = self.clock()
+            conn.executemany(SQL_INSERT_COURSE, [
+                (email,) + tuple(entry[field] for field in COURSE_FIELDS)
+                + (self._next_fire(entry["day_of_week"], entry["start_time"], now),)
+                for entry in entries
+            ])
+            self._timetable_changed(conn, email)
+
+    def get_timetable(self, email: str) -> List[dict]:
+        """获取指定用户的课表，课程ID即数据库行ID"""
+        with self._read() as conn:
+            rows = conn.execute(SQL_COURSES, (email,)).fetchall()
+        return [self._course_dict(row, with_id=True) for row in rows]
+
+    @staticmethod
+    def _course_dict(row, with_id: bool = False) -> dict:
+        course = {
+            "course_name": row[1],
+            "day_of_week": row[2],
+            "start_time": row[3],
+            "end_time": row[4],
+            "location": row[5],
+            "last_reminder": row[6],
+        }
+        if with_id:
+            course["id"] = row[0]
+        return course
+
+    def add_single_course(self, email: str, course: dict) -> int:
+        with self._write() as conn:
+            self._require_user(conn, email)
+            cursor = conn.execute(SQL_INSERT_COURSE, (email,) + tuple(course[field] for field in COURSE_FIELDS)
+                                  + (self._next_fire(course["day_of_week"], course["start_time"], self.clock()),))
+            self._timetable_changed(conn, email)
+        return cursor.lastrowid
+
+    def update_course(self, email: str, course_id: int, updated_course: dict) -> bool:
+        fields = [field for field in COURSE_FIELDS + ("last_reminder",) if field in updated_course]
+        with self._write() as conn:
+            row = conn.execute(SQL_COURSE, (course_id, email)).fetchone()
+            if row is None:
+                return False
+            if fields:
+                values = tuple(updated_course[field] for field in fields)
+                if "day_of_week" in updated_course or "start_time" in updated_course:
+                    # 上课时间可能变化，重新安排提醒
+                    fields.append("next_fire")
+                    values += (self._next_fire(updated_course.get("day_of_week", row[2]),
+                                               updated_course.get("start_time", row[3]), self.clock()),)
+                conn.execute(
+                    f"UPDATE courses SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                    values + (course_id,)
+                )
+                self._timetable_changed(conn, email)
+        return True
+
+    def delete_course(self, email: str, course_id: int) -> bool:
+        with self._write() as conn:
+            cursor = conn.execute("DELETE FROM courses WHERE id = ? AND email = ?", (course_id, email))
+            if cursor.rowcount == 0:
+                return False
+            self._timetable_changed(conn, email)
+        return True
+
+    def get_course(self, email: str, course_id: int) -> Optional[dict]:
+        with self._read() as conn:
+            row = conn.execute(SQL_COURSE, (course_id, email)).fetchone()
+        return self._course_dict(row) if row else None
+
+    # ====== 按索引查询 ======
+
+    def find_emails_by_username(self, username: str) -> List[str]:
+        with self._read() as conn:
+            return [row[0] for row in conn.execute("SELECT email FROM users WHERE username = ?", (username,))]
+
+    def _courses_where(self, condition: str, value, limit: int, cursor: Optional[int]) -> Tuple[List[dict], Optional[int]]:
+        """按课程ID分页，cursor为上一页最后一门课程的ID（参数和返回值与内存版一致，游标的含义由存储决定）"""
+        limit = max(limit, 0)
+        with self._read() as conn:
+            # 多取一条判断是否还有下一页
+            rows = conn.execute(SQL_COURSES_WITH_USER + f"WHERE c.{condition} = ? AND c.id > ? ORDER BY c.id LIMIT ?",
+                                (value, cursor or 0, limit + 1)).fetchall()
+        courses = [dict(self._course_dict(row, with_id=True), email=row[7], username=row[8]) for row in rows[:limit]]
+        next_cursor = rows[limit - 1][0] if len(rows) > limit > 0 else None
+        return courses, next_cursor
+
+    def get_courses_on_weekday(self, weekday: int, limit: int = 50,
+                               cursor: Optional[int] = None) -> Tuple[List[dict], Optional[int]]:
+        return self._courses_where("day_of_week", WEEKDAY_NAMES[weekday], limit, cursor)
+
+    def get_courses_at_location(self, location: str, limit: int = 50,
+                                cursor: Optional[int] = None) -> Tuple[List[dict], Optional[int]]:
+        return self._courses_where("location", location, limit, cursor)
+
+    # ====== 任务管理方法 ======
+
+    def add_task(self, email: str, task: dict) -> int:
+        with self._write() as conn:
+            self._require_user(conn, email)
+            cursor = conn.execute(SQL_INSERT_TASK, (email,) + task_row(task))
+            self._tasks_changed(conn, email)
+        return cursor.lastrowid
+
+    def get_tasks(self, email: str) -> List[dict]:
+        with self._read() as conn:
+            self._require_user(conn, email)
+            rows = conn.execute(SQL_TASKS, (email,)).fetchall()
+        return [dict(zip(TASK_FIELDS, row[1:]), id=row[0]) for row in rows]
+
+    def query_tasks(self, email: str, start: Optional[str] = None, end: Optional[str] = None,
+                    limit: int = 50, cursor: Optional[Tuple[str, int]] = None) -> Tuple[List[dict], Optional[Tuple[str, int]]]:
+        """按截止日期升序查询任务，使用tasks_by_due_date索引，参数和返回值与内存版一致"""
+        conditions = ["email = ?"]
+        params: list = [email]
+        if start is not None:
+            conditions.append("due_date >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("due_date <= ?")
+            params.append(end)
+        if cursor is not None:
+            conditions.append("(due_date, id) > (?, ?)")
+            params.extend(cursor)
+        # 多取一条判断是否还有下一页
+        params.append(max(limit, 0) + 1)
+        with self._read() as conn:
+            self._require_user(conn, email)
+            rows = conn.execute(
+                f"SELECT id, title, description, due_date FROM tasks WHERE {' AND '.join(conditions)} "
+                "ORDER BY due_date, id LIMIT ?", params
+            ).fetchall()
+        tasks = [dict(zip(TASK_FIELDS, row[1:]), id=row[0]) for row in rows[:max(limit, 0)]]
+        next_cursor = (tasks[-1]["due_date"], tasks[-1]["id"]) if tasks and len(rows) > len(tasks) else None
+        return tasks, next_cursor
+
+    def delete_task(self, email: str, task_id: int):
+        with self._write() as conn:
+            self._require_user(conn, email)
+            if conn.execute("DELETE FROM tasks WHERE id = ? AND email = ?", (task_id, email)).rowcount == 0:
+                raise IndexError("任务不存在")
+            self._tasks_changed(conn, email)
+
+    def edit_task(self, email: str, task_id: int, updated_task: dict):
+        with self._write() as conn:
+            self._require_user(conn, email)
+            cursor = conn.execute(
+                "UPDATE tasks SET title = ?, description = ?, due_date = ? WHERE id = ? AND email = ?",
+                task_row(updated_task) + (task_id, email)
+            )
+            if cursor.rowcount == 0:
+                raise IndexError("任务不存在")
+            self._tasks_changed(conn, email)
+
+    def apply_task_batch(self, email: str, operations: List[dict]) -> List[dict]:
+        """在一个事务中执行一组任务操作，全部校验通过才执行，版本号只更新一次"""
+        with self._write() as conn:
+            self._require_user(conn, email)
+            check_task_batch(operations, [row[0] for row in conn.execute("SELECT id FROM tasks WHERE email = ?", (email,))])
+            results = []
+            for operation in operations:
+                op = operation["op"]
+                if op == "add":
+                    task_id = conn.execute(
+                        SQL_INSERT_TASK, (email,) + task_row(operation["task"])
+                    ).lastrowid
+                elif op == "edit":
+                    task_id = operation["id"]
+                    conn.execute(
+                        "UPDATE tasks SET title = ?, description = ?, due_date = ? WHERE id = ?",
+                        task_row(operation["task"]) + (task_id,)
+                    )
+                else:
+                    task_id = operation["id"]
+                    conn.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+                results.append({"op": op, "id": task_id})
+            if operations:
+                self._tasks_changed(conn, email)
+        return results
+
+    # ====== 课程提醒 ======
+
+    @staticmethod
+    def _next_fire(day_of_week: str, start_time: str, after: float) -> Optional[float]:
+        start = next_course_start(WEEKDAY_INDEX.get(day_of_week, day_of_week), start_time, after)
+        return None if start is None else start - REMINDER_LEAD
+
+    def pop_due_reminders(self, now: Optional[float] = None) -> List[Tuple[str, dict]]:
+        """取出提醒时间已到的课程并安排到下一周，返回值与内存版一致；通过courses_by_next_fire索引只读取到期的课程"""
+        now = self.clock() if now is None else now
+        due = []
+        with self._write() as conn:
+            rows = conn.execute(SQL_COURSES_WITH_USER + "WHERE c.next_fire <= ? ORDER BY c.next_fire",
+                                (now,)).fetchall()
+            conn.executemany("UPDATE courses SET next_fire = ? WHERE id = ?", [
+                (self._next_fire(row[2], row[3], max(row[9] + REMINDER_LEAD, now)), row[0]) for row in rows
+            ])
+        for row in rows:
+            start = row[9] + REMINDER_LEAD
+            if start > now:
+                course = dict(self._course_dict(row, with_id=True), email=row[7], username=row[8])
+                due.append((datetime.fromtimestamp(start, REMINDER_TIMEZONE).date().isoformat(), course))
+        return due
+
+    def mark_reminded(self, email: str, course_id: int, date: str, expected: Optional[dict] = None) -> bool:
+        with self._write():
+            if expected is not None:
+                # 读取和标记在同一个写事务中，期间课程不会被修改
+                course = self.get_course(email, course_id)
+                if course is None or any(course.get(key) != expected.get(key) for key in COURSE_IDENTITY_FIELDS):
+                    return False
+            return self.update_course(email, course_id, {"last_reminder": date})
@@ -0,0 +1,61 @@
+"""数据存储压测：比较内存存储和SQLite（WAL）存储的verify_user、get_timetable、add_task吞吐量
+
+用户密码以明文写入，verify_user只比较字符串，测到的是存储本身的开销而不是PBKDF2。
+SQLite额外测一次在batch()中批量提交的add_task。
+
+    python store_bench.py
+    python store_bench.py --users 10000 --courses 20 --ops 50000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from data_store import DataStore
+from sqlite_store import SQLiteDataStore
+
+def populate(store, users: int, courses: int):
+    timetable = [{"course_name": f"课程{number}", "day_of_week": "周一", "start_time": "08:00",
+                  "end_time": "09:35", "location": "教一-101"} for number in range(courses)]
+    for number in range(users):
+        email = f"student{number}@bench.test"
+        store.add_user(email, f"学生{number}", "bench")
+        store.add_timetable(email, timetable)
+
+def throughput(action, users: int, ops: int) -> float:
+    began = time.perf_counter()
+    for number in range(ops):
+        action(f"student{number % users}@bench.test")
+    return ops / (time.perf_counter() - began)
+
+def bench(store, users: int, ops: int) -> dict:
+    task = {"title": "作业", "description": "完成习题", "due_date": "2026-01-01"}
+    results = {
+        "verify_user": throughput(lambda email: store.verify_user(email, "bench"), users, ops),
+        "get_timetable": throughput(store.get_timetable, users, ops),
+        "add_task": throughput(lambda email: store.add_task(email, task), users, ops),
+    }
+    if hasattr(store, "batch"):
+        with store.batch():
+            results["add_task (batch)"] = throughput(lambda email: store.add_task(email, task), users, ops)
+    return results
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="内存存储与SQLite存储的吞吐量对比")
+    parser.add_argument("--users", type=int, default=2000, help="用户数")
+    parser.add_argument("--courses", type=int, default=20, help="每个用户的课程数")
+    parser.add_argument("--ops", type=int, default=20000, help="每项操作的次数")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="store-bench-")
+    stores = [("memory", DataStore()), ("sqlite", SQLiteDataStore(os.path.join(workdir, "bench.db")))]
+    for name, store in stores:
+        populate(store, args.users, args.courses)
+        for operation, rate in bench(store, args.users, args.ops).items():
+            print(f"{name:8s} {operation:20s} {rate:12,.0f} 次/秒")
+        store.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
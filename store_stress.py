@@ -0,0 +1,235 @@
+"""数据存储并发压测：API修改、课程提醒和日志压缩同时运行，检查课表快照和日志的一致性
+
+使用挂接了日志的内存存储（临时目录），同时运行：
+- 多个API线程随机添加/修改/删除课程、添加/删除任务、发聊天消息；
+- 提醒定时检查（check_reminders）和发件箱投递线程，邮件发到本地SMTP服务，
+  送达后由投递线程调用mark_reminded，其中一个用户有--big-timetable门马上要上的课；
+- 读取线程反复读取课表快照，换邮箱线程来回修改一批用户的邮箱；
+- 压缩线程不停地写快照、切换日志段。
+检查线程在持有用户分段锁时比较缓存的课表快照和实际课表。结束后再比较一次全部用户，
+并从日志目录重放出一个新存储和原存储比较。有快照过期、重放不一致、线程出错或
+不能按时结束（疑似死锁）、消息进入死信时以非0状态退出。
+
+    python store_stress.py
+    python store_stress.py --seconds 60 --users 500 --big-timetable 50000
+"""
+import argparse
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from data_store import REMINDER_TIMEZONE, WEEKDAY_NAMES
+from journal import open_journaled_store
+from reminder_bench import SMTPSink
+
+BIG_USER = "big@stress.test"
+
+def soon_course(name: str, minutes: int = 5) -> dict:
+    """几分钟后开始的课程，下一次check_reminders就会为它发提醒"""
+    when = datetime.now(REMINDER_TIMEZONE) + timedelta(minutes=minutes)
+    return {"course_name": name, "day_of_week": WEEKDAY_NAMES[when.weekday()], "start_time": when.strftime("%H:%M"),
+            "end_time": "23:59", "location": "教一-101"}
+
+def fresh_timetable(user) -> tuple:
+    return tuple(dict(course.to_dict(), id=course_id) for course_id, course in user.timetable.items())
+
+def stale_snapshots(store, emails) -> list:
+    """缓存的课表快照和实际课表不一致的用户"""
+    stale = []
+    for email in emails:
+        # 持有分段锁比较，正常的修改不会夹在两次读取之间
+        with store._stripe(email):
+            user = store.users.get(email)
+            if user is not None and store.get_timetable_snapshot(email)[1] != fresh_timetable(user):
+                stale.append(email)
+    return stale
+
+class Workers:
+    """运行压测线程，统计每种操作的次数，记录线程中抛出的异常"""
+    def __init__(self):
+        self.stop = threading.Event()
+        self.threads = []
+        self.errors = []
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def count(self, key: str):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def spawn(self, name: str, step):
+        def run():
+            try:
+                while not self.stop.is_set():
+                    step()
+            except Exception as e:
+                self.errors.append(f"{name}: {e!r}")
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def join(self, timeout: float) -> list:
+        """通知线程结束，返回没能在timeout秒内结束的线程名"""
+        self.stop.set()
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        return [thread.name for thread in self.threads if thread.is_alive()]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="数据存储并发压测（API修改 + 课程提醒 + 日志压缩）")
+    parser.add_argument("--seconds", type=float, default=10, help="运行秒数")
+    parser.add_argument("--users", type=int, default=100, help="普通用户数")
+    parser.add_argument("--courses", type=int, default=5, help="每个普通用户初始的课程数")
+    parser.add_argument("--big-timetable", type=int, default=20000, help="大课表用户的课程数")
+    parser.add_argument("--api-threads", type=int, default=6, help="API修改线程数")
+    parser.add_argument("--movers", type=int, default=4, help="来回换邮箱的用户数")
+    parser.add_argument("--workers", type=int, default=4, help="投递线程数")
+    parser.add_argument("--join-timeout", type=float, default=30, help="等待线程结束的秒数，超过视为死锁")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    args = parser.parse_args()
+
+    sink = SMTPSink()
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    workdir = tempfile.mkdtemp(prefix="store-stress-")
+    # server在导入时读取这些配置：邮件发到本地SMTP服务，发件箱放在临时目录，不限速
+    os.environ.update({
+        "SMTP_HOST": "127.0.0.1", "SMTP_PORT": str(sink.port), "SMTP_SSL": "0", "SMTP_USER": "",
+        "OUTBOX_PATH": os.path.join(workdir, "outbox.db"), "OUTBOX_WORKERS": str(args.workers),
+        "OUTBOX_DEFAULT_RATE": "0", "OUTBOX_RATE_LIMITS": "",
+        "REMINDER_DIGEST": "0", "DATA_STORE_BACKEND": "memory",
+    })
+    import server
+
+    store = open_journaled_store(os.path.join(workdir, "journal"))
+    server.data_store = store
+    emails = [f"student{number}@stress.test" for number in range(args.users)]
+    for number, email in enumerate(emails):
+        store.add_user(email, f"学生{number}", "stress")
+        store.add_timetable(email, [soon_course(f"课程{number}-{k}") for k in range(args.courses)])
+    store.add_user(BIG_USER, "大课表", "stress")
+    store.add_timetable(BIG_USER, [soon_course(f"大课{k}") for k in range(args.big_timetable)])
+    movers = [(f"mover{number}@a.stress.test", f"mover{number}@b.stress.test") for number in range(args.movers)]
+    for number, (email, _) in enumerate(movers):
+        store.add_user(email, f"换邮箱{number}", "stress")
+        store.add_timetable(email, [soon_course(f"换邮箱课程{number}")])
+
+    workers = Workers()
+    task = {"title": "作业", "description": "完成习题", "due_date": "2026-01-01"}
+
+    def api_step(rng: random.Random):
+        number = rng.randrange(args.users)
+        email = emails[number]
+        action = rng.randrange(6)
+        if action == 0:
+            store.add_single_course(email, soon_course(f"课程{number}-{rng.randrange(100)}"))
+            workers.count("add_single_course")
+        elif action in (1, 2):
+            timetable = store.get_timetable(email)
+            if timetable:
+                course_id = rng.choice(timetable)["id"]
+                if action == 1:
+                    store.delete_course(email, course_id)
+                    workers.count("delete_course")
+                else:
+                    store.update_course(email, course_id, {"location": f"教{rng.randrange(5)}-101"})
+                    workers.count("update_course")
+        elif action == 3:
+            store.add_task(email, task)
+            workers.count("add_task")
+        elif action == 4:
+            tasks = store.get_tasks(email)
+            if tasks:
+                with contextlib.suppress(IndexError):  # 被其他线程先删了
+                    store.delete_task(email, tasks[0]["id"])
+                workers.count("delete_task")
+        else:
+            store.add_message(f"学生{number}", "明天的作业是什么？", f"course:课程{number % 5}")
+            workers.count("add_message")
+
+    def read_step(rng: random.Random):
+        store.get_timetable_snapshot(BIG_USER)
+        store.get_timetable(emails[rng.randrange(args.users)])
+        workers.count("read")
+
+    def check_step(rng: random.Random):
+        email = BIG_USER if rng.random() < 0.5 else emails[rng.randrange(args.users)]
+        if stale_snapshots(store, [email]):
+            workers.count("stale")
+        workers.count("check")
+
+    def reminder_step():
+        server.check_reminders()
+        workers.count("check_reminders")
+        time.sleep(0.05)
+
+    def move_step():
+        for old, new in movers:
+            store.change_user_email(old, new)
+            store.change_user_email(new, old)
+        workers.count("change_user_email")
+
+    def compact_step():
+        store.compactor.compact()
+        workers.count("compact")
+        time.sleep(0.02)
+
+    # 每封邮件都会打印一行，压测时丢弃
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        server.outbox_dispatcher.start()
+        for number in range(args.api_threads):
+            rng = random.Random(args.seed + number)
+            workers.spawn(f"api-{number}", lambda rng=rng: api_step(rng))
+        rng = random.Random(args.seed - 1)
+        workers.spawn("read", lambda: read_step(rng))
+        check_rng = random.Random(args.seed - 2)
+        workers.spawn("check", lambda: check_step(check_rng))
+        workers.spawn("reminders", reminder_step)
+        workers.spawn("mover", move_step)
+        workers.spawn("compactor", compact_step)
+        time.sleep(args.seconds)
+        hung = workers.join(args.join_timeout)
+        if hung:
+            # 持有锁的线程停不下来，不再做清理和后续检查
+            print(f"❌ 线程 {', '.join(hung)} 在 {args.join_timeout}s 内没有结束，疑似死锁", file=sys.stderr)
+            return 1
+        # 再等一会儿让已入队的提醒投递完
+        deadline = time.monotonic() + args.join_timeout
+        while server.outbox.backlog() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        server.outbox_dispatcher.stop()
+    server.mail_pool.close()
+
+    failures = list(workers.errors)
+    if workers.counts.get("stale"):
+        failures.append(f"运行中 {workers.counts['stale']} 次检查发现课表快照与实际课表不一致")
+    stale = stale_snapshots(store, list(store.users))
+    if stale:
+        failures.append(f"结束后 {len(stale)} 个用户的课表快照与实际课表不一致")
+    counts = server.outbox.counts()
+    if counts.get("dead"):
+        failures.append(f"{counts['dead']} 条消息进入死信")
+    reminded = sum(course.last_reminder is not None for user in store.users.values() for course in user.timetable.values())
+
+    state = store.dump_state()
+    directory = store.journal.directory
+    store.close()
+    replayed = open_journaled_store(directory)
+    if replayed.dump_state() != state:
+        failures.append("从日志重放出的数据与原数据不一致")
+    replayed.close()
+
+    print(f"运行 {args.seconds}s：用户 {args.users + args.movers + 1}，大课表 {args.big_timetable} 门课")
+    print("操作次数：" + "  ".join(f"{key} {value}" for key, value in sorted(workers.counts.items())))
+    print(f"提醒邮件 {sink.stats['messages']} 封，已标记提醒的课程 {reminded} 门，发件箱 {counts}")
+    for failure in failures:
+        print(f"❌ {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
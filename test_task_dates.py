@@ -0,0 +1,55 @@
+"""任务截止日期：strptime也接受未补零的日期（2026-1-5），保存、索引和查询前都要统一为YYYY-MM-DD
+
+    python -m pytest test_task_dates.py
+"""
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from data_store import DataStore
+from sqlite_store import SQLiteDataStore
+
+EMAIL = "student@test.example"
+
+@pytest.fixture(params=["memory", "sqlite"])
+def client(request, tmp_path, monkeypatch):
+    store = DataStore() if request.param == "memory" else SQLiteDataStore(str(tmp_path / "tasks.db"))
+    store.add_user(EMAIL, "学生", "pw")
+    monkeypatch.setattr(server, "data_store", store)
+    yield TestClient(server.app)
+    store.close()
+
+def add_task(client, due_date: str):
+    return client.post("/api/tasks/add", data={"email": EMAIL, "title": "作业", "description": "完成习题", "due_date": due_date})
+
+def due_dates(client, **params) -> list:
+    response = client.get("/api/tasks", params=dict(params, email=EMAIL))
+    assert response.status_code == 200
+    return [task["due_date"] for task in response.json()["tasks"]]
+
+def test_non_padded_dates_are_stored_padded(client):
+    for due_date in ("2026-1-5", "2026-01-20", "2026-2-1"):
+        assert add_task(client, due_date).status_code == 200
+    assert due_dates(client) == ["2026-01-05", "2026-01-20", "2026-02-01"]
+    assert due_dates(client, **{"from": "2026-01-01", "to": "2026-01-31"}) == ["2026-01-05", "2026-01-20"]
+
+def test_non_padded_query_bounds(client):
+    for due_date in ("2026-01-05", "2026-01-20", "2026-02-01"):
+        add_task(client, due_date)
+    assert due_dates(client, **{"from": "2026-1-1", "to": "2026-1-31"}) == ["2026-01-05", "2026-01-20"]
+
+def test_edit_and_batch_store_padded_dates(client):
+    task_id = add_task(client, "2026-03-01").json()["id"]
+    response = client.post("/api/tasks/edit", data={"email": EMAIL, "task_id": task_id, "title": "作业",
+                                                     "description": "完成习题", "due_date": "2026-1-9"})
+    assert response.status_code == 200
+    response = client.post("/api/tasks/batch", json={"email": EMAIL, "operations": [
+        {"op": "add", "task": {"title": "作业", "description": "完成习题", "due_date": "2026-1-3"}},
+    ]})
+    assert response.status_code == 200
+    assert due_dates(client, limit=10) == ["2026-01-03", "2026-01-09"]
+
+def test_invalid_dates_are_rejected(client):
+    assert add_task(client, "2026-13-01").status_code == 422
+    response = client.get("/api/tasks", params={"email": EMAIL, "from": "2026-02-30"})
+    assert response.status_code == 400